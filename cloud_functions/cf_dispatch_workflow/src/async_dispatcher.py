@@ -0,0 +1,209 @@
+"""
+Concurrent dispatch of many Pub/Sub messages by one instance.
+
+`receive_messages` handles one message per invocation and blocks on each of
+its steps (load job, moves, workflow), so an instance handles one file at a
+time. The `receive_push` entry point is instead an HTTP function for a
+Pub/Sub push subscription, for a runtime which sends many requests to one
+instance (Cloud Functions 2nd gen or Cloud Run with a concurrency above 1);
+`serve` runs the same dispatch behind a local HTTP server. The messages of
+all the requests of an instance go through one asyncio event loop:
+    - each message is handled by `receive_messages` as it is (same loads,
+      same archive/reject moves, same workflow), in a pool of
+      `async_max_concurrency` worker threads (32 by default): a blocking SDK
+      call holds its thread, not the loop, and all the threads share the
+      clients of `common/clients.py`, so their HTTP session and connection
+      pool (size it with `http_pool_size`);
+    - at most `async_table_concurrency` messages of a table (1 by default)
+      are handled at once: the files of a table replace partitions of the
+      same raw table and merge into the same cleaned tables, while the other
+      tables go on meanwhile;
+    - a push request is answered 204 (acknowledged) once its message is
+      handled, 500 if the handling raised (delivered again by Pub/Sub) and
+      400 if it is not a Pub/Sub push.
+
+Each message is still recorded as one `receive_messages` invocation (see
+`common/instrumentation.py`).
+
+Local server (from `src/`): python async_dispatcher.py --port 8080
+"""
+import argparse
+import asyncio
+import base64
+import contextvars
+import json
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_TABLE_CONCURRENCY = 1
+
+HTTP_REASONS = {204: 'No Content', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                500: 'Internal Server Error'}
+
+
+def push_event(envelope: dict) -> dict:
+    """
+    Event of `receive_messages` from the body of a Pub/Sub push request
+    ({"message": {"data", "attributes", "messageId"}, "subscription"}).
+
+    Raises:
+         ValueError: If the body is not a Pub/Sub push.
+    """
+    if not isinstance(envelope, dict) or not isinstance(envelope.get('message'), dict):
+        raise ValueError("Le corps de la requête n'est pas un message Pub/Sub push")
+    message = envelope['message']
+    if not message.get('data'):
+        raise ValueError('Message Pub/Sub sans données')
+    return {
+        'data': message['data'],
+        'attributes': message.get('attributes') or {},
+        'messageId': message.get('messageId') or message.get('message_id'),
+    }
+
+
+class Dispatcher:
+    """
+    Event loop handling many messages at once with a per-table limit.
+
+    Args:
+         handler (callable): `handler(event, context)` handling one message,
+                             `receive_messages`.
+         max_concurrency (int): Messages handled at once by the instance,
+                                `async_max_concurrency` by default.
+         table_concurrency (int): Messages of a table handled at once,
+                                  `async_table_concurrency` by default.
+    """
+
+    def __init__(self, handler, max_concurrency: int = None, table_concurrency: int = None):
+        self._handler = handler
+        self.max_concurrency = max_concurrency or int(os.environ.get('async_max_concurrency',
+                                                                     DEFAULT_MAX_CONCURRENCY))
+        self.table_concurrency = table_concurrency or int(os.environ.get('async_table_concurrency',
+                                                                         DEFAULT_TABLE_CONCURRENCY))
+        self._pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='dispatch')
+        self._table_semaphores = {}
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def _table_semaphore(self, table_name: str) -> asyncio.Semaphore:
+        # only created from the loop, one per table
+        if table_name not in self._table_semaphores:
+            self._table_semaphores[table_name] = asyncio.Semaphore(self.table_concurrency)
+        return self._table_semaphores[table_name]
+
+    async def dispatch(self, event: dict):
+        """
+        Handle one message once its table has a free slot.
+
+        Args:
+             event (dict): Event of `receive_messages`.
+        """
+        table_name = base64.b64decode(event['data']).decode('utf-8')
+        async with self._table_semaphore(table_name):
+            loop = asyncio.get_running_loop()
+            # each message is its own invocation, in a copy of the current context
+            await loop.run_in_executor(self._pool, contextvars.copy_context().run, self._handler, event, {})
+
+    async def dispatch_all(self, events: list) -> list:
+        """
+        Handle many messages at once.
+
+        Returns:
+             list: For each event, None if it was handled, else the exception
+                   it raised.
+        """
+        results = await asyncio.gather(*[self.dispatch(event) for event in events], return_exceptions=True)
+        return [result if isinstance(result, BaseException) else None for result in results]
+
+    def submit(self, event: dict):
+        """
+        Handle a message on the event loop of the instance, from any thread
+        (the request threads of the runtime). The loop runs in a background
+        thread, started by the first call.
+
+        Returns:
+             concurrent.futures.Future: Done when the message is handled.
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='dispatch-loop', daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(self.dispatch(event), self._loop)
+
+    async def _answer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        One request of the local HTTP server: POST of a Pub/Sub push.
+        """
+        status, body = 500, ''
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            content = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if len(request_line) < 2 or request_line[0] != 'POST':
+                status, body = 405, 'POST only'
+            else:
+                try:
+                    event = push_event(json.loads(content or b'null'))
+                except ValueError as e:
+                    status, body = 400, str(e)
+                else:
+                    try:
+                        await self.dispatch(event)
+                        status = 204
+                    except Exception as e:
+                        status, body = 500, repr(e)
+        except Exception as e:
+            body = repr(e)
+        finally:
+            data = body.encode('utf-8')
+            writer.write(f'HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Length: {len(data)}\r\n'
+                         f'Content-Type: text/plain; charset=utf-8\r\nConnection: close\r\n\r\n'.encode('latin-1')
+                         + data)
+            await writer.drain()
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8080):
+        """
+        Local HTTP server of the Pub/Sub push requests, until cancelled.
+        """
+        server = await asyncio.start_server(self._answer, host, port)
+        print(f'Pub/Sub push dispatcher on http://{host}:{port}/ '
+              f'({self.max_concurrency} messages at once, {self.table_concurrency} per table)')
+        async with server:
+            await server.serve_forever()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def dispatcher(handler) -> Dispatcher:
+    """
+    Dispatcher of the instance, built on first use.
+    """
+    global _dispatcher
+
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher(handler)
+    return _dispatcher
+
+
+if __name__ == '__main__':
+    import main
+
+    parser = argparse.ArgumentParser(description='Local HTTP server of the Pub/Sub push requests.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    asyncio.run(dispatcher(main.receive_messages).serve(args.host, args.port))
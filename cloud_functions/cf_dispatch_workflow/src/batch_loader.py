@@ -0,0 +1,291 @@
+"""
+Micro-batching of the raw loads.
+
+By default every file is loaded with its own load job. When
+`load_batch_max_files` is set, the files are instead gathered per table and
+format in one document (`state/load_batches/<table>.<extension>.json`), each
+with the date of its file name, and loaded together once the batch reaches:
+    - `load_batch_max_files` files, or
+    - `load_batch_max_bytes` bytes, or
+    - `load_batch_max_age` seconds since its first file (the batches which
+      do not grow anymore are flushed by `flush_due_batches`, called on a
+      schedule by the `track_executions` entry point).
+
+A batch of one date (or of a table which is not partitioned on the file
+date) is loaded as one `source_uris` list in a single load job. A batch of
+several dates, a backfill for instance, is loaded into the partitions of its
+dates at once (see `load_batch` of `main.py`).
+
+The files of a batch follow the result of its load: all archived (and
+recorded in the content index, see `content_index`) if it succeeded, all
+rejected if it failed.
+
+A batch being loaded is kept in the `flushing` part of its document until it
+is done, so it is loaded by only one instance and, if that instance dies,
+flushed again after `load_batch_flush_timeout` seconds. The document is
+deleted once empty, the next file of the table opens a new one.
+
+A message delivered again adds nothing if its file is already in the batch
+or being loaded. As it may also come once the file is loaded and moved, a
+flush first checks that each file is still in the bucket with the generation
+it was added with, and drops the others instead of failing the load job.
+"""
+import contextvars
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from common import clients
+from common import content_index
+from common import instrumentation
+from common import state_store
+from common import tables
+
+BATCHES_PREFIX = 'load_batches/'
+
+DEFAULT_MAX_BYTES = 1024 ** 3
+DEFAULT_MAX_AGE = 300
+DEFAULT_FLUSH_TIMEOUT = 900
+DEFAULT_CHECK_WORKERS = 16
+
+# BigQuery accepts at most 10 000 source URIs per load job
+MAX_SOURCE_URIS = 10000
+
+
+def batching_enabled() -> bool:
+    return os.environ.get('load_batch_max_files') not in [None, '']
+
+
+def _max_files() -> int:
+    return min(int(os.environ['load_batch_max_files']), MAX_SOURCE_URIS)
+
+
+def _max_bytes() -> int:
+    return int(os.environ.get('load_batch_max_bytes', DEFAULT_MAX_BYTES))
+
+
+def _max_age() -> float:
+    return float(os.environ.get('load_batch_max_age', DEFAULT_MAX_AGE))
+
+
+def _flush_timeout() -> float:
+    return float(os.environ.get('load_batch_flush_timeout', DEFAULT_FLUSH_TIMEOUT))
+
+
+def _path(table_name: str, extension: str) -> str:
+    return f'{BATCHES_PREFIX}{table_name}.{extension.lower()}.json'
+
+
+def _new_document(table_name: str, extension: str, bucket_name: str) -> dict:
+    return {
+        'table_name': table_name,
+        'extension': extension.lower(),
+        'bucket_name': bucket_name,
+        'blobs': [],
+        'opened_at': None,
+        'flushing': None,
+    }
+
+
+def _is_full(document: dict, now: float) -> bool:
+    if not document['blobs']:
+        return False
+    return (
+        len(document['blobs']) >= _max_files()
+        or sum(blob['size'] for blob in document['blobs']) >= _max_bytes()
+        or now - document['opened_at'] >= _max_age()
+    )
+
+
+def _same_blob(blob: dict, blob_path: str, generation: int) -> bool:
+    return blob['blob_path'] == blob_path and blob.get('generation') == generation
+
+
+def add_blob(table_name: str, bucket_name: str, blob_path: str, size: int, load, move, on_loaded,
+             file_date: str = None, generation: int = None, md5_hash: str = None, crc32c: str = None,
+             now: float = None) -> bool:
+    """
+    Add a file to the batch of its table and flush the batch if it is full.
+
+    Args:
+         table_name (str): BigQuery raw table name.
+         bucket_name (str): Bucket name of the file.
+         blob_path (str): Path of the blob inside the bucket.
+         size (int): Size of the blob in bytes.
+         load (callable): `load(table_name, source_uris, extension,
+                          file_dates)` loads the files, `file_dates` being
+                          the date of each file.
+         move (callable): `move(bucket_name, blob_paths, subfolder,
+                          generations)` moves the files of a batch.
+         on_loaded (callable): `on_loaded(table_name)` once a batch is loaded.
+         file_date (str): YYYYMMDD date of the file, if the table is
+                          partitioned on the file date.
+         generation (int): Generation of the file.
+         md5_hash, crc32c (str): Hashes of the file, recorded in the content
+                                 index once loaded (see `content_index`).
+         now (float): Current timestamp, for tests.
+
+    Returns:
+         bool: True if the batch was flushed by this call.
+    """
+    now = now if now is not None else time.time()
+    # the gzipped and plain files of a format go in the same load job
+    _, extension, _ = tables.split_file_name(blob_path.rsplit('/', 1)[-1])
+
+    def append(document):
+        document = document or _new_document(table_name, extension, bucket_name)
+        flushing_blobs = document['flushing']['blobs'] if document['flushing'] is not None else []
+        if any(_same_blob(blob, blob_path, generation) for blob in document['blobs'] + flushing_blobs):
+            # redelivered message
+            return None
+        if not document['blobs']:
+            document['opened_at'] = now
+        document['blobs'].append({'blob_path': blob_path, 'size': size, 'file_date': file_date,
+                                  'generation': generation, 'added_at': now, 'md5_hash': md5_hash, 'crc32c': crc32c})
+        return document
+
+    path = _path(table_name, extension)
+    document = state_store.update_document(path, append)
+    print(f"     {path} batch: {len(document['blobs'])} file(s)")
+
+    if _is_full(document, now):
+        return flush(table_name, extension, load, move, on_loaded, now=now)
+    return False
+
+
+def _present_blobs(bucket_name: str, blobs: list) -> list:
+    """
+    The files of a batch still in the bucket with the generation they were
+    added with.
+    """
+    bucket = clients.storage_client().bucket(bucket_name)
+
+    def present(blob):
+        instrumentation.count_call(instrumentation.GCS)
+        current = bucket.get_blob(blob['blob_path'])
+        return current is not None and blob.get('generation') in [None, current.generation]
+
+    workers = min(int(os.environ.get('move_workers', DEFAULT_CHECK_WORKERS)), len(blobs)) or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # each worker counts its calls in the current invocation
+        checks = list(pool.map(lambda blob: contextvars.copy_context().run(present, blob), blobs))
+    for blob, check in zip(blobs, checks):
+        if not check:
+            print(f"[WARNING] {blob['blob_path']} (génération {blob.get('generation')}) n'est plus dans le bucket, "
+                  f"retiré du batch")
+    return [blob for blob, check in zip(blobs, checks) if check]
+
+
+def flush(table_name: str, extension: str, load, move, on_loaded, now: float = None) -> bool:
+    """
+    Load the files of a batch with one load job and archive or reject them.
+
+    Args:
+         table_name (str): BigQuery raw table name.
+         extension (str): Extension of the files of the batch.
+         load, move, on_loaded (callable): See `add_blob`.
+         now (float): Current timestamp, for tests.
+
+    Returns:
+         bool: True if a batch was loaded (or rejected).
+    """
+    now = now if now is not None else time.time()
+    path = _path(table_name, extension)
+    claimed = []
+
+    def claim(document):
+        if document is None:
+            return None
+        flushing = document['flushing']
+        if flushing is not None and now - flushing['started_at'] < _flush_timeout():
+            # someone else is loading it
+            return None
+        if flushing is None:
+            if not document['blobs']:
+                return None
+            flushing = {'blobs': document['blobs'][:_max_files()], 'started_at': now}
+            document['blobs'] = document['blobs'][_max_files():]
+            document['opened_at'] = now if document['blobs'] else None
+        else:
+            print(f'[WARNING] Reprise du batch {path} commencé à {flushing["started_at"]}')
+            flushing['started_at'] = now
+        document['flushing'] = flushing
+        claimed[:] = [document['bucket_name'], flushing['blobs']]
+        return document
+
+    state_store.update_document(path, claim)
+    if not claimed:
+        return False
+    bucket_name, blobs = claimed
+    blobs = _present_blobs(bucket_name, blobs)
+
+    destination = None
+    if blobs:
+        destination = _load_blobs(table_name, extension, bucket_name, blobs, path, load, move)
+
+    def done(document):
+        if not document['blobs']:
+            # so the listing of `flush_due_batches` only sees the open batches
+            return state_store.DELETE
+        document['flushing'] = None
+        return document
+
+    document = state_store.update_document(path, done)
+
+    if destination == 'archive':
+        on_loaded(table_name)
+
+    # the files added meanwhile may already make a full batch
+    if document is not None and _is_full(document, now):
+        flush(table_name, extension, load, move, on_loaded, now=now)
+    return True
+
+
+def _load_blobs(table_name: str, extension: str, bucket_name: str, blobs: list, path: str, load, move) -> str:
+    """
+    Load the files of a claimed batch and archive or reject them.
+
+    Returns:
+         str: 'archive' if the batch was loaded, else 'reject'.
+    """
+    source_uris = [f"gs://{bucket_name}/{blob['blob_path']}" for blob in blobs]
+    file_dates = [blob['file_date'] for blob in blobs]
+    print(f'     flush {path}: {len(source_uris)} file(s), {sum(blob["size"] for blob in blobs)} bytes, '
+          f'dates {sorted(set(file_dates) - {None})}')
+    try:
+        load(table_name, source_uris, extension, file_dates)
+        destination = 'archive'
+        if content_index.index_enabled():
+            for blob, file_date in zip(blobs, file_dates):
+                content_index.record_loaded(table_name, blob['blob_path'], blob.get('md5_hash'), blob.get('crc32c'),
+                                            blob['size'], file_date)
+    except Exception as e:
+        print(e)
+        destination = 'reject'
+
+    move(bucket_name, [blob['blob_path'] for blob in blobs], destination, [blob.get('generation') for blob in blobs])
+    return destination
+
+
+def flush_due_batches(load, move, on_loaded, now: float = None) -> list:
+    """
+    Flush the batches which are full (mostly because of their age) or whose
+    flush was interrupted.
+
+    Args:
+         load, move, on_loaded (callable): See `add_blob`.
+         now (float): Current timestamp, for tests.
+
+    Returns:
+         list: The batches flushed as `<table>.<extension>`.
+    """
+    now = now if now is not None else time.time()
+    flushed = []
+    for path, document, _ in state_store.list_documents(BATCHES_PREFIX):
+        interrupted = document['flushing'] is not None and now - document['flushing']['started_at'] >= _flush_timeout()
+        if not (_is_full(document, now) or interrupted):
+            continue
+        if flush(document['table_name'], document['extension'], load, move, on_loaded, now=now):
+            flushed.append(path[len(BATCHES_PREFIX):-len('.json')])
+    return flushed
@@ -0,0 +1,268 @@
+"""
+Daily manifest: the files of a date loaded as one unit.
+
+By default each of `store_<date>.csv`, `customer_<date>.csv` and
+`basket_<date>.json` is loaded on arrival and triggers its own workflow, so
+the cleaned tables are rebuilt three times a day and can see a day half
+delivered. When `manifest_tables` is set (for example
+'store,customer,basket'), a file of one of these tables is instead recorded
+in the manifest of its date (`state/manifests/<YYYYMMDD>.json`), the date of
+the file name checked by the trigger (`verifier_nom_fichier`). The manifest
+is committed once:
+    - a file of every table of `manifest_tables` arrived, or
+    - `manifest_deadline` seconds passed since its first file (the manifests
+      which do not complete are committed by `commit_due_manifests`, called
+      on a schedule by the `track_executions` entry point; the missing tables
+      are reported).
+
+The commit loads the files of the manifest together, one load in parallel
+per file (each replaces the partition of its date), archives the files loaded
+(recorded in the content index, see `content_index`) and rejects the others,
+then triggers one workflow execution refreshing the cleaned tables of all the
+tables loaded. With `wkf_coalesce_window`, each table loaded asks for its
+refresh through the per-table coalescing instead (see `trigger_scheduler`),
+so a manifest never runs a refresh of a table beside the one of its lease.
+
+BigQuery has no transaction across load jobs: a file which fails is rejected
+and the others are still loaded and refreshed, as without the manifest.
+
+A manifest being committed is kept in its `committing` part until it is done,
+so it is committed by only one instance and, if that instance dies,
+committed again after `manifest_commit_timeout` seconds. Its document is
+then deleted, unless files of the date arrived meanwhile: a file of a date
+already committed opens a new manifest for the date.
+"""
+import contextvars
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from common import content_index
+from common import state_store
+
+MANIFESTS_PREFIX = 'manifests/'
+
+DEFAULT_DEADLINE = 3600
+DEFAULT_COMMIT_TIMEOUT = 900
+
+
+def manifest_enabled() -> bool:
+    return os.environ.get('manifest_tables') not in [None, '']
+
+
+def manifest_tables() -> list:
+    return [table_name.strip() for table_name in os.environ.get('manifest_tables', '').split(',') if table_name.strip()]
+
+
+def in_manifest(table_name: str) -> bool:
+    """
+    True if the files of the table wait for the manifest of their date.
+    """
+    return manifest_enabled() and table_name in manifest_tables()
+
+
+def _deadline() -> float:
+    return float(os.environ.get('manifest_deadline', DEFAULT_DEADLINE))
+
+
+def _commit_timeout() -> float:
+    return float(os.environ.get('manifest_commit_timeout', DEFAULT_COMMIT_TIMEOUT))
+
+
+def _path(file_date: str) -> str:
+    return f'{MANIFESTS_PREFIX}{file_date}.json'
+
+
+def _new_document(file_date: str) -> dict:
+    return {
+        'file_date': file_date,
+        'files': {},
+        'opened_at': None,
+        'committing': None,
+        'commits': 0,
+    }
+
+
+def _missing_tables(document: dict) -> list:
+    return [table_name for table_name in manifest_tables() if table_name not in document['files']]
+
+
+def _is_due(document: dict, now: float) -> bool:
+    if not document['files']:
+        return False
+    return not _missing_tables(document) or now - document['opened_at'] >= _deadline()
+
+
+def add_file(table_name: str, file_date: str, bucket_name: str, blob_path: str, size: int, load, move, on_committed,
+             generation: int = None, md5_hash: str = None, crc32c: str = None, now: float = None) -> bool:
+    """
+    Record a file in the manifest of its date and commit the manifest if it
+    is complete.
+
+    Args:
+         table_name (str): BigQuery raw table name.
+         file_date (str): YYYYMMDD date of the file name.
+         bucket_name (str): Bucket name of the file.
+         blob_path (str): Path of the blob inside the bucket.
+         size (int): Size of the blob in bytes.
+         load (callable): `load(table_name, bucket_name, blob_path, file_date,
+                          size)` loads one file.
+         move (callable): `move(bucket_name, blob_path, subfolder, generation)`
+                          moves one file.
+         on_committed (callable): `on_committed(file_date, table_names)` with
+                                  the tables loaded by a commit.
+         generation (int): Generation of the file.
+         md5_hash, crc32c (str): Hashes of the file, for the content index.
+         now (float): Current timestamp, for tests.
+
+    Returns:
+         bool: True if the manifest was committed by this call.
+    """
+    now = now if now is not None else time.time()
+
+    def record(document):
+        document = document or _new_document(file_date)
+        entry = {'bucket_name': bucket_name, 'blob_path': blob_path, 'size': size, 'generation': generation,
+                 'md5_hash': md5_hash, 'crc32c': crc32c, 'added_at': now}
+        previous = document['files'].get(table_name)
+        if previous is not None and previous['blob_path'] == blob_path and previous['generation'] == generation:
+            # redelivered message
+            return None
+        if previous is not None:
+            print(f"[WARNING] {previous['blob_path']} remplacé par {blob_path} dans le manifeste du {file_date}")
+        if not document['files']:
+            document['opened_at'] = now
+        document['files'][table_name] = entry
+        return document
+
+    path = _path(file_date)
+    document = state_store.update_document(path, record)
+    missing = _missing_tables(document)
+    print(f"     {path}: {sorted(document['files'])} arrivés, en attente de {missing}")
+
+    if _is_due(document, now):
+        return commit(file_date, load, move, on_committed, now=now)
+    return False
+
+
+def _load_file(table_name: str, file_date: str, entry: dict, load) -> str:
+    """
+    Load one file of a manifest.
+
+    Returns:
+         str: 'archive' if the file was loaded, else 'reject'.
+    """
+    try:
+        load(table_name, entry['bucket_name'], entry['blob_path'], file_date, entry['size'])
+        if content_index.index_enabled():
+            content_index.record_loaded(table_name, entry['blob_path'], entry.get('md5_hash'), entry.get('crc32c'),
+                                        entry['size'], file_date)
+        return 'archive'
+    except Exception as e:
+        print(e)
+        return 'reject'
+
+
+def commit(file_date: str, load, move, on_committed, now: float = None) -> bool:
+    """
+    Load the files of a manifest together, archive or reject them, then
+    refresh the cleaned tables once.
+
+    Args:
+         file_date (str): YYYYMMDD date of the manifest.
+         load, move, on_committed (callable): See `add_file`.
+         now (float): Current timestamp, for tests.
+
+    Returns:
+         bool: True if files were committed.
+    """
+    now = now if now is not None else time.time()
+    path = _path(file_date)
+    claimed = []
+
+    def claim(document):
+        if document is None:
+            return None
+        committing = document['committing']
+        if committing is not None and now - committing['started_at'] < _commit_timeout():
+            # someone else is committing it
+            return None
+        if committing is None:
+            if not document['files']:
+                return None
+            committing = {'files': document['files'], 'started_at': now}
+            document['files'] = {}
+            document['opened_at'] = None
+        else:
+            print(f'[WARNING] Reprise du manifeste {path} commencé à {committing["started_at"]}')
+            committing['started_at'] = now
+        document['committing'] = committing
+        claimed[:] = [committing['files']]
+        return document
+
+    state_store.update_document(path, claim)
+    if not claimed:
+        return False
+    files = claimed[0]
+
+    missing = [table_name for table_name in manifest_tables() if table_name not in files]
+    if missing:
+        print(f'[WARNING] Manifeste du {file_date} commité sans {missing} (délai dépassé)')
+    print(f'     commit {path}: {sorted(files)}')
+
+    # the loads run together, each worker counts its calls in the current invocation
+    table_names = [table_name for table_name in manifest_tables() if table_name in files] \
+        + sorted(table_name for table_name in files if table_name not in manifest_tables())
+    with ThreadPoolExecutor(max_workers=len(table_names)) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, _load_file, table_name, file_date, files[table_name], load)
+                   for table_name in table_names]
+        destinations = [future.result() for future in futures]
+
+    loaded = []
+    for table_name, destination in zip(table_names, destinations):
+        entry = files[table_name]
+        move(entry['bucket_name'], entry['blob_path'], destination, entry['generation'])
+        if destination == 'archive':
+            loaded.append(table_name)
+
+    def done(document):
+        if not document['files']:
+            return state_store.DELETE
+        document['committing'] = None
+        document['commits'] += 1
+        return document
+
+    document = state_store.update_document(path, done)
+
+    if loaded:
+        on_committed(file_date, loaded)
+
+    # the files of the date received meanwhile may already make a complete manifest
+    if document is not None and _is_due(document, now):
+        commit(file_date, load, move, on_committed, now=now)
+    return True
+
+
+def commit_due_manifests(load, move, on_committed, now: float = None) -> list:
+    """
+    Commit the manifests whose deadline passed or whose commit was
+    interrupted.
+
+    Args:
+         load, move, on_committed (callable): See `add_file`.
+         now (float): Current timestamp, for tests.
+
+    Returns:
+         list: The dates of the manifests committed.
+    """
+    now = now if now is not None else time.time()
+    committed = []
+    for _, document, _ in state_store.list_documents(MANIFESTS_PREFIX):
+        interrupted = (document['committing'] is not None
+                       and now - document['committing']['started_at'] >= _commit_timeout())
+        if not (_is_due(document, now) or interrupted):
+            continue
+        if commit(document['file_date'], load, move, on_committed, now=now):
+            committed.append(document['file_date'])
+    return committed
@@ -0,0 +1,219 @@
+"""
+Ledger of the Cloud Workflows executions triggered by the dispatcher.
+
+In the `async` wait mode, `trigger_worflow` returns as soon as the execution
+is created and records it here instead of polling it. The `track_executions`
+entry point then runs on a schedule and, in one pass, checks the state of
+every execution that is due:
+    - the executions are grouped by workflow and their states are read with
+      one `list_executions` call per workflow (newest first, FULL view so the
+      result or error comes with the state) instead of one `get_execution`
+      call per execution;
+    - an execution still running is checked again later, with an interval
+      doubling from `wkf_track_initial_interval` up to `wkf_track_max_interval`
+      seconds;
+    - an execution still running after `wkf_track_deadline` seconds is
+      reported as late (once);
+    - a finished execution is moved from `executions/pending/` to
+      `executions/finished/<YYYYMMDD>/` with its final state, and reported
+      if it did not succeed;
+    - an execution which no longer exists (past the retention of Cloud
+      Workflows) is finished with the `NOT_FOUND` state and reported; one
+      which cannot be read is checked again at the next pass, without
+      holding up the others.
+"""
+import os
+import time
+
+from datetime import datetime, timezone
+
+from common import clients
+from common import instrumentation
+from common import state_store
+
+PENDING_PREFIX = 'executions/pending/'
+FINISHED_PREFIX = 'executions/finished/'
+
+DEFAULT_INITIAL_INTERVAL = 10
+DEFAULT_MAX_INTERVAL = 300
+DEFAULT_DEADLINE = 1800
+
+# a few pages are enough: the pending executions are the most recent ones
+MAX_LIST_PAGES = 10
+LIST_PAGE_SIZE = 100
+
+TERMINAL_STATES = ['SUCCEEDED', 'FAILED', 'CANCELLED']
+NOT_FOUND = 'NOT_FOUND'
+
+
+def _setting(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+def _document_path(execution_name: str) -> str:
+    # projects/<p>/locations/<l>/workflows/<w>/executions/<id> -> <w>/<id>
+    parts = execution_name.split('/')
+    return f'{parts[5]}/{parts[7]}.json'
+
+
+def record_execution(table_name: str, execution_name: str, arguments: str = '{}'):
+    """
+    Record a newly created execution so it is tracked.
+
+    Args:
+         table_name (str): Table which triggered the workflow.
+         execution_name (str): Full resource name of the execution.
+         arguments (str): JSON arguments of the execution.
+    """
+    now = time.time()
+    initial_interval = _setting('wkf_track_initial_interval', DEFAULT_INITIAL_INTERVAL)
+    document = {
+        'execution_name': execution_name,
+        'workflow': execution_name.rsplit('/executions/', 1)[0],
+        'table_name': table_name,
+        'arguments': arguments,
+        'state': 'ACTIVE',
+        'created_at': now,
+        'deadline_at': now + _setting('wkf_track_deadline', DEFAULT_DEADLINE),
+        'check_interval': initial_interval,
+        'next_check_at': now + initial_interval,
+        'checks': 0,
+        'late_reported': False,
+    }
+    state_store.write_document(PENDING_PREFIX + _document_path(execution_name), document, generation=0)
+    print(f'[INFO] Exécution suivie dans le registre : {execution_name}')
+
+
+def _list_states(workflow: str, execution_names: set, oldest_created_at: float) -> dict:
+    """
+    Read the states of some executions of a workflow with as few calls as
+    possible.
+
+    Returns:
+         dict: {execution name: Execution} for the executions read, None for
+               the ones which no longer exist.
+    """
+    from google.api_core.exceptions import GoogleAPICallError, NotFound, RetryError
+    from google.cloud.workflows.executions_v1.types import ExecutionView
+
+    client = clients.executions_client()
+    found = {}
+    # the default BASIC view leaves out the result and the error of the executions
+    pages = client.list_executions(request={'parent': workflow, 'page_size': LIST_PAGE_SIZE,
+                                            'view': ExecutionView.FULL}).pages
+    for page_number, page in enumerate(pages):
+        instrumentation.count_call(instrumentation.WORKFLOWS)
+        for execution in page.executions:
+            if execution.name in execution_names:
+                found[execution.name] = execution
+        if len(found) == len(execution_names) or page_number + 1 >= MAX_LIST_PAGES:
+            break
+        # the executions are listed newest first: stop once we are older than all of ours
+        if page.executions and page.executions[-1].start_time.timestamp() < oldest_created_at - 60:
+            break
+
+    # the ones not found in the listed pages are read one by one
+    for execution_name in execution_names - set(found):
+        instrumentation.count_call(instrumentation.WORKFLOWS)
+        try:
+            found[execution_name] = client.get_execution(request={'name': execution_name})
+        except NotFound:
+            found[execution_name] = None
+        except (GoogleAPICallError, RetryError) as e:
+            print(f'[ERROR] Impossible de lire l\'exécution {execution_name} : {e}')
+    return found
+
+
+def _report(document: dict, level: str, message: str):
+    print(f"[{level}] {message} | table: {document['table_name']} | "
+          f"execution: {document['execution_name']} | "
+          f"created at: {_iso(document['created_at'])}")
+
+
+def check_executions(on_finished=None, now: float = None) -> dict:
+    """
+    Check, in one pass, every pending execution which is due.
+
+    Args:
+         on_finished (callable): Called with the document of each execution
+                                 found finished.
+         now (float): Current timestamp, for tests.
+
+    Returns:
+         dict: Number of executions per outcome of the pass.
+    """
+    from google.api_core.exceptions import GoogleAPICallError, RetryError
+
+    now = now if now is not None else time.time()
+    max_interval = _setting('wkf_track_max_interval', DEFAULT_MAX_INTERVAL)
+    summary = {'due': 0, 'active': 0, 'late': 0, 'succeeded': 0, 'failed': 0, 'not_found': 0, 'errors': 0}
+
+    # group the due executions by workflow
+    due = {}
+    for path, document, generation in state_store.list_documents(PENDING_PREFIX):
+        if document['next_check_at'] <= now:
+            due.setdefault(document['workflow'], []).append((path, document, generation))
+            summary['due'] += 1
+
+    for workflow, entries in due.items():
+        try:
+            executions = _list_states(
+                workflow,
+                {document['execution_name'] for _, document, _ in entries},
+                min(document['created_at'] for _, document, _ in entries),
+            )
+        except (GoogleAPICallError, RetryError) as e:
+            print(f'[ERROR] Impossible de vérifier les exécutions de {workflow} : {e}')
+            summary['errors'] += len(entries)
+            continue
+
+        for path, document, generation in entries:
+            if document['execution_name'] not in executions:
+                # not read, checked again at the next pass
+                summary['errors'] += 1
+                continue
+            execution = executions[document['execution_name']]
+            state = execution.state.name if execution is not None else NOT_FOUND
+            document['state'] = state
+            document['checks'] += 1
+            document['checked_at'] = now
+
+            try:
+                if state in TERMINAL_STATES + [NOT_FOUND]:
+                    document['finished_at'] = now
+                    if state == NOT_FOUND:
+                        _report(document, 'WARNING', "Exécution introuvable (durée de rétention dépassée ?), "
+                                                     "retirée du registre")
+                        summary['not_found'] += 1
+                    elif state == 'SUCCEEDED':
+                        document['result'] = execution.result
+                        summary['succeeded'] += 1
+                    else:
+                        document['error'] = str(execution.error)
+                        _report(document, 'ERROR', f'Exécution terminée avec le statut {state} : {execution.error}')
+                        summary['failed'] += 1
+                    finished_day = datetime.fromtimestamp(now, tz=timezone.utc).strftime('%Y%m%d')
+                    finished_path = f"{FINISHED_PREFIX}{finished_day}/{path[len(PENDING_PREFIX):]}"
+                    state_store.write_document(finished_path, document)
+                    state_store.delete_document(path, generation)
+                    if on_finished is not None:
+                        on_finished(document)
+                else:
+                    if now > document['deadline_at'] and not document['late_reported']:
+                        _report(document, 'WARNING', f"Exécution toujours {state} après {int(now - document['created_at'])} s")
+                        document['late_reported'] = True
+                        summary['late'] += 1
+                    # adaptive backoff: long executions are checked less and less often
+                    document['check_interval'] = min(document['check_interval'] * 2, max_interval)
+                    document['next_check_at'] = now + document['check_interval']
+                    state_store.write_document(path, document, generation)
+                    summary['active'] += 1
+            except state_store.StateConflict as e:
+                # another tracker pass handled it in the meantime
+                print(f'[INFO] {e}')
+
+    return summary
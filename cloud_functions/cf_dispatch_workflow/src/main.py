@@ -1,18 +1,42 @@
 import os
+import sys
 import time
 import json
+import uuid
 import base64
 
 from datetime import datetime
-from google.cloud import storage
-from google.cloud import bigquery
 
-from google.cloud.workflows.executions_v1 import ExecutionsClient
-from google.cloud.workflows.executions_v1.types import Execution
-from google.api_core.exceptions import GoogleAPICallError, RetryError
-import time
+# The GCP SDKs are imported inside the functions that use them: importing them
+# is most of the cold start of the function and some events never need them.
+
+# `common/` is copied next to this file in the deployment bundle (see filter_dir.sh).
+# When the function is run from the repository, it is found in `cloud_functions/`.
+if not os.path.isdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'common')):
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from common import clients
+from common import content_index
+from common import tables
+from common import instrumentation
+from common import mover
+from common import profiling
+from common.instrumentation import span, count_call
+
+import async_dispatcher
+import execution_ledger
+import trigger_scheduler
+import batch_loader
+import daily_manifest
+import parquet_stager
+import quarantine
+import stream_writer
 
+DEFAULT_WORKFLOW_ID = 'cleaned_wkf'
 
+
+@profiling.profiled
+@instrumentation.instrumented
 def receive_messages(event: dict, context: dict):
     """
     Triggered from a message on a Cloud Pub/Sub topic.
@@ -25,13 +49,8 @@ def receive_messages(event: dict, context: dict):
          context (google.cloud.functions.Context): Metadata for the event.
     """
 
-    print(f'     ***************                 Start  Receive message   : {datetime.now().strftime("%H:%M:%S.%f")[:-4]}')
-
-    # rename the variable to be more specific and write it to the logs
+    # rename the variable to be more specific
     pubsub_event = event
-    print(f' pubsub_event : {pubsub_event}')
-    pubsub_event_data = pubsub_event['data']
-    print(type(pubsub_event_data))
     
     # decode the data giving the targeted table name
     table_name = base64.b64decode(pubsub_event['data']).decode('utf-8')
@@ -39,25 +58,70 @@ def receive_messages(event: dict, context: dict):
     # get the blob infos from the attributes
     bucket_name = pubsub_event['attributes']['bucket_name']
     blob_path = pubsub_event['attributes']['blob_path']
+    # date of the file name, the partition of the raw table to write
+    file_date = pubsub_event['attributes'].get('file_date')
+    instrumentation.set_attribute('table_name', table_name)
+    instrumentation.set_attribute('blob_path', blob_path)
     
-    #     - connect to the Cloud Storage client
-    storage_client = storage.Client()
+    #     - get the shared Cloud Storage client
+    storage_client = clients.storage_client()
     bucket = storage_client.bucket(bucket_name)
-    leblob = bucket.blob(blob_path)
+    count_call(instrumentation.GCS)
+    leblob = bucket.get_blob(blob_path)
 
     load_completed = True
 
-    if leblob.exists():
+    if leblob is not None and content_index.index_enabled() and not content_index.forced(pubsub_event['attributes']):
+        with span('dedup'):
+            loaded = content_index.find_loaded(table_name, leblob.md5_hash, leblob.crc32c, leblob.size, file_date)
+        if (loaded is not None and file_date and loaded.get('file_date') not in [None, file_date]
+                and tables.table_spec(table_name)['partitioning'] and not daily_manifest.in_manifest(table_name)):
+            # unchanged snapshot of another date: its partition is a copy of the one loaded, same cleaned tables
+            # (a table of the daily manifest loads it with the other files of its date)
+            with span('copy_partition'):
+                copy_partition(table_name, loaded['file_date'], file_date)
+            content_index.record_loaded(table_name, blob_path, leblob.md5_hash, leblob.crc32c, leblob.size, file_date)
+            move_file(bucket_name, blob_path, 'archive', leblob.generation)
+            instrumentation.add_metric('partitions_copied', 1)
+            return
+        if loaded is not None and loaded.get('file_date') in [None, file_date]:
+            # redelivered message or same day uploaded again: nothing new for the tables
+            print(f"{blob_path}: contenu identique à {loaded['blob_path']}, déjà chargé, archivé sans chargement")
+            move_file(bucket_name, blob_path, 'archive', leblob.generation)
+            instrumentation.add_metric('duplicates_skipped', 1)
+            return
+
+    if leblob is not None and file_date and daily_manifest.in_manifest(table_name):
+        # the file waits for the other tables of its date, the workflow is
+        # requested once for all of them when the manifest is committed
+        load_completed = False
+        daily_manifest.add_file(table_name, file_date, bucket_name, blob_path, leblob.size,
+                                load=insert_into_raw, move=move_file, on_committed=request_manifest_workflow,
+                                generation=leblob.generation, md5_hash=leblob.md5_hash, crc32c=leblob.crc32c)
+
+    elif leblob is not None and batch_loader.batching_enabled():
+        # the file joins the batch of its table, the workflow is requested
+        # once the batch is loaded
+        load_completed = False
+        batch_loader.add_blob(table_name, bucket_name, blob_path, leblob.size,
+                              load=load_batch, move=move_files, on_loaded=request_workflow,
+                              file_date=file_date if tables.table_spec(table_name)['partitioning'] else None,
+                              generation=leblob.generation, md5_hash=leblob.md5_hash, crc32c=leblob.crc32c)
+
+    elif leblob is not None:
         load_completed = False
         try:
             # insert the data into the raw table then archive the file
-            insert_into_raw(table_name, bucket_name, blob_path)
-            move_file(bucket_name, blob_path, 'archive')
+            insert_into_raw(table_name, bucket_name, blob_path, file_date, leblob.size)
+            # indexed before the move, so a redelivered message finds it
+            if content_index.index_enabled():
+                content_index.record_loaded(table_name, blob_path, leblob.md5_hash, leblob.crc32c, leblob.size, file_date)
+            move_file(bucket_name, blob_path, 'archive', leblob.generation)
             load_completed = True
             
         except Exception as e:
             print(e)
-            move_file(bucket_name, blob_path, 'reject')
+            move_file(bucket_name, blob_path, 'reject', leblob.generation)
         
     else:
         print(f'{blob_path} inexistant dans  in {bucket_name} ')
@@ -65,94 +129,354 @@ def receive_messages(event: dict, context: dict):
     # trigger the pipeline if the load is completed 
     # même si pas de fichier pour vider la table 
     if load_completed:
-        trigger_worflow(table_name)
+        request_workflow(table_name)
+
+def receive_push(request):
+    """
+    Triggered by an HTTP request of a Pub/Sub push subscription.
+    Handles the message like `receive_messages`, together with the other
+    requests sent to the instance (see `async_dispatcher`).
+
+    Args:
+         request (flask.Request): The push request.
 
-    print(f'     ***************                 End  Receive message   : {datetime.now().strftime("%H:%M:%S.%f")[:-4]}')        
+    Returns:
+         tuple: Body and HTTP status, 204 once the message is handled.
+    """
+    try:
+        event = async_dispatcher.push_event(request.get_json(silent=True))
+    except ValueError as e:
+        print(f'[ERROR] {e}')
+        return str(e), 400
+    try:
+        async_dispatcher.dispatcher(receive_messages).submit(event).result()
+    except Exception as e:
+        # not acknowledged: Pub/Sub delivers the message again
+        print(f'[ERROR] {e!r}')
+        return repr(e), 500
+    return '', 204
 
-def insert_into_raw(table_name: str, bucket_name: str, blob_path: str):
+def insert_into_raw(table_name: str, bucket_name: str, blob_path: str, file_date: str = None, size: int = None):
     """
-    Insert a file into the correct BigQuery raw table.
+    Insert a file into the correct BigQuery raw table. A file of at most
+    `stream_max_bytes` bytes is appended through the Storage Write API (see
+    `stream_writer`), the others are loaded with a load job. With
+    `quarantine_max_bad_rows`, the bad rows are set aside first (see
+    `quarantine`).
     
     Args:
          table_name (str): BigQuery raw table name.
          bucket_name (str): Bucket name of the file.
          blob_path (str): Path of the blob inside the bucket.
+         file_date (str): YYYYMMDD date of the file name.
+         size (int): Size of the file in bytes.
+    """
+    report = None
+    if quarantine.quarantine_enabled():
+        with span('quarantine'):
+            report = quarantine.split_rows(table_name, bucket_name, blob_path)
+
+    #     - store in a string variable the blob uri path of the data to load (gs://your-bucket/your/path/to/data)
+    #       (the caller already checked that the blob exists)
+    blob_uri_path = f'gs://{bucket_name}/{blob_path}'
+    #gs://vast-verve-469412-c5_magasin_cie_landing/input\store_20220531.csv[.gz]
+    # a gzipped file is loaded as it is, BigQuery decompresses it
+    _, extension, _ = tables.split_file_name(blob_path.rsplit('/', 1)[-1])
+
+    if report is not None and report.bad_rows:
+        # only the good rows are loaded, so BigQuery fails on a bad row instead of skipping it
+        with span('quarantine'):
+            good_rows_uri = quarantine.write_good_rows(table_name, bucket_name, blob_path, report)
+        try:
+            load_job = load_into_raw(table_name, [good_rows_uri], extension, file_date)
+        finally:
+            quarantine.delete_good_rows(good_rows_uri)
+        quarantine.write_sidecar(table_name, bucket_name, blob_path, report, load_job.output_rows)
+        return
+
+    if stream_writer.should_stream(size):
+        if stream_writer.append_file(table_name, bucket_name, blob_path, file_date) is not None:
+            return
+
+    load_files(table_name, [blob_uri_path], extension, file_date)
+
+def load_files(table_name: str, source_uris: list, extension: str, file_date: str = None):
+    """
+    Load files into the raw table, through a Parquet conversion when
+    `parquet_staging_prefix` is set (see `parquet_stager`).
+
+    Args:
+         table_name (str): BigQuery raw table name.
+         source_uris (list): gs:// URIs of the files to load.
+         extension (str): Extension of the files (csv or json).
+         file_date (str): YYYYMMDD date of the files, all the same.
+    """
+    if not parquet_stager.staging_enabled():
+        return load_into_raw(table_name, source_uris, extension, file_date)
+
+    staged_uris = []
+    try:
+        with span('convert'):
+            staged_uris = parquet_stager.stage_files(table_name, source_uris)
+        return load_into_raw(table_name, staged_uris, 'parquet', file_date)
+    finally:
+        parquet_stager.delete_staged(staged_uris)
+
+def load_batch(table_name: str, source_uris: list, extension: str, file_dates: list):
+    """
+    Load the files of a batch (see `batch_loader`): with one load job if they
+    are all of the same date (or the table is not partitioned on the file
+    date), else into the partitions of their dates at once (see
+    `load_into_partitions`).
+
+    Args:
+         table_name (str): BigQuery raw table name.
+         source_uris (list): gs:// URIs of the files to load.
+         extension (str): Extension of the files (csv or json).
+         file_dates (list): YYYYMMDD date of each file, None if the table is
+                            not partitioned on the file date.
+    """
+    dates = sorted(set(file_dates) - {None})
+    if len(dates) <= 1:
+        return load_files(table_name, source_uris, extension, dates[0] if dates else None)
+
+    staged_uris = []
+    try:
+        if parquet_stager.staging_enabled():
+            with span('convert'):
+                # in the same order, each Parquet file keeps the date of its file
+                staged_uris = parquet_stager.stage_files(table_name, source_uris)
+            source_uris, extension = staged_uris, 'parquet'
+        return load_into_partitions(table_name, source_uris, extension, file_dates)
+    finally:
+        parquet_stager.delete_staged(staged_uris)
+
+def load_into_partitions(table_name: str, source_uris: list, extension: str, file_dates: list):
     """
+    Load files of several dates into the partitions of their dates at once.
 
-    print(f'     ***************              Start  insert_into_raw   : {datetime.now().strftime("%H:%M:%S.%f")[:-4]}')
+    A load job writes a single partition, so the files are instead read as a
+    temporary external table by one query which copies them, with the name of
+    the file of each row (`_FILE_NAME`), into a staging table. One script
+    then replaces the partitions of the dates with the rows of their files,
+    in a transaction: the batch is loaded whole or not at all. The staging
+    table is deleted afterwards.
 
-    # TODO: 2
-    # You have to try to insert the file into the correct raw table using the python BigQuery Library. 
-    # Please, refer yourself to the documentation and StackOverflow is still your friend ;)
-    # As an help, you can follow those instructions:
-    #     - connect to the Cloud Storage client
-    storage_client = storage.Client()
+    Unlike a load job, the query is billed for the bytes of the files it
+    reads.
+
+    Args:
+         table_name (str): BigQuery raw table name.
+         source_uris (list): gs:// URIs of the files to load, gzipped or not.
+         extension (str): Extension of the files (csv, json or parquet),
+                          without the compression.
+         file_dates (list): YYYYMMDD date of each file.
+    """
+    from google.cloud import bigquery
 
-    #     - get the util bucket object using the os environments
     project = os.environ["GCP_PROJECT"]
-    util_bucket_suffix = os.environ['util_bucket_suffix']
-    if util_bucket_suffix is None:
-        raise ValueError("La variable d'environnement 'util_bucket_suffix' n'est pas définie.")
-    bucket_util_name = f'{project}_{util_bucket_suffix}'
-    bucket_util = storage_client.bucket(bucket_util_name)
-    
-    #     - loads the schema of the table as a json (dictionary) from the bucket    
-    blob_util = bucket_util.blob(f'raw_{table_name}_json')
-    raw_schema_json = json.loads(blob_util.download_as_string())
+    spec = tables.table_spec(table_name)
+    with span('schema_fetch'):
+        raw_schema_json = tables.raw_schema(table_name)
+    bigquery_client = clients.bigquery_client()
+    table_id = f"{project}.{spec['dataset']}.{spec['table']}"
+    staging_id = f"{table_id}_batch_{uuid.uuid4().hex[:12]}"
+
+    if extension.lower() == 'csv':
+        external_config = bigquery.ExternalConfig(bigquery.SourceFormat.CSV)
+        external_config.options.field_delimiter = spec['delimiter']
+        external_config.options.skip_leading_rows = spec['skip_leading_rows']
+    elif extension.lower() == 'json':
+        external_config = bigquery.ExternalConfig(bigquery.SourceFormat.NEWLINE_DELIMITED_JSON)
+    elif extension.lower() == 'parquet':
+        external_config = bigquery.ExternalConfig(bigquery.SourceFormat.PARQUET)
+        external_config.options.enable_list_inference = True
+    else:
+        raise NotImplementedError(f'Extension {extension} not supported')
+    if extension.lower() != 'parquet':
+        external_config.schema = [bigquery.SchemaField.from_api_repr(field) for field in raw_schema_json]
+    external_config.source_uris = source_uris
+
+    columns = ', '.join(field['name'] for field in raw_schema_json)
+    # the date of each file, as a parameter: the names of the files are not pasted into the SQL
+    batch_files = bigquery.ArrayQueryParameter('batch_files', 'STRUCT', [
+        bigquery.StructQueryParameter(
+            None,
+            bigquery.ScalarQueryParameter('uri', 'STRING', source_uri),
+            bigquery.ScalarQueryParameter('file_date', 'DATE', datetime.strptime(file_date, '%Y%m%d').date()),
+        )
+        for source_uri, file_date in zip(source_uris, file_dates)
+    ])
+    # the partitions of the dates are replaced by the rows of their files
+    script = f"""
+        BEGIN TRANSACTION;
+        DELETE FROM `{table_id}`
+        WHERE _PARTITIONDATE IN (SELECT batch_file.file_date FROM UNNEST(@batch_files) AS batch_file);
+        INSERT INTO `{table_id}` (_PARTITIONTIME, {columns})
+        SELECT TIMESTAMP(batch_file.file_date), {columns}
+        FROM `{staging_id}` JOIN UNNEST(@batch_files) AS batch_file ON batch_file.uri = _source_uri;
+        COMMIT TRANSACTION;
+    """
 
-    #     - store in a string variable the blob uri path of the data to load (gs://your-bucket/your/path/to/data)
-    blob_uri_path = f'gs://{bucket_name}/{blob_path}'
-    #gs://vast-verve-469412-c5_magasin_cie_landing/input\store_20220531.csv
-    bucket = storage_client.bucket(bucket_name)
-    leblob = bucket.blob(blob_path)
-    if leblob.exists():
-
-        #     - connect to the BigQuery Client
-        bigquery_client = bigquery.Client()  
-
-        #     - store in a string variable the table id with the bigquery client. (project_id.dataset_id.table_name)
-        table_id = f'{project}.raw.{table_name}'    
-
-        #     - create your LoadJobConfig object from the BigQuery librairy
-        #     - (maybe you will need more variables according to the type of the file - csv, json - so it can be good to see the documentation)
-
-        *_, extension = blob_path.split('.')
-        if extension.lower() == 'csv':
-            load_job_config = bigquery.LoadJobConfig(
-                schema=raw_schema_json,
-                source_format=bigquery.SourceFormat.CSV,
-                skip_leading_rows=1,
-            )
-
-        elif extension.lower() == 'json':
-            load_job_config = bigquery.LoadJobConfig(
-                schema=raw_schema_json,
-                source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-            )
-        else:
-            raise NotImplementedError(f'Extension {extension} not supported')
-
-        #run your loading job from the blob uri to the destination raw table
-        print(f'         load_table_from_uri  ')
+    # the raw table may not exist yet: created as the load job would
+    table = bigquery.Table(table_id, schema=[bigquery.SchemaField.from_api_repr(field) for field in raw_schema_json])
+    table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY)
+    table.clustering_fields = spec['clustering'] or None
+    count_call(instrumentation.BIGQUERY)
+    bigquery_client.create_table(table, exists_ok=True)
+
+    with span('load'):
+        count_call(instrumentation.BIGQUERY)
+        staging_job = bigquery_client.query(
+            f'SELECT {columns}, _FILE_NAME AS _source_uri FROM batch_files',
+            job_config=bigquery.QueryJobConfig(
+                table_definitions={'batch_files': external_config},
+                destination=staging_id,
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            ),
+        )
+        try:
+            count_call(instrumentation.BIGQUERY)
+            staged_rows = staging_job.result().total_rows
+            count_call(instrumentation.BIGQUERY, 2)
+            bigquery_client.query(script, job_config=bigquery.QueryJobConfig(query_parameters=[batch_files])).result()
+        finally:
+            count_call(instrumentation.BIGQUERY)
+            bigquery_client.delete_table(staging_id, not_found_ok=True)
+
+    instrumentation.add_metric('files_loaded', len(source_uris))
+    instrumentation.add_metric('bytes_loaded', staging_job.total_bytes_processed)
+    instrumentation.add_metric('rows_loaded', staged_rows)
+    print(f'{staged_rows} rows loaded from {len(source_uris)} file(s) into {len(set(file_dates))} partitions of {table_id}')
+    return staging_job
+
+def load_into_raw(table_name: str, source_uris: list, extension: str, file_date: str = None):
+    """
+    Load one or many files of the same format into the correct BigQuery raw
+    table with a single load job.
+
+    When the raw table is partitioned on the file date, the files replace the
+    partition of their date (`table$YYYYMMDD`), so reloading a day does not
+    duplicate it. Without a date, they are appended.
+
+    Args:
+         table_name (str): BigQuery raw table name.
+         source_uris (list): gs:// URIs of the files to load, gzipped or not.
+         extension (str): Extension of the files (csv, json or parquet),
+                          without the compression.
+         file_date (str): YYYYMMDD date of the files, all the same.
+
+    Returns:
+         google.cloud.bigquery.LoadJob: The finished load job.
+    """
+    from google.cloud import bigquery
+
+    project = os.environ["GCP_PROJECT"]
+
+    #     - get the specification and the raw schema of the table from the registry
+    spec = tables.table_spec(table_name)
+    with span('schema_fetch'):
+        raw_schema_json = tables.raw_schema(table_name)
+
+    #     - get the shared BigQuery Client
+    bigquery_client = clients.bigquery_client()
+
+    #     - store in a string variable the table id with the bigquery client. (project_id.dataset_id.table_name)
+    table_id = f"{project}.{spec['dataset']}.{spec['table']}"
+
+    #     - create your LoadJobConfig object from the BigQuery librairy
+    #     - (maybe you will need more variables according to the type of the file - csv, json - so it can be good to see the documentation)
+    if extension.lower() not in [spec['extension'], 'parquet']:
+        raise NotImplementedError(f"Extension {extension} not supported for {table_name} (expected {spec['extension']})")
+
+    load_options = {
+        'schema': raw_schema_json,
+        'write_disposition': bigquery.WriteDisposition.WRITE_APPEND,
+        'clustering_fields': spec['clustering'] or None,
+    }
+    if spec['partitioning'] == 'file_date':
+        # used if the load creates the table, must match the existing table else
+        load_options['time_partitioning'] = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY)
+        if file_date:
+            table_id = f'{table_id}${file_date}'
+            load_options['write_disposition'] = bigquery.WriteDisposition.WRITE_TRUNCATE
+
+    if extension.lower() == 'csv':
+        load_job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.CSV,
+            field_delimiter=spec['delimiter'],
+            skip_leading_rows=spec['skip_leading_rows'],
+            **load_options,
+        )
+
+    elif extension.lower() == 'json':
+        load_job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            **load_options,
+        )
+
+    elif extension.lower() == 'parquet':
+        # the Parquet files carry their typed schema, the lists are REPEATED fields
+        load_options.pop('schema')
+        parquet_options = bigquery.format_options.ParquetOptions()
+        parquet_options.enable_list_inference = True
+        load_job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            parquet_options=parquet_options,
+            **load_options,
+        )
+    else:
+        raise NotImplementedError(f'Extension {extension} not supported')
+
+    #run your loading job from the blob uris to the destination raw table
+    with span('load'):
+        count_call(instrumentation.BIGQUERY)
         load_job = bigquery_client.load_table_from_uri(
-            source_uris=blob_uri_path,
+            source_uris=source_uris,
             destination=table_id,
             job_config=load_job_config,
         )
 
         #waits the job to finish and print the number of rows inserted
+        count_call(instrumentation.BIGQUERY)
         load_job.result()
 
-        nb_rows_table = bigquery_client.get_table(table_id).num_rows
+    # the job statistics already give what was loaded, no need to read the table
+    instrumentation.add_metric('files_loaded', len(source_uris))
+    instrumentation.add_metric('bytes_loaded', load_job.input_file_bytes)
+    instrumentation.add_metric('rows_loaded', load_job.output_rows)
+    print(f'{load_job.output_rows} rows loaded from {len(source_uris)} file(s) into {table_id}')
+    return load_job
 
-        print(f'{nb_rows_table} rows in {table_id} ')
-    else:
-        print(f'{blob_path} inexistant dans  in {bucket_name} ')
-    
-    print(f'     ***************              End  insert_into_raw   : {datetime.now().strftime("%H:%M:%S.%f")[:-4]}')
+def copy_partition(table_name: str, source_date: str, file_date: str):
+    """
+    Copy a partition of a raw table to the partition of another date,
+    replacing it, with a copy job.
+
+    Args:
+         table_name (str): BigQuery raw table name.
+         source_date (str): YYYYMMDD date of the partition copied.
+         file_date (str): YYYYMMDD date of the partition written.
+    """
+    from google.cloud import bigquery
+
+    spec = tables.table_spec(table_name)
+    table_id = f"{os.environ['GCP_PROJECT']}.{spec['dataset']}.{spec['table']}"
+    count_call(instrumentation.BIGQUERY)
+    copy_job = clients.bigquery_client().copy_table(
+        f'{table_id}${source_date}',
+        f'{table_id}${file_date}',
+        job_config=bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE),
+    )
+    count_call(instrumentation.BIGQUERY)
+    copy_job.result()
+    print(f'{table_id}${source_date} copiée dans {table_id}${file_date} (contenu identique)')
 
 def trigger_workflow_for_a_table(project_id, location, workflow_id, arguments=None):
-    client = ExecutionsClient()
+    from google.cloud.workflows.executions_v1.types import Execution
+    from google.api_core.exceptions import GoogleAPICallError
+
+    client = clients.executions_client()
     parent = f"projects/{project_id}/locations/{location}/workflows/{workflow_id}"
 
     print(f"[INFO] Déclenchement du workflow '{workflow_id}'")
@@ -161,6 +485,7 @@ def trigger_workflow_for_a_table(project_id, location, workflow_id, arguments=No
     try:
         # Crée une exécution
         execution = Execution(argument=arguments if arguments else "{}")
+        count_call(instrumentation.WORKFLOWS)
         response = client.create_execution(request={"parent": parent, "execution": execution})
         execution_id = response.name.split("/")[-1]
         print(f"[SUCCESS] Exécution déclenchée. ID : {execution_id}")
@@ -170,20 +495,24 @@ def trigger_workflow_for_a_table(project_id, location, workflow_id, arguments=No
         return None
 
 def wait_for_execution_completion(project_id, location, workflow_id, execution_id, timeout=300):
-    client = ExecutionsClient()
+    from google.api_core.exceptions import GoogleAPICallError, RetryError
+
+    client = clients.executions_client()
     execution_name = f"projects/{project_id}/locations/{location}/workflows/{workflow_id}/executions/{execution_id}"
 
     start_time = time.time()
     while True:
         try:
+            count_call(instrumentation.WORKFLOWS)
             response = client.get_execution(request={"name": execution_name})
             state = response.state.name  # ex: "ACTIVE", "SUCCEEDED", "FAILED"
-            print(f"[INFO]  statut : {state}  : {datetime.now().strftime("%H:%M:%S.%f")[:-4]} ")
+            print(f"[INFO]  statut : {state}  : {datetime.now().strftime('%H:%M:%S.%f')[:-4]} ")
 
             if state not in ["ACTIVE"]:
                 print(f"[INFO] Exécution terminée avec le statut : {state}")
                 if state == "SUCCEEDED":
                     print(f"[RESULT] {response.result}")
+                    record_workflow_statistics(response.result)
                 elif state == "FAILED":
                     print(f"[ERROR] {response.error}")
                 return state
@@ -199,9 +528,85 @@ def wait_for_execution_completion(project_id, location, workflow_id, execution_i
             print(f"[ERROR] Impossible de vérifier le statut de l'exécution : {e}")
             return None
 
-def trigger_worflow(table_name: str):
-    print(f'     ***************   Start  trigger_worflow   : {datetime.now().strftime("%H:%M:%S.%f")[:-4]}')
+def record_workflow_statistics(result: str):
+    """
+    Add the statistics of the BigQuery jobs returned by `cleaned_wkf`
+    ({table: {bytes_processed, slot_ms, ...}}) to the metrics of the invocation.
+    """
+    try:
+        tables_results = json.loads(result or 'null') or {}
+        for table_result in tables_results.values():
+            instrumentation.add_metric('bytes_processed', int(table_result.get('bytes_processed') or 0))
+            instrumentation.add_metric('slot_ms', int(table_result.get('slot_ms') or 0))
+    except (ValueError, TypeError, AttributeError):
+        print(f'[WARNING] Résultat du workflow illisible : {result}')
+
+def request_workflow(table_name: str):
+    """
+    Ask for a rebuild of the cleaned tables: the workflow is triggered right
+    away, or through the per-table coalescing when `wkf_coalesce_window` is set.
+
+    Args:
+         table_name (str): Table to rebuild.
+    """
+    if not tables.table_spec(table_name)['cleaned']:
+        print(f'     {table_name}: pas de table cleaned, pas de workflow')
+        return
+    if trigger_scheduler.coalescing_enabled():
+        outcome = trigger_scheduler.request_trigger(table_name, launch_workflow)
+        print(f'     workflow of {table_name}: {outcome}')
+    else:
+        trigger_worflow(table_name)
 
+def request_manifest_workflow(file_date: str, table_names: list):
+    """
+    Trigger one refresh of the cleaned tables of all the tables loaded by the
+    commit of a daily manifest (see `daily_manifest`), or ask for the refresh
+    of each of them through the per-table coalescing when
+    `wkf_coalesce_window` is set.
+
+    Args:
+         file_date (str): YYYYMMDD date of the manifest.
+         table_names (list): Tables loaded by the commit.
+    """
+    if trigger_scheduler.coalescing_enabled():
+        # the lease of a table keeps its refreshes from running side by side
+        for table_name in table_names:
+            request_workflow(table_name)
+        return
+    cleaned_tables = [entry for table_name in table_names for entry in tables.table_spec(table_name)['cleaned']]
+    if not cleaned_tables:
+        print(f'     manifeste du {file_date}: pas de table cleaned, pas de workflow')
+        return
+    trigger_worflow(f'manifest_{file_date}', cleaned_tables)
+
+def launch_workflow(table_name: str):
+    """
+    Trigger the workflow of a table for the coalescing scheduler.
+
+    Returns:
+         str: The execution name if it is still running (`async` wait mode),
+              else None.
+    """
+    execution_name = trigger_worflow(table_name)
+    if os.environ.get('wkf_wait_mode', 'sync') == 'async':
+        return execution_name
+    return None
+
+def trigger_worflow(table_name: str, cleaned_tables: list = None):
+    """
+    Trigger the refresh of the cleaned tables of a raw table by the `cleaned_wkf` workflow
+    (`wkf_id`) and wait for its end (`sync` wait mode) or record it in the
+    execution ledger (`async` wait mode).
+
+    Args:
+         table_name (str): Table to rebuild.
+         cleaned_tables (list): Cleaned tables and chains to refresh, those
+                                of the table by default.
+
+    Returns:
+         str: The name of the execution, None if it could not be created.
+    """
     project_id = os.environ.get('GCP_PROJECT')
     if project_id is None:
         raise ValueError("La variable d'environnement 'GCP_PROJECT' n'est pas définie.")
@@ -213,16 +618,71 @@ def trigger_worflow(table_name: str):
         print(f'On force la variable  "location" a "europe-west1"')
         #raise ValueError("La variable d'environnement 'wkf_location' n'est pas définie.")
 
-    workflow_id = f'{table_name}_wkf'
-    arguments = "{}"  # JSON string si besoin
+    # one workflow for every cleaned table, the cleaned tables of the raw
+    # table (and their chains, see `tables.TABLES_SPEC`) are an argument
+    workflow_id = os.environ.get('wkf_id', DEFAULT_WORKFLOW_ID)
+    # the workflow merges only the new raw rows into the cleaned tables, unless
+    # `cleaned_full_refresh` asks for a full rebuild (backfills)
+    full_refresh = os.environ.get('cleaned_full_refresh', 'false').lower() == 'true'
+    if cleaned_tables is None:
+        cleaned_tables = tables.table_spec(table_name)['cleaned']
+    arguments = json.dumps({'tables': cleaned_tables,
+                            'full_refresh': full_refresh})  # JSON string
+
+    # sync  : wait for the end of the execution (polling every 5s)
+    # async : return as soon as the execution is created, the execution is
+    #         recorded in the ledger and followed by `track_executions`
+    wait_mode = os.environ.get('wkf_wait_mode', 'sync')
+    if wait_mode not in ['sync', 'async']:
+        raise ValueError(f"La variable d'environnement 'wkf_wait_mode' doit valoir 'sync' ou 'async', pas '{wait_mode}'.")
+
+    execution_name = None
+    with span('trigger'):
+        execution_id = trigger_workflow_for_a_table(project_id, location, workflow_id, arguments)
+        if execution_id:
+            execution_name = f"projects/{project_id}/locations/{location}/workflows/{workflow_id}/executions/{execution_id}"
+            if wait_mode == 'async':
+                execution_ledger.record_execution(table_name, execution_name, arguments)
+    if execution_id and wait_mode == 'sync':
+        with span('wait_workflow'):
+            wait_for_execution_completion(project_id, location, workflow_id, execution_id)
+
+    return execution_name
+
+@instrumentation.instrumented
+def track_executions(event: dict, context: dict):
+    """
+    Triggered on a schedule (Cloud Scheduler -> Pub/Sub).
+    Checks the workflow executions recorded in the ledger by the `async`
+    wait mode, records their final state and reports the late or failed ones.
+    Then flushes the raw load batches which are due, commits the daily
+    manifests whose deadline passed and triggers the coalesced workflows
+    whose window ended.
 
-    execution_id = trigger_workflow_for_a_table(project_id, location, workflow_id, arguments)
-    if execution_id:
-        wait_for_execution_completion(project_id, location, workflow_id, execution_id)
+    Args:
+         event (dict): Event payload (not used).
+         context (google.cloud.functions.Context): Metadata for the event.
+    """
+    def on_finished(document):
+        trigger_scheduler.release(document['table_name'], document['execution_name'], launch=launch_workflow)
+
+    summary = execution_ledger.check_executions(on_finished=on_finished)
+    print(f'     executions: {summary}')
+
+    if batch_loader.batching_enabled():
+        flushed = batch_loader.flush_due_batches(load=load_batch, move=move_files, on_loaded=request_workflow)
+        print(f'     load batches flushed: {flushed}')
+
+    if daily_manifest.manifest_enabled():
+        committed = daily_manifest.commit_due_manifests(load=insert_into_raw, move=move_file,
+                                                        on_committed=request_manifest_workflow)
+        print(f'     daily manifests committed: {committed}')
 
-    print(f'     ***************   End  trigger_worflow   : {datetime.now().strftime("%H:%M:%S.%f")[:-4]}')
+    if trigger_scheduler.coalescing_enabled():
+        triggered = trigger_scheduler.fire_due_triggers(launch_workflow)
+        print(f'     coalesced workflows triggered: {triggered}')
 
-def move_file(bucket_name, blob_path, new_subfolder):
+def move_file(bucket_name, blob_path, new_subfolder, generation=None):
     """
     Move a file a to new subfolder as root.
 
@@ -230,40 +690,33 @@ def move_file(bucket_name, blob_path, new_subfolder):
          bucket_name (str): Bucket name of the file.
          blob_path (str): Path of the blob inside the bucket.
          new_subfolder (str): Subfolder where to move the file.
+         generation (int): Generation of the file to move, None for the
+                           current one.
+
+    Returns:
+         dict: The result of the move (see `mover.move_blob`).
     """
-    print(f'     ***************   Start move_file   : {datetime.now().strftime("%H:%M:%S.%f")[:-4]}')
-    
-    
-    print(f'     bucket_name: {bucket_name}')
-    print(f'     blob_path: {blob_path}')
+    with span('move'):
+        return mover.move_blobs(bucket_name, [(blob_path, new_subfolder, generation)])[0]
 
-    # TODO: 1
-    # Now you are confortable with the first Cloud Function you wrote. 
-    # Inspire youreslf from this first Cloud Function and:
-    #     - connect to the Cloud Storage client
-    storage_client = storage.Client()
 
-    #     - get the bucket object and the blob object
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-
-    #     - split the blob path to isolate the file name 
-    blob_nom_sans_extension, blob_extension = blob_path.rsplit('.', 1)
-    print(f' blob_nom_sans_extension : {blob_nom_sans_extension}')
-    print(f' blob_extension          : {blob_extension}')
-    #     - create your new blob path with the correct new subfolder given from the arguments
-    new_blob_path = blob_path.replace('input', new_subfolder)
-    print(f' new_blob_path           : {new_blob_path}')
-    # the file is moved to the invalid/ folder if one check is failed
-    try:
-        bucket.rename_blob(blob, new_blob_path)
-        print(f'{blob.name} moved to {new_blob_path}')
-    except Exception as e:
-            print(e)
-    #     - move you file inside the bucket to its destination
-    #     - print the actual move you made
+def move_files(bucket_name, blob_paths, new_subfolder, generations=None):
+    """
+    Move many files to a new subfolder as root, in parallel.
 
-    print(f'     ***************   End   move_file   : {datetime.now().strftime("%H:%M:%S.%f")[:-4]}')
+    Args:
+         bucket_name (str): Bucket name of the files.
+         blob_paths (list): Paths of the blobs inside the bucket.
+         new_subfolder (str): Subfolder where to move the files.
+         generations (list): Generation of each file, the current one if None.
+
+    Returns:
+         list: The result of each move (see `mover.move_blob`).
+    """
+    generations = generations or [None] * len(blob_paths)
+    with span('move'):
+        return mover.move_blobs(bucket_name, [(blob_path, new_subfolder, generation)
+                                              for blob_path, generation in zip(blob_paths, generations)])
 
 if __name__ == '__main__':
 
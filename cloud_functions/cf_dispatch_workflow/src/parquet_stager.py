@@ -0,0 +1,251 @@
+"""
+Optional conversion of the landing files to Parquet before their load.
+
+When `parquet_staging_prefix` is set (for example 'staging/'), every file is
+converted before the load job:
+    - the file (gzipped or not) is read as a stream and parsed in record
+      batches of `parquet_batch_rows` rows, so the memory used depends on the
+      batch size, not on the size of the file;
+    - each value is typed from the raw schema of the table (FLOAT, INTEGER,
+      BOOLEAN, TIMESTAMP, nested RECORD / REPEATED ...), so BigQuery loads
+      typed columns instead of parsing text;
+    - the batches are written as a Parquet file streamed to
+      `<parquet_staging_prefix><table>_<date>.parquet` in the same bucket,
+      which is loaded with `SourceFormat.PARQUET` and deleted afterwards.
+
+The original file is still the one archived or rejected.
+
+Needs `pyarrow`, imported only when the conversion is enabled.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+
+from datetime import datetime, timezone
+
+from common import clients
+from common import instrumentation
+from common import tables
+
+DEFAULT_BATCH_ROWS = 10000
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+_TRUE = {'true', 't', 'yes', 'y', '1'}
+_FALSE = {'false', 'f', 'no', 'n', '0'}
+
+
+def staging_enabled() -> bool:
+    return os.environ.get('parquet_staging_prefix') not in [None, '']
+
+
+def _staging_prefix() -> str:
+    return os.environ['parquet_staging_prefix'].strip('/') + '/'
+
+
+def _arrow_type(field: dict):
+    import pyarrow as pa
+
+    field_type = field['type'].upper()
+    if field_type in ['RECORD', 'STRUCT']:
+        arrow_type = pa.struct([_arrow_field(sub_field) for sub_field in field.get('fields', [])])
+    else:
+        arrow_type = {
+            'STRING': pa.string(),
+            'INTEGER': pa.int64(),
+            'INT64': pa.int64(),
+            'FLOAT': pa.float64(),
+            'FLOAT64': pa.float64(),
+            'BOOLEAN': pa.bool_(),
+            'BOOL': pa.bool_(),
+            'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+            'DATE': pa.date32(),
+        }.get(field_type, pa.string())
+    if field.get('mode', 'NULLABLE').upper() == 'REPEATED':
+        arrow_type = pa.list_(arrow_type)
+    return arrow_type
+
+
+def _arrow_field(field: dict):
+    import pyarrow as pa
+
+    return pa.field(field['name'], _arrow_type(field), nullable=field.get('mode', 'NULLABLE').upper() != 'REQUIRED')
+
+
+def arrow_schema(schema: list):
+    """
+    Arrow schema of a BigQuery schema (list of fields as in schemas/raw).
+    """
+    import pyarrow as pa
+
+    return pa.schema([_arrow_field(field) for field in schema])
+
+
+def _parse_timestamp(text: str) -> datetime:
+    # 2022-05-11T13:18:00Z, 2022-06-01 00:05:00 UTC, 2022-06-01
+    text = text.strip().replace(' UTC', '+00:00').replace('Z', '+00:00').replace(' ', 'T', 1)
+    value = datetime.fromisoformat(text)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def _convert(field: dict, value):
+    """
+    Python value of a field, typed as the raw schema says.
+    """
+    if value is None or value == '':
+        return None
+    if field.get('mode', 'NULLABLE').upper() == 'REPEATED':
+        item_field = {**field, 'mode': 'NULLABLE'}
+        return [_convert(item_field, item) for item in value]
+
+    field_type = field['type'].upper()
+    if field_type in ['RECORD', 'STRUCT']:
+        return {sub_field['name']: _convert(sub_field, value.get(sub_field['name'])) for sub_field in field.get('fields', [])}
+    if field_type in ['INTEGER', 'INT64']:
+        return int(value)
+    if field_type in ['FLOAT', 'FLOAT64']:
+        return float(value)
+    if field_type in ['BOOLEAN', 'BOOL']:
+        if isinstance(value, bool):
+            return value
+        text = str(value).strip().lower()
+        if text not in _TRUE | _FALSE:
+            raise ValueError(f"'{field['name']}' : '{value}' n'est pas un booléen")
+        return text in _TRUE
+    if field_type == 'TIMESTAMP':
+        return _parse_timestamp(value)
+    if field_type == 'DATE':
+        return datetime.strptime(value.strip(), '%Y-%m-%d').date()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value if isinstance(value, str) else str(value)
+
+
+def records(spec: dict, schema: list, lines):
+    """
+    Iterate over the rows of a file as {column: typed value}.
+
+    Args:
+         spec (dict): Specification of the table (see `tables.table_spec`).
+         schema (list): Raw schema of the table.
+         lines: Text lines of the file, decompressed.
+
+    Raises:
+         ValueError: If a CSV row has not one value per column, which a load
+                     job of the file would reject too.
+    """
+    if spec['extension'] == 'csv':
+        reader = csv.reader(lines, delimiter=spec['delimiter'])
+        for row in reader:
+            if reader.line_num <= spec['skip_leading_rows'] or not row:
+                continue
+            if len(row) != len(schema):
+                raise ValueError(f'ligne {reader.line_num} : {len(row)} colonne(s) au lieu de {len(schema)}')
+            yield {field['name']: _convert(field, value) for field, value in zip(schema, row)}
+    else:
+        for line in lines:
+            if line.strip():
+                record = json.loads(line)
+                yield {field['name']: _convert(field, record.get(field['name'])) for field in schema}
+
+
+def convert_stream(table_name: str, source, destination, compression: str = None) -> int:
+    """
+    Convert a file of a table to Parquet, one record batch at a time.
+
+    Args:
+         table_name (str): Name of the table of the file.
+         source: Binary file-like object of the file.
+         destination: Binary file-like object the Parquet file is written to.
+         compression (str): 'gz' if the source is gzipped, else None.
+
+    Returns:
+         int: Number of rows written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    spec = tables.table_spec(table_name)
+    schema = tables.raw_schema(table_name)
+    parquet_schema = arrow_schema(schema)
+    batch_rows = int(os.environ.get('parquet_batch_rows', DEFAULT_BATCH_ROWS))
+
+    if compression == 'gz':
+        source = gzip.GzipFile(fileobj=source, mode='rb')
+    lines = io.TextIOWrapper(source, encoding='utf-8-sig', newline='')
+
+    rows = 0
+    batch = []
+    with pq.ParquetWriter(destination, parquet_schema, compression='snappy') as writer:
+        for record in records(spec, schema, lines):
+            batch.append(record)
+            if len(batch) >= batch_rows:
+                writer.write_table(pa.Table.from_pylist(batch, schema=parquet_schema))
+                rows += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=parquet_schema))
+            rows += len(batch)
+    lines.detach()
+    return rows
+
+
+def stage_files(table_name: str, source_uris: list) -> list:
+    """
+    Convert files of the landing bucket to Parquet files of the staging prefix.
+
+    Args:
+         table_name (str): Name of the table of the files.
+         source_uris (list): gs:// URIs of the files.
+
+    Returns:
+         list: gs:// URIs of the Parquet files, in the same order.
+
+    Raises:
+         ValueError: If a file cannot be converted, once the Parquet files
+                     already written are deleted.
+    """
+    chunk_size = int(os.environ.get('parquet_chunk_size', DEFAULT_CHUNK_SIZE))
+    storage_client = clients.storage_client()
+    staged_uris = []
+    try:
+        for source_uri in source_uris:
+            bucket_name, _, blob_path = source_uri[len('gs://'):].partition('/')
+            name, _, compression = tables.split_file_name(blob_path.rsplit('/', 1)[-1])
+            staged_path = f'{_staging_prefix()}{name}.parquet'
+            bucket = storage_client.bucket(bucket_name)
+            # before the writing, so that a file written in part is deleted too
+            staged_uris.append(f'gs://{bucket_name}/{staged_path}')
+
+            source_blob = bucket.blob(blob_path)
+            staged_blob = bucket.blob(staged_path)
+            with source_blob.open('rb', chunk_size=chunk_size) as source, \
+                    staged_blob.open('wb', chunk_size=chunk_size, ignore_flush=True) as destination:
+                rows = convert_stream(table_name, source, destination, compression)
+                source_bytes, staged_bytes = source.tell(), destination.tell()
+
+            instrumentation.count_call(instrumentation.GCS, 2)
+            instrumentation.add_metric('bytes_staged', staged_bytes)
+            print(f'     {source_uri} -> gs://{bucket_name}/{staged_path}: {rows} rows, {source_bytes} -> {staged_bytes} bytes')
+    except Exception:
+        # the caller gets no URI to delete
+        delete_staged(staged_uris)
+        raise
+    return staged_uris
+
+
+def delete_staged(staged_uris: list):
+    """
+    Delete the Parquet files once loaded (or failed).
+    """
+    from google.api_core.exceptions import NotFound
+
+    storage_client = clients.storage_client()
+    for staged_uri in staged_uris:
+        bucket_name, _, blob_path = staged_uri[len('gs://'):].partition('/')
+        instrumentation.count_call(instrumentation.GCS)
+        try:
+            storage_client.bucket(bucket_name).blob(blob_path).delete()
+        except NotFound:
+            pass
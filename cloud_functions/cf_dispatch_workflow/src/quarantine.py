@@ -0,0 +1,227 @@
+"""
+Optional quarantine of the bad rows of a file instead of the whole file.
+
+Without it, a load job which fails moves the whole file to `reject/`: one bad
+line in a `basket_*.json` of 4 MB throws the whole day away. When
+`quarantine_max_bad_rows` is set, each file loaded one by one is first read
+as a stream and checked row by row against the raw schema (see
+`common/validator.py`):
+    - no bad row: the file is loaded as usual;
+    - at most `quarantine_max_bad_rows` bad rows: the other lines are copied
+      to `quarantine/<table>_<date>.<extension>` in the same bucket, which is
+      loaded instead of the file, with no bad record allowed (a row the
+      validator accepted but BigQuery does not fails the load, nothing is
+      skipped silently), then deleted; the bad rows are written with their
+      line numbers and errors to the sidecar
+      `reject/<table>_<date>.errors.<extension>`, whose metadata keep the
+      rows loaded and quarantined;
+    - more bad rows, or an error of the whole file (header, unreadable
+      file): the file is rejected as before.
+
+The original file is archived once its good rows are loaded: only the
+sidecar needs to be fixed and sent again. The files of the micro-batches
+(`load_batch_max_files`) are not checked. With `content_validation_max_errors`,
+set `quarantine_max_bad_rows` to the same value for the trigger, so that it
+only moves to `invalid/` the files which would be rejected here.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+
+from common import clients
+from common import instrumentation
+from common import tables
+from common import validator
+from common.instrumentation import count_call
+
+SIDECAR_FOLDER = 'reject'
+GOOD_ROWS_FOLDER = 'quarantine'
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def quarantine_enabled() -> bool:
+    return validator.quarantine_enabled()
+
+
+def max_bad_rows() -> int:
+    return int(os.environ['quarantine_max_bad_rows'])
+
+
+def split_rows(table_name: str, bucket_name: str, blob_path: str) -> validator.ValidationReport:
+    """
+    Find the bad rows of a file.
+
+    Args:
+         table_name (str): Name of the table of the file.
+         bucket_name (str): Bucket name of the file.
+         blob_path (str): Path of the blob inside the bucket.
+
+    Returns:
+         validator.ValidationReport: The rows read and the rows in error,
+                                     with their errors.
+
+    Raises:
+         ValueError: If the file has more than `quarantine_max_bad_rows` bad
+                     rows or an error of the whole file.
+    """
+    _, _, compression = tables.split_file_name(blob_path.rsplit('/', 1)[-1])
+    blob = clients.storage_client().bucket(bucket_name).blob(blob_path)
+    report = validator.validate_blob(table_name, blob, max_errors_count=max_bad_rows(), compression=compression,
+                                     keep_rows=True)
+    if report.complete:
+        raise ValueError(f'{blob_path}: plus de {max_bad_rows()} lignes invalides, fichier rejeté\n{report}')
+    if report.file_error:
+        raise ValueError(f'{blob_path}: fichier invalide, rejeté\n{report}')
+    return report
+
+
+def _lines(spec: dict, extension: str, lines):
+    """
+    The rows of a file with their physical lines, read as the validator
+    reads them.
+
+    Yields:
+         (int, list): Line number of the row (0 for a blank line), the lines
+                      of the row as they are in the file.
+    """
+    if extension != 'csv':
+        for line_number, line in enumerate(lines, start=1):
+            yield (line_number if line.strip() else 0), [line]
+        return
+
+    # a quoted CSV value may hold line breaks: keep every line the reader takes
+    consumed = []
+
+    def reading():
+        for line in lines:
+            consumed.append(line)
+            yield line
+
+    reader = csv.reader(reading(), delimiter=spec['delimiter'])
+    for row in reader:
+        yield (reader.line_num if row else 0), list(consumed)
+        consumed.clear()
+
+
+def write_good_rows(table_name: str, bucket_name: str, blob_path: str, report: validator.ValidationReport) -> str:
+    """
+    Copy the file without its bad rows, streamed and uncompressed.
+
+    Args:
+         table_name (str): Name of the table of the file.
+         bucket_name (str): Bucket name of the file.
+         blob_path (str): Path of the blob inside the bucket.
+         report (validator.ValidationReport): The result of `split_rows`.
+
+    Returns:
+         str: gs:// URI of the copy, to load then delete with `delete_good_rows`.
+    """
+    spec = tables.table_spec(table_name)
+    name, extension, compression = tables.split_file_name(blob_path.rsplit('/', 1)[-1])
+    path = f'{GOOD_ROWS_FOLDER}/{name}.{extension}'
+    chunk_size = int(os.environ.get('content_validation_chunk_size', DEFAULT_CHUNK_SIZE))
+    bucket = clients.storage_client().bucket(bucket_name)
+
+    rows = 0
+    with bucket.blob(blob_path).open('rb', chunk_size=chunk_size) as source, \
+            bucket.blob(path).open('wb', chunk_size=chunk_size, ignore_flush=True) as destination:
+        stream = gzip.GzipFile(fileobj=source, mode='rb') if compression == 'gz' else source
+        lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        output = io.TextIOWrapper(destination, encoding='utf-8', newline='')
+        for line_number, row_lines in _lines(spec, extension, lines):
+            if line_number in report.bad_rows:
+                continue
+            header = extension == 'csv' and line_number <= spec['skip_leading_rows']
+            rows += bool(line_number) and not header
+            output.writelines(row_lines)
+        output.flush()
+        output.detach()
+        lines.detach()
+
+    count_call(instrumentation.GCS, 2)
+    if rows != report.rows - len(report.bad_rows):
+        delete_good_rows(f'gs://{bucket_name}/{path}')
+        raise ValueError(f'{blob_path}: {rows} lignes copiées au lieu de {report.rows - len(report.bad_rows)}')
+    return f'gs://{bucket_name}/{path}'
+
+
+def delete_good_rows(good_rows_uri: str):
+    """
+    Delete the copy of `write_good_rows` once loaded (or failed).
+    """
+    from google.api_core.exceptions import NotFound
+
+    bucket_name, _, blob_path = good_rows_uri[len('gs://'):].partition('/')
+    count_call(instrumentation.GCS)
+    try:
+        clients.storage_client().bucket(bucket_name).blob(blob_path).delete()
+    except NotFound:
+        pass
+
+
+def sidecar_path(blob_path: str) -> str:
+    """
+    `input/basket_20220601.json[.gz]` -> `reject/basket_20220601.errors.json`
+    """
+    name, extension, _ = tables.split_file_name(blob_path.rsplit('/', 1)[-1])
+    return f'{SIDECAR_FOLDER}/{name}.errors.{extension}'
+
+
+def _sidecar_content(table_name: str, report: validator.ValidationReport) -> str:
+    """
+    The bad rows with their line numbers and errors, in the format of the
+    file: CSV rows `_line,_errors,<columns>` or JSON lines
+    `{"_line", "_errors", "_row"}`.
+    """
+    spec = tables.table_spec(table_name)
+    errors_by_line = {}
+    for line_number, message in report.errors:
+        errors_by_line.setdefault(line_number, []).append(message)
+
+    output = io.StringIO()
+    if spec['extension'] == 'csv':
+        writer = csv.writer(output, delimiter=spec['delimiter'], lineterminator='\n')
+        writer.writerow(['_line', '_errors'] + [field['name'] for field in tables.raw_schema(table_name)])
+        for line_number, row in sorted(report.bad_rows.items()):
+            writer.writerow([line_number, ' ; '.join(errors_by_line[line_number])] + list(row))
+    else:
+        for line_number, row in sorted(report.bad_rows.items()):
+            output.write(json.dumps({'_line': line_number, '_errors': errors_by_line[line_number], '_row': row},
+                                    ensure_ascii=False) + '\n')
+    return output.getvalue()
+
+
+def write_sidecar(table_name: str, bucket_name: str, blob_path: str, report: validator.ValidationReport,
+                  rows_loaded: int) -> str:
+    """
+    Write the bad rows of a file loaded without them to its sidecar.
+
+    Args:
+         table_name (str): Name of the table of the file.
+         bucket_name (str): Bucket name of the file.
+         blob_path (str): Path of the blob inside the bucket.
+         report (validator.ValidationReport): The result of `split_rows`.
+         rows_loaded (int): Rows loaded by the load job.
+
+    Returns:
+         str: Path of the sidecar inside the bucket.
+    """
+    path = sidecar_path(blob_path)
+    blob = clients.storage_client().bucket(bucket_name).blob(path)
+    blob.metadata = {
+        'source': blob_path,
+        'rows_read': str(report.rows),
+        'rows_loaded': str(rows_loaded),
+        'rows_quarantined': str(len(report.bad_rows)),
+    }
+    count_call(instrumentation.GCS)
+    blob.upload_from_string(_sidecar_content(table_name, report),
+                            content_type='text/csv' if tables.table_spec(table_name)['extension'] == 'csv'
+                            else 'application/x-ndjson')
+
+    instrumentation.add_metric('files_quarantined', 1)
+    instrumentation.add_metric('rows_quarantined', len(report.bad_rows))
+    print(f'{blob_path}: {rows_loaded} rows loaded, {len(report.bad_rows)} rows in gs://{bucket_name}/{path}')
+    return path
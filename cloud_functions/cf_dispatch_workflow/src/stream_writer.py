@@ -0,0 +1,173 @@
+"""
+Optional ingestion of the small files through the BigQuery Storage Write API.
+
+A load job waits in a queue for seconds and counts against the load job
+quota, even for a `customer_*.csv` of a few hundred bytes. When
+`stream_max_bytes` is set, a file of at most this size is instead:
+    - downloaded and parsed in the function, each value typed from the raw
+      schema of the table as for the Parquet staging (see `parquet_stager`);
+    - appended as one Arrow record batch to a PENDING write stream of the
+      raw table (its `table$YYYYMMDD` partition for the partitioned tables),
+      at offset 0;
+    - made visible by finalizing the stream and committing it: all the rows
+      of the file are in the table, or none. For a partitioned table, the
+      rows of the partition are deleted just before the commit, so the file
+      replaces its partition as the load job (WRITE_TRUNCATE) does.
+
+The larger files keep the load job. Both paths report the same metrics
+(`files_loaded`, `bytes_loaded`, `rows_loaded`), the streamed files are also
+counted in `files_streamed`.
+
+The delete and the commit are two calls, not one transaction: a commit
+which fails after the delete leaves the partition empty until the file is
+loaded again (the file goes to reject/ like any failed load). A table which
+does not exist yet is left to the load job, which creates it. An append
+request is limited to 10 MB: keep `stream_max_bytes` well below.
+
+Needs `pyarrow` and `google-cloud-bigquery-storage`, imported only when a
+file is streamed.
+"""
+import gzip
+import io
+import os
+
+from datetime import datetime
+
+from common import clients
+from common import instrumentation
+from common import tables
+from common.instrumentation import span, count_call
+
+import parquet_stager
+
+
+def streaming_enabled() -> bool:
+    return os.environ.get('stream_max_bytes') not in [None, '']
+
+
+def should_stream(size: int) -> bool:
+    """
+    True if a file of `size` bytes goes through the Storage Write API.
+    """
+    return streaming_enabled() and size is not None and int(size) <= int(os.environ['stream_max_bytes'])
+
+
+def _record_batch(table_name: str, data: bytes, compression: str = None) -> tuple:
+    """
+    Parse a file into (Arrow schema, Arrow record batch) typed from the raw
+    schema of its table.
+    """
+    import pyarrow as pa
+
+    spec = tables.table_spec(table_name)
+    schema = tables.raw_schema(table_name)
+    if compression == 'gz':
+        data = gzip.decompress(data)
+    lines = io.StringIO(data.decode('utf-8-sig'), newline='')
+    arrow_schema = parquet_stager.arrow_schema(schema)
+    batch = pa.RecordBatch.from_pylist(list(parquet_stager.records(spec, schema, lines)), schema=arrow_schema)
+    return arrow_schema, batch
+
+
+def _delete_partition(project: str, spec: dict, file_date: str):
+    """
+    Delete the rows of the `file_date` partition of a raw table.
+    """
+    from google.cloud import bigquery
+
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('file_date', 'DATE', datetime.strptime(file_date, '%Y%m%d').date()),
+    ])
+    count_call(instrumentation.BIGQUERY)
+    clients.bigquery_client().query(
+        f"DELETE FROM `{project}.{spec['dataset']}.{spec['table']}` WHERE _PARTITIONDATE = @file_date",
+        job_config=job_config,
+    ).result()
+
+
+def append_file(table_name: str, bucket_name: str, blob_path: str, file_date: str = None):
+    """
+    Append the rows of a small file to its raw table through a pending
+    write stream, committed once all the rows are written.
+
+    Args:
+         table_name (str): BigQuery raw table name.
+         bucket_name (str): Bucket name of the file.
+         blob_path (str): Path of the blob inside the bucket.
+         file_date (str): YYYYMMDD date of the file name.
+
+    Returns:
+         int: Number of rows committed, None if the table does not exist yet
+              (the caller loads the file with a load job instead).
+    """
+    from google.api_core.exceptions import NotFound
+    from google.cloud.bigquery_storage_v1 import types
+
+    project = os.environ['GCP_PROJECT']
+    spec = tables.table_spec(table_name)
+    table = spec['table']
+    if spec['partitioning'] == 'file_date' and file_date:
+        table = f'{table}${file_date}'
+
+    #     - read and parse the file in memory, it is small
+    blob = clients.storage_client().bucket(bucket_name).blob(blob_path)
+    count_call(instrumentation.GCS)
+    data = blob.download_as_bytes()
+    _, _, compression = tables.split_file_name(blob_path.rsplit('/', 1)[-1])
+    with span('parse'):
+        arrow_schema, batch = _record_batch(table_name, data, compression)
+
+    write_client = clients.bigquery_write_client()
+    parent = write_client.table_path(project, spec['dataset'], table)
+
+    with span('stream'):
+        try:
+            count_call(instrumentation.BIGQUERY)
+            write_stream = write_client.create_write_stream(
+                parent=parent,
+                write_stream=types.WriteStream(type_=types.WriteStream.Type.PENDING),
+            )
+        except NotFound:
+            print(f'{parent} inexistante, chargement par un load job')
+            return None
+
+        #     - one request: the schema and all the rows, at offset 0 so a retry cannot duplicate them
+        request = types.AppendRowsRequest(
+            write_stream=write_stream.name,
+            offset=0,
+            arrow_rows=types.AppendRowsRequest.ArrowData(
+                writer_schema=types.ArrowSchema(serialized_schema=arrow_schema.serialize().to_pybytes()),
+                rows=types.ArrowRecordBatch(serialized_record_batch=batch.serialize().to_pybytes(),
+                                            row_count=batch.num_rows),
+            ),
+        )
+        count_call(instrumentation.BIGQUERY)
+        responses = write_client.append_rows(
+            requests=iter([request]),
+            metadata=(('x-goog-request-params', f'write_stream={write_stream.name}'),),
+        )
+        for response in responses:
+            if response.row_errors:
+                errors = '; '.join(f'row {error.index}: {error.message}' for error in response.row_errors[:5])
+                raise ValueError(f'{len(response.row_errors)} rows rejected by {parent}: {errors}')
+            if response.error.code:
+                raise RuntimeError(f'Append to {parent} failed: {response.error.message}')
+
+        #     - the rows become visible together, at the commit
+        count_call(instrumentation.BIGQUERY)
+        finalized = write_client.finalize_write_stream(name=write_stream.name)
+        if table != spec['table']:
+            #     - replacing the rows of the partition, as the load job does
+            _delete_partition(project, spec, file_date)
+        count_call(instrumentation.BIGQUERY)
+        commit = write_client.batch_commit_write_streams(
+            types.BatchCommitWriteStreamsRequest(parent=parent, write_streams=[write_stream.name]))
+        if commit.stream_errors:
+            raise RuntimeError(f'Commit to {parent} failed: {commit.stream_errors[0].error_message}')
+
+    instrumentation.add_metric('files_loaded', 1)
+    instrumentation.add_metric('files_streamed', 1)
+    instrumentation.add_metric('bytes_loaded', len(data))
+    instrumentation.add_metric('rows_loaded', finalized.row_count)
+    print(f'{finalized.row_count} rows streamed from gs://{bucket_name}/{blob_path} into {project}.{spec["dataset"]}.{table}')
+    return finalized.row_count
@@ -0,0 +1,207 @@
+"""
+Per-table coalescing of the workflow triggers.
+
+Every loaded file asks for a refresh of its cleaned table by the workflow,
+but each refresh reads all the new raw rows of the table: when many files land
+together, only the last refresh is useful. When `wkf_coalesce_window` is set, the requests are
+not triggered directly but go through one document per table
+(`state/triggers/<table>.json`) which:
+    - gathers the requests of a table during `wkf_coalesce_window` seconds
+      after the first one, then triggers the workflow once;
+    - is a lease: while an execution of the table runs, the new requests are
+      merged into at most one follow-up, triggered once the execution ended;
+    - expires the lease after `wkf_coalesce_lease` seconds, in case the end
+      of an execution is never seen.
+
+The windows which end without a new request are fired by `fire_due_triggers`,
+called on a schedule by the `track_executions` entry point (deployed as
+`cf_track_executions` with its Cloud Scheduler job, see `iac/scheduler.tf`):
+a window is thus fired up to one schedule tick after it ends. With the
+`async` wait mode, the end of an execution is also seen there (see `release`).
+"""
+import os
+import time
+
+from common import state_store
+
+TRIGGERS_PREFIX = 'triggers/'
+
+DEFAULT_LEASE = 3600
+
+# value of `running` between the lease acquisition and the execution creation
+STARTING = 'STARTING'
+
+
+def coalescing_enabled() -> bool:
+    return os.environ.get('wkf_coalesce_window') not in [None, '']
+
+
+def _window() -> float:
+    return float(os.environ.get('wkf_coalesce_window', 0))
+
+
+def _lease() -> float:
+    return float(os.environ.get('wkf_coalesce_lease', DEFAULT_LEASE))
+
+
+def _path(table_name: str) -> str:
+    return f'{TRIGGERS_PREFIX}{table_name}.json'
+
+
+def _new_document(table_name: str) -> dict:
+    return {
+        'table_name': table_name,
+        'pending': False,
+        'pending_since': None,
+        'requests': 0,
+        'running': None,
+        'lease_expires_at': None,
+        'follow_up': False,
+        'follow_up_since': None,
+    }
+
+
+def _lease_expired(document: dict, now: float) -> bool:
+    return document['running'] is not None and document['lease_expires_at'] < now
+
+
+def request_trigger(table_name: str, launch, now: float = None) -> str:
+    """
+    Ask for a rebuild of a table.
+
+    Args:
+         table_name (str): Table to rebuild.
+         launch (callable): Called with the table name to trigger the workflow.
+                            Returns the name of the execution if it is still
+                            running (it must then be released with `release`),
+                            else None.
+         now (float): Current timestamp, for tests.
+
+    Returns:
+         str: 'triggered', 'deferred' (in the window) or 'queued' (follow-up).
+    """
+    now = now if now is not None else time.time()
+
+    def add_request(document):
+        document = document or _new_document(table_name)
+        document['requests'] += 1
+        if document['running'] is not None and not _lease_expired(document, now):
+            if not document['follow_up']:
+                document['follow_up'] = True
+                document['follow_up_since'] = now
+        elif not document['pending']:
+            document['pending'] = True
+            document['pending_since'] = now
+        return document
+
+    document = state_store.update_document(_path(table_name), add_request)
+    print(f"     trigger request for {table_name}: {document['requests']} request(s) since the last trigger")
+
+    if document['running'] is not None and not _lease_expired(document, now):
+        return 'queued'
+    if _start_if_due(table_name, launch, now):
+        return 'triggered'
+    return 'deferred'
+
+
+def _start_if_due(table_name: str, launch, now: float) -> bool:
+    """
+    Acquire the lease of a table and trigger its workflow if its window ended.
+    """
+    acquired = []
+
+    def acquire(document):
+        if document is None or not document['pending']:
+            return None
+        if document['running'] is not None and not _lease_expired(document, now):
+            return None
+        if now - document['pending_since'] < _window():
+            return None
+        if _lease_expired(document, now):
+            print(f"[WARNING] Bail expiré pour {table_name} : {document['running']}")
+        document.update({
+            'pending': False,
+            'pending_since': None,
+            'requests': 0,
+            'running': STARTING,
+            'lease_expires_at': now + _lease(),
+        })
+        acquired.append(True)
+        return document
+
+    state_store.update_document(_path(table_name), acquire)
+    if not acquired:
+        return False
+
+    try:
+        execution_name = launch(table_name)
+    except Exception:
+        release(table_name, STARTING, now=now)
+        raise
+
+    if execution_name is None:
+        # the execution is already over (or did not start): a queued follow-up
+        # is left to the next request or to `fire_due_triggers`
+        release(table_name, STARTING, now=now)
+    else:
+        def set_running(document):
+            if document['running'] != STARTING:
+                return None
+            document['running'] = execution_name
+            return document
+        state_store.update_document(_path(table_name), set_running)
+    return True
+
+
+def release(table_name: str, execution_name: str, launch=None, now: float = None):
+    """
+    Release the lease of a table once its execution ended. A queued follow-up
+    becomes a pending request, triggered once its window ended.
+
+    Args:
+         table_name (str): Table of the execution.
+         execution_name (str): Execution which ended.
+         launch (callable): If given, used to trigger the follow-up right away
+                            when its window already ended.
+         now (float): Current timestamp, for tests.
+    """
+    now = now if now is not None else time.time()
+
+    def free(document):
+        if document is None or document['running'] != execution_name:
+            return None
+        document['running'] = None
+        document['lease_expires_at'] = None
+        if document['follow_up']:
+            document['pending'] = True
+            document['pending_since'] = document['follow_up_since']
+            document['follow_up'] = False
+            document['follow_up_since'] = None
+        return document
+
+    document = state_store.update_document(_path(table_name), free)
+    if launch is not None and document is not None and document['pending']:
+        _start_if_due(table_name, launch, now)
+
+
+def fire_due_triggers(launch, now: float = None) -> list:
+    """
+    Trigger the tables whose window ended, and take over the expired leases.
+
+    Args:
+         launch (callable): See `request_trigger`.
+         now (float): Current timestamp, for tests.
+
+    Returns:
+         list: Tables triggered.
+    """
+    now = now if now is not None else time.time()
+    triggered = []
+    for path, document, _ in state_store.list_documents(TRIGGERS_PREFIX):
+        if _lease_expired(document, now):
+            release(document['table_name'], document['running'], now=now)
+        elif not document['pending'] or document['running'] is not None:
+            continue
+        if _start_if_due(document['table_name'], launch, now):
+            triggered.append(document['table_name'])
+    return triggered
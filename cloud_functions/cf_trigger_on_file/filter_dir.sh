@@ -1,3 +1,14 @@
 #!/bin/bash
+# Builds the deployment bundle of the function in src_filtered/.
+# Only the runtime code is kept: no virtualenv, no cache and no previous zip.
 pwd
-rsync -av --exclude='venv/' ../cloud_functions/cf_trigger_on_file/src/ ../cloud_functions/cf_trigger_on_file/src_filtered/
+rsync -av --delete \
+    --exclude='venv/' \
+    --exclude='__pycache__/' \
+    --exclude='*.zip' \
+    --exclude='/common/' \
+    ../cloud_functions/cf_trigger_on_file/src/ ../cloud_functions/cf_trigger_on_file/src_filtered/
+# shared code of the functions (GCP clients registry, table registry, ...)
+rsync -av --delete --exclude='__pycache__/' --exclude='/schemas/' ../cloud_functions/common/ ../cloud_functions/cf_trigger_on_file/src_filtered/common/
+# raw schemas of the table registry
+rsync -av --delete ../schemas/raw/ ../cloud_functions/cf_trigger_on_file/src_filtered/common/schemas/raw/
@@ -1,27 +1,38 @@
 #import re
 from datetime import datetime
 import os
+import sys
 #import datetime
-from google.cloud import storage
-from google.cloud import pubsub_v1
+
+# `common/` is copied next to this file in the deployment bundle (see filter_dir.sh).
+# When the function is run from the repository, it is found in `cloud_functions/`.
+if not os.path.isdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'common')):
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from common import clients
+from common import content_index
+from common import tables
+from common import instrumentation
+from common import mover
+from common import profiling
+from common import publishing
+from common import validator
+from common.instrumentation import span
 
 # This dictionary gives your the requirements and the specifications of the kind
 # of files you can receive. 
 #     - the keys are the names of the files
 #     - the values give the required extension for each file 
+# It comes from the table registry shared with the dispatcher (common/tables.py).
 
-FILES_AND_EXTENSION_SPEC = {
-    'store': 'csv',
-    'customer': 'csv',
-    'basket': 'json'
-}
+FILES_AND_EXTENSION_SPEC = tables.FILES_AND_EXTENSION_SPEC
 
 def verifier_nom_fichier(nom_fichier):
-    # Séparer le nom et l'extension
+    # Séparer le nom et l'extension (suivie éventuellement de .gz)
     if '.' not in nom_fichier:
         return False, "Le nom du fichier doit contenir une extension." ,"",""
 
-    nom_sans_extension, extension = nom_fichier.rsplit('.', 1)
+    nom_sans_extension, extension, compression = tables.split_file_name(nom_fichier)
 
     # Vérifier que le nom comporte 2 parties séparées par _
     parties = nom_sans_extension.split('_')
@@ -51,6 +62,8 @@ def verifier_nom_fichier(nom_fichier):
 
 
 
+@profiling.profiled
+@instrumentation.instrumented
 def check_file_format(event: dict, context: dict):
     """
     Triggered by a change to a Cloud Storage bucket.
@@ -63,18 +76,35 @@ def check_file_format(event: dict, context: dict):
          context (google.cloud.functions.Context): Metadata for the event.
     """
 
-    # rename the variable to be more specific and write it to the logs
+    # rename the variable to be more specific
     blob_event = event
-    print(f'     ***************                 Start Processing blob: {blob_event["name"]}   : {datetime.now().strftime("%H:%M:%S.%f")[:-4]}')
 
     # get the bucket name and the blob path
     bucket_name = blob_event['bucket']
     blob_path = blob_event['name']
+    # generation of this upload, the moves only touch this one
+    generation = int(blob_event['generation']) if blob_event.get('generation') else None
+    instrumentation.set_attribute('blob_path', blob_path)
 
     # get the subfolder, the file name and its extension
     *subfolder, file = blob_path.split(os.sep)  
     subfolder =  os.path.join(*subfolder) if subfolder != [] else ''
-    file_name, file_extention = file.split('.') 
+
+    # Check if the file is in the subfolder `input/` to avoid infinite loop.
+    # The archive/, reject/ and invalid/ files written by the pipeline itself
+    # end here: nothing else is done for them (no SDK import, no client).
+    if subfolder != 'input':
+        print(f'{blob_path} ignored: file must be in `input/` subfolder to be processed')
+        instrumentation.set_attribute('outcome', 'ignored')
+        return
+
+    # the files uploaded by tools/backfill.py are published by the backfill itself
+    if (blob_event.get('metadata') or {}).get('backfill'):
+        print(f'{blob_path} ignored: uploaded by the backfill')
+        instrumentation.set_attribute('outcome', 'backfill')
+        return
+
+    file_name, file_extention, compression = tables.split_file_name(file)
 
     print(f'Bucket name: {bucket_name}')
     print(f'File path: {blob_path}')
@@ -82,9 +112,7 @@ def check_file_format(event: dict, context: dict):
     print(f'Full file name: {file}')
     print(f'File name: {file_name}')
     print(f'File Extension: {file_extention}')
-
-    # Check if the file is in the subfolder `input/` to avoid infinite loop
-    assert subfolder == 'input', 'File must be in `input/ subfolder to be processed`'
+    print(f'Compression: {compression}')
     
     # check if the file name has the good format
     # required format: <table_name>_<date>.<extension>
@@ -96,40 +124,119 @@ def check_file_format(event: dict, context: dict):
         #     - the second part is required to be a 'YYYYMMDD'-formatted date 
         #     - required to have the expected extension
 
-        valide, message, part_one ,part_two = verifier_nom_fichier(file)
+        with span('validate'):
+            valide, message, part_one ,part_two = verifier_nom_fichier(file)
         #print(f"{part_one}: {message}")
         if not valide:
             print(f"{part_one}: {message}")
+            instrumentation.set_attribute('outcome', 'invalid_name')
             return
             raise Exception(message)
 
         table_name = part_one
+        instrumentation.set_attribute('table_name', table_name)
+
+        # a content already loaded into the partition of its date (same MD5) is archived right away,
+        # an unchanged snapshot of another date is published: the dispatcher copies its partition
+        force_load = content_index.forced(blob_event.get('metadata'))
+        if content_index.index_enabled() and not force_load:
+            with span('dedup'):
+                loaded = content_index.find_loaded(table_name, blob_event.get('md5Hash'), blob_event.get('crc32c'),
+                                                   blob_event.get('size'), part_two)
+            if loaded is not None and loaded.get('file_date') == part_two:
+                print(f"{blob_path}: contenu identique à {loaded['blob_path']}, déjà chargé, archivé sans chargement")
+                move_to_archive_folder(bucket_name, blob_path, generation)
+                instrumentation.add_metric('duplicates_skipped', 1)
+                instrumentation.set_attribute('outcome', 'duplicate')
+                return
+
+        # check the content before paying for a message, a load job and the moves
+        if validator.validation_enabled():
+            with span('validate_content'):
+                report = validate_file_content(table_name, bucket_name, blob_path, compression)
+            if validator.rejected(report):
+                print(f'{blob_path}: contenu invalide\n{report}')
+                move_to_invalid_file_folder(bucket_name, blob_path, generation)
+                instrumentation.set_attribute('outcome', 'invalid_content')
+                return
+            print(f'{blob_path}: {report}')
 
         # if all checks are succesful then publish it to the PubSub topic
+        batch = publishing.PublishBatch()
         publish_to_pubsub(
             data=table_name.encode('utf-8'),
             attributes={
                 'bucket_name': bucket_name, 
-                'blob_path': blob_path
-            }
+                'blob_path': blob_path,
+                # the raw tables are partitioned on the date of the file
+                'file_date': part_two,
+                **({content_index.FORCE_ATTRIBUTE: 'true'} if force_load else {}),
+            },
+            batch=batch,
+            # a message which cannot be published after the retries
+            on_failure=lambda error: move_to_invalid_file_folder(bucket_name, blob_path, generation),
+            # still in flight at the deadline, it may be published: the file stays in input/
+            on_unknown=lambda: print(f'[WARNING] {blob_path}: publication incertaine, fichier laissé dans input/'),
         )
 
+        # wait for the message once, at the end of the invocation
+        with span('publish'):
+            summary = batch.flush()
+        if summary['failed']:
+            instrumentation.set_attribute('outcome', 'publish_failed')
+        elif summary['unknown']:
+            instrumentation.set_attribute('outcome', 'publish_unknown')
+        else:
+            instrumentation.set_attribute('outcome', 'published')
+
     except Exception as e:
         print(e)
         # the file is moved to the invalid/ folder if one check is failed
-        move_to_invalid_file_folder(bucket_name, blob_path)
+        move_to_invalid_file_folder(bucket_name, blob_path, generation)
+        instrumentation.set_attribute('outcome', 'invalid')
+
 
-    print(f'     ***************                 End   Processing blob: {blob_event["name"]}   : {datetime.now().strftime("%H:%M:%S.%f")[:-4]}')    
 
+def validate_file_content(table_name: str, bucket_name: str, blob_path: str, compression: str = None):
+    """
+    Stream the file and check its content against the raw schema of its table.
+
+    Args:
+         table_name (str): Name of the table of the file.
+         bucket_name (str): Bucket name of the file.
+         blob_path (str): Path of the blob inside the bucket.
+         compression (str): 'gz' if the file is gzipped, else None.
+
+    Returns:
+         validator.ValidationReport: The rows read and the first errors found,
+                                     the rows in error with the quarantine.
+    """
+    storage_client = clients.storage_client()
+    blob = storage_client.bucket(bucket_name).blob(blob_path)
+    if validator.quarantine_enabled():
+        # the dispatcher loads the file without its bad rows, up to the same limit
+        return validator.validate_blob(table_name, blob, max_errors_count=int(os.environ['quarantine_max_bad_rows']),
+                                       compression=compression, keep_rows=True)
+    return validator.validate_blob(table_name, blob, compression=compression)
 
 
-def publish_to_pubsub(data: bytes, attributes: dict):
+def publish_to_pubsub(data: bytes, attributes: dict, batch: publishing.PublishBatch = None, on_failure=None,
+                      on_unknown=None):
     """
     Publish a message to the pubsub topic to insert the file.
 
+    The message is added to `batch` without waiting for its result: the
+    caller flushes the batch once, at the end of the invocation. Without a
+    batch, the message is published and waited for right away.
+
     Args:
          data (bytes): Encoded string as data for the message.
          attributes (dict): Custom attributes for the message.
+         batch (publishing.PublishBatch): Batch of the invocation.
+         on_failure (callable): `on_failure(error)` if the message cannot be
+                                published after the retries.
+         on_unknown (callable): `on_unknown()` if the message is still in
+                                flight when the flush gives up waiting.
     """
     ## this small part is here to be able to simulate the function but
     ## remove this part when you are ready to deploy your Cloud Function. 
@@ -154,24 +261,32 @@ def publish_to_pubsub(data: bytes, attributes: dict):
         raise ValueError("La variable d'environnement 'topic_id' n'est pas définie.")
     print(f'     topic_id: {topic_id}')
     
-    # connect to the PubSub client
-    publisher = pubsub_v1.PublisherClient()
+    # get the shared PubSub client
+    publisher = clients.publisher_client()
 
-    # publish your message to the topic
+    # publish your message to the topic, the result comes in the callback
     topic_path = publisher.topic_path(project_id, topic_id)
-    future = publisher.publish(topic_path, data, **attributes)
-
-    future.result()  # Bloque jusqu'à ce que le message soit publié
-    print(f"Message publié avec ID : {future.result()}")
-    print(f'Published messages with custom attributes to {topic_path}.')
-
-def move_to_invalid_file_folder(bucket_name: str, blob_path: str):
+    flush_now = batch is None
+    batch = batch or publishing.PublishBatch()
+    batch.publish(
+        topic_path, data, attributes,
+        on_success=lambda message_id: print(f'Message publié avec ID : {message_id}'),
+        on_failure=on_failure,
+        on_unknown=on_unknown,
+    )
+    if flush_now:
+        with span('publish'):
+            batch.flush()
+
+def move_to_invalid_file_folder(bucket_name: str, blob_path: str, generation: int = None):
     """
     Move an invalid file from the input/ to the invalid/ subfolder.
 
     Args:
          bucket_name (str): Bucket name of the file.
          blob_path (str): Path of the blob inside the bucket.
+         generation (int): Generation of the file from the event, so a newer
+                           upload of the same name is never moved.
     """
 
     ## this small part is here to be able to simulate the function but
@@ -182,20 +297,24 @@ def move_to_invalid_file_folder(bucket_name: str, blob_path: str):
     #print(f'     blob_path: {blob_path}')
     #return
     ## [end simulation]
-        
-    # connect to the Cloud Storage client
-    storage_client = storage.Client()
-
-    # move the file to the invalid/ subfolder
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-    new_blob_path = blob_path.replace('input', 'invalid')
-    try:
-        bucket.rename_blob(blob, new_blob_path)
-        print(f'{blob.name} moved to {new_blob_path}')
-    except Exception as e:
-            print(e)
-            # the file is moved to the invalid/ folder if one check is failed
+
+    # move the file to the invalid/ subfolder (copy then delete of this generation)
+    with span('move'):
+        mover.move_blobs(bucket_name, [(blob_path, 'invalid', generation)])
+
+
+def move_to_archive_folder(bucket_name: str, blob_path: str, generation: int = None):
+    """
+    Move a file whose content is already loaded from the input/ to the
+    archive/ subfolder.
+
+    Args:
+         bucket_name (str): Bucket name of the file.
+         blob_path (str): Path of the blob inside the bucket.
+         generation (int): Generation of the file from the event.
+    """
+    with span('move'):
+        mover.move_blobs(bucket_name, [(blob_path, 'archive', generation)])
 
 
 
@@ -0,0 +1,7 @@
+"""
+Code shared by the Cloud Functions of the pipeline.
+
+This folder is copied next to each function's `main.py` when the deployment
+bundle is built (see `filter_dir.sh`), so the functions import it as the
+`common` package.
+"""
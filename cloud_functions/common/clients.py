@@ -0,0 +1,178 @@
+"""
+Registry of the GCP clients used by the Cloud Functions.
+
+Building a client is expensive: it resolves the credentials, opens a new
+HTTP session (or a gRPC channel) and pays a TLS handshake on its first call.
+The clients are therefore built once per function instance, on first use,
+and reused by every helper and every warm invocation of the instance.
+
+The HTTP based clients (Cloud Storage, BigQuery) share one authorized
+session whose connection pool is sized with the `http_pool_size` environment
+variable. The gRPC based clients (Pub/Sub, Workflows, BigQuery Storage Write) keep their own channel,
+which is reused as long as the client is.
+
+The publisher gathers the messages in batches sent when they reach
+`pubsub_batch_max_messages` messages, `pubsub_batch_max_bytes` bytes or
+`pubsub_batch_max_latency` seconds (see `publishing.py`). With
+`pubsub_message_ordering`, the messages of an ordering key are sent in order.
+
+Tests (or the local harness) can inject fakes with `set_client` and go back
+to the real clients with `reset_clients`.
+"""
+import os
+import threading
+
+STORAGE = 'storage'
+BIGQUERY = 'bigquery'
+PUBLISHER = 'publisher'
+EXECUTIONS = 'executions'
+BIGQUERY_WRITE = 'bigquery_write'
+
+DEFAULT_HTTP_POOL_SIZE = 32
+DEFAULT_PUBSUB_BATCH_MAX_MESSAGES = 100
+DEFAULT_PUBSUB_BATCH_MAX_BYTES = 1000 * 1000
+DEFAULT_PUBSUB_BATCH_MAX_LATENCY = 0.01
+CLOUD_PLATFORM_SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
+
+_lock = threading.RLock()
+_clients = {}
+_http_session = None
+
+
+def _project_id():
+    return os.environ.get('GCP_PROJECT')
+
+
+def _authorized_session():
+    """
+    Return the HTTP session shared by the Cloud Storage and BigQuery clients.
+    """
+    global _http_session
+
+    with _lock:
+        if _http_session is None:
+            import google.auth
+            from google.auth.transport.requests import AuthorizedSession
+            from requests.adapters import HTTPAdapter
+
+            credentials, _ = google.auth.default(scopes=[CLOUD_PLATFORM_SCOPE])
+            pool_size = int(os.environ.get('http_pool_size', DEFAULT_HTTP_POOL_SIZE))
+
+            session = AuthorizedSession(credentials)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            _http_session = session
+
+    return _http_session
+
+
+def _build_storage_client():
+    from google.cloud import storage
+    return storage.Client(project=_project_id(), _http=_authorized_session())
+
+
+def _build_bigquery_client():
+    from google.cloud import bigquery
+    return bigquery.Client(project=_project_id(), _http=_authorized_session())
+
+
+def pubsub_batch_max_messages() -> int:
+    return int(os.environ.get('pubsub_batch_max_messages', DEFAULT_PUBSUB_BATCH_MAX_MESSAGES))
+
+
+def _build_publisher_client():
+    from google.cloud import pubsub_v1
+
+    batch_settings = pubsub_v1.types.BatchSettings(
+        max_messages=pubsub_batch_max_messages(),
+        max_bytes=int(os.environ.get('pubsub_batch_max_bytes', DEFAULT_PUBSUB_BATCH_MAX_BYTES)),
+        max_latency=float(os.environ.get('pubsub_batch_max_latency', DEFAULT_PUBSUB_BATCH_MAX_LATENCY)),
+    )
+    publisher_options = pubsub_v1.types.PublisherOptions(
+        enable_message_ordering=os.environ.get('pubsub_message_ordering', 'false').lower() == 'true',
+    )
+    return pubsub_v1.PublisherClient(batch_settings=batch_settings, publisher_options=publisher_options)
+
+
+def _build_executions_client():
+    from google.cloud.workflows.executions_v1 import ExecutionsClient
+    return ExecutionsClient()
+
+
+def _build_bigquery_write_client():
+    from google.cloud import bigquery_storage_v1
+    return bigquery_storage_v1.BigQueryWriteClient()
+
+
+_BUILDERS = {
+    STORAGE: _build_storage_client,
+    BIGQUERY: _build_bigquery_client,
+    PUBLISHER: _build_publisher_client,
+    EXECUTIONS: _build_executions_client,
+    BIGQUERY_WRITE: _build_bigquery_write_client,
+}
+
+
+def get_client(name: str):
+    """
+    Return the client registered under `name`, building it on first use.
+
+    Args:
+         name (str): One of STORAGE, BIGQUERY, PUBLISHER, EXECUTIONS or BIGQUERY_WRITE.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                if name not in _BUILDERS:
+                    raise KeyError(f'Unknown client {name}. Known clients are: {", ".join(_BUILDERS)}.')
+                client = _BUILDERS[name]()
+                _clients[name] = client
+    return client
+
+
+def storage_client():
+    return get_client(STORAGE)
+
+
+def bigquery_client():
+    return get_client(BIGQUERY)
+
+
+def publisher_client():
+    return get_client(PUBLISHER)
+
+
+def executions_client():
+    return get_client(EXECUTIONS)
+
+
+def bigquery_write_client():
+    return get_client(BIGQUERY_WRITE)
+
+
+def set_client(name: str, client):
+    """
+    Register `client` under `name` instead of building the real one.
+    Used by the tests and the local harness to inject fakes.
+
+    Args:
+         name (str): One of STORAGE, BIGQUERY, PUBLISHER, EXECUTIONS or BIGQUERY_WRITE.
+         client: The object returned by `get_client(name)` from now on.
+    """
+    if name not in _BUILDERS:
+        raise KeyError(f'Unknown client {name}. Known clients are: {", ".join(_BUILDERS)}.')
+    with _lock:
+        _clients[name] = client
+
+
+def reset_clients():
+    """
+    Forget every registered client (real or fake) and the shared HTTP session.
+    """
+    global _http_session
+
+    with _lock:
+        _clients.clear()
+        _http_session = None
@@ -0,0 +1,164 @@
+"""
+Index of the file contents already loaded, to skip the duplicates.
+
+The finalize events and the Pub/Sub messages are delivered at least once, and
+many daily snapshots (`store_*.csv`) are byte-identical to the day before.
+When `content_index` is 'true', every file loaded into a raw table is recorded
+under `state/content_index/<table>/<key>.json` in the utils bucket, where the
+key is the MD5 of the content given by Cloud Storage (or its CRC32C and size
+for the composite objects, which have no MD5), and so is the content of its
+partition (`state/content_index/<table>/dates/<YYYYMMDD>.json`). Then:
+    - `check_file_format` archives a file whose content is already in the
+      partition of its date, without publishing it;
+    - `receive_messages` does the same for a message delivered again, so the
+      file is archived without a load job or a workflow execution.
+
+An unchanged snapshot of another date is not loaded either: the trigger
+publishes it and `receive_messages` copies the partition of the date last
+loaded with this content to the partition of the snapshot (a copy job, free,
+instead of a load job), so every date keeps its rows. The cleaned tables are
+the same, no workflow is requested. An entry whose partition was loaded
+since with another content is not used.
+
+An entry older than `content_index_ttl` seconds (unset: never) is not used:
+the file is loaded again and the entry replaced. A file uploaded with the
+`force_load: true` metadata (`gsutil -h x-goog-meta-force_load:true cp ...`),
+or published by the backfill with `--force`, is loaded whatever the index
+says: the message carries a `force_load` attribute.
+"""
+import base64
+import binascii
+import os
+import time
+
+from common import instrumentation
+from common import state_store
+
+INDEX_PREFIX = 'content_index/'
+FORCE_ATTRIBUTE = 'force_load'
+
+
+def index_enabled() -> bool:
+    return os.environ.get('content_index', 'false').lower() == 'true'
+
+
+def forced(values: dict) -> bool:
+    """
+    True if the metadata of a file or the attributes of its message ask to
+    load it whatever the index says.
+    """
+    return str((values or {}).get(FORCE_ATTRIBUTE, '')).lower() == 'true'
+
+
+def _hex(base64_hash: str) -> str:
+    return binascii.hexlify(base64.b64decode(base64_hash)).decode('ascii')
+
+
+def content_key(md5_hash: str = None, crc32c: str = None, size: int = None):
+    """
+    Key of a content in the index.
+
+    Args:
+         md5_hash (str): Base64 MD5 of the object (`md5Hash` of the event).
+         crc32c (str): Base64 CRC32C of the object (`crc32c` of the event).
+         size (int): Size of the object in bytes.
+
+    Returns:
+         str: `md5-<hex>` or `crc32c-<hex>-<size>`, None without any hash.
+    """
+    if md5_hash:
+        return f'md5-{_hex(md5_hash)}'
+    if crc32c and size is not None:
+        return f'crc32c-{_hex(crc32c)}-{int(size)}'
+    return None
+
+
+def _path(table_name: str, key: str) -> str:
+    return f'{INDEX_PREFIX}{table_name}/{key}.json'
+
+
+def _date_path(table_name: str, file_date: str) -> str:
+    return f'{INDEX_PREFIX}{table_name}/dates/{file_date}.json'
+
+
+def find_loaded(table_name: str, md5_hash: str = None, crc32c: str = None, size: int = None,
+                file_date: str = None, now: float = None):
+    """
+    Entry of the index for a content already loaded into a table, younger
+    than `content_index_ttl`: the one of the `file_date` partition if it holds
+    this content, else the one of the partition loaded last with it, if it
+    still holds it.
+
+    Args:
+         table_name (str): Name of the table of the file.
+         md5_hash, crc32c, size: Hashes and size of the file (see `content_key`).
+         file_date (str): YYYYMMDD date of the file name.
+         now (float): Current time, `time.time()` by default.
+
+    Returns:
+         dict: The file loaded with this content, its `file_date` the one of
+               the partition which holds it, None if there is none.
+    """
+    key = content_key(md5_hash, crc32c, size)
+    if key is None:
+        return None
+    ttl = os.environ.get('content_index_ttl')
+    now = now or time.time()
+
+    def fresh(document):
+        return document is not None and not (ttl and now - document['loaded_at'] > float(ttl))
+
+    if file_date:
+        # a message delivered again, or the same day uploaded again
+        partition, _ = state_store.read_document(_date_path(table_name, file_date))
+        if fresh(partition) and partition['key'] == key:
+            return partition
+    document, _ = state_store.read_document(_path(table_name, key))
+    if not fresh(document):
+        return None
+    if document.get('file_date'):
+        if document['file_date'] == file_date:
+            # its partition holds another content now, read above
+            return None
+        # the partition may have been loaded since with another content
+        partition, _ = state_store.read_document(_date_path(table_name, document['file_date']))
+        if partition is None or partition['key'] != key:
+            return None
+    return document
+
+
+def record_loaded(table_name: str, blob_path: str, md5_hash: str = None, crc32c: str = None, size: int = None,
+                  file_date: str = None):
+    """
+    Record a file loaded (or copied) into a table: the entry of its content
+    is replaced, the TTL runs from now, and its partition is recorded with
+    this content. A failure is only reported: the load itself succeeded.
+
+    Args:
+         table_name (str): Name of the table the file was loaded into.
+         blob_path (str): Path of the blob inside the landing bucket.
+         md5_hash, crc32c, size: Hashes and size of the file (see `content_key`).
+         file_date (str): YYYYMMDD date of the file name.
+    """
+    key = content_key(md5_hash, crc32c, size)
+    if key is None:
+        print(f'[WARNING] {blob_path}: ni MD5 ni CRC32C, non indexé')
+        return
+    document = {
+        'table_name': table_name,
+        'blob_path': blob_path,
+        'file_date': file_date,
+        'size': size,
+        'md5_hash': md5_hash,
+        'crc32c': crc32c,
+        'loaded_at': time.time(),
+    }
+    try:
+        if file_date:
+            state_store.write_document(_date_path(table_name, file_date), {**document, 'key': key})
+        state_store.write_document(_path(table_name, key), document)
+    except Exception as e:
+        # the file is loaded all the same, it is only not skipped next time
+        print(f'[WARNING] {blob_path} non indexé : {e}')
+        return
+    instrumentation.add_metric('contents_indexed', 1)
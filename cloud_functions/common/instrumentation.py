@@ -0,0 +1,202 @@
+"""
+Lightweight instrumentation of the function invocations.
+
+An entry point decorated with `instrumented` records, for each invocation:
+    - the timed spans of its stages (`with span('load'): ...`), as a count
+      and a total duration per stage;
+    - the number of calls made to each GCP API (`count_call('gcs')`);
+    - metrics such as the bytes and rows loaded (`add_metric('rows_loaded', n)`);
+    - a few attributes (`set_attribute('table_name', ...)`);
+and hands one record per invocation to the exporter.
+
+The default exporter prints the record as one JSON line, which Cloud Logging
+turns into a structured log entry. `InMemoryExporter` keeps the records in
+a list for the tests and the benchmarks. Any object with an `export(record)`
+method can be set with `set_exporter`.
+
+Outside of an instrumented invocation, the helpers do nothing. To count the
+calls made from worker threads, run the work in a copy of the invocation
+context (`contextvars.copy_context().run`).
+"""
+import contextvars
+import functools
+import json
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+
+GCS = 'gcs'
+BIGQUERY = 'bigquery'
+PUBSUB = 'pubsub'
+WORKFLOWS = 'workflows'
+
+
+class LogExporter:
+    """
+    Print each record as a JSON line (structured log in Cloud Logging).
+    """
+
+    def export(self, record: dict):
+        print(json.dumps({
+            'severity': 'ERROR' if record['status'] == 'error' else 'INFO',
+            'message': f"{record['function']} {record['status']} in {record['duration_ms']:.1f} ms",
+            'invocation': record,
+        }, default=str))
+
+
+class InMemoryExporter:
+    """
+    Keep each record in `records`.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def export(self, record: dict):
+        self.records.append(record)
+
+    def clear(self):
+        self.records.clear()
+
+
+class NullExporter:
+    """
+    Drop the records.
+    """
+
+    def export(self, record: dict):
+        pass
+
+
+_exporter = LogExporter()
+_current = contextvars.ContextVar('instrumentation_invocation', default=None)
+# the record of an invocation can be updated by its worker threads
+_update_lock = threading.Lock()
+
+
+def set_exporter(exporter):
+    """
+    Set the exporter of the invocation records.
+
+    Args:
+         exporter: Object with an `export(record: dict)` method.
+    """
+    global _exporter
+    _exporter = exporter
+
+
+def get_exporter():
+    return _exporter
+
+
+class _Invocation:
+
+    def __init__(self, function_name: str):
+        self.record = {
+            'function': function_name,
+            'invocation_id': uuid.uuid4().hex,
+            'status': 'ok',
+            'duration_ms': 0.0,
+            'spans': {},
+            'api_calls': {},
+            'metrics': {},
+            'attributes': {},
+        }
+
+    def add_span(self, name: str, duration_ms: float):
+        with _update_lock:
+            span_record = self.record['spans'].setdefault(name, {'count': 0, 'total_ms': 0.0})
+            span_record['count'] += 1
+            span_record['total_ms'] += duration_ms
+
+
+@contextmanager
+def invocation(function_name: str, **attributes):
+    """
+    Record an invocation and export it when it ends.
+
+    Args:
+         function_name (str): Name of the entry point.
+         attributes: First attributes of the record.
+    """
+    current = _Invocation(function_name)
+    current.record['attributes'].update(attributes)
+    token = _current.set(current)
+    start = time.perf_counter()
+    try:
+        yield current.record
+    except Exception as e:
+        current.record['status'] = 'error'
+        current.record['error'] = repr(e)
+        raise
+    finally:
+        current.record['duration_ms'] = (time.perf_counter() - start) * 1000
+        _current.reset(token)
+        _exporter.export(current.record)
+
+
+def instrumented(function):
+    """
+    Decorator recording each call of a Cloud Function entry point as an
+    invocation named after the function.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with invocation(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def span(name: str):
+    """
+    Time a stage of the current invocation.
+
+    Args:
+         name (str): Name of the stage (validate, publish, schema_fetch, load,
+                     move, trigger, ...).
+    """
+    current = _current.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if current is not None:
+            current.add_span(name, (time.perf_counter() - start) * 1000)
+
+
+def count_call(service: str, count: int = 1):
+    """
+    Count calls made to a GCP API by the current invocation.
+
+    Args:
+         service (str): GCS, BIGQUERY, PUBSUB or WORKFLOWS.
+         count (int): Number of calls.
+    """
+    current = _current.get()
+    if current is not None:
+        with _update_lock:
+            api_calls = current.record['api_calls']
+            api_calls[service] = api_calls.get(service, 0) + count
+
+
+def add_metric(name: str, value):
+    """
+    Add a value to a metric of the current invocation (bytes_loaded, ...).
+    """
+    current = _current.get()
+    if current is not None:
+        with _update_lock:
+            metrics = current.record['metrics']
+            metrics[name] = metrics.get(name, 0) + (value or 0)
+
+
+def set_attribute(name: str, value):
+    """
+    Set an attribute of the current invocation (table_name, blob_path, ...).
+    """
+    current = _current.get()
+    if current is not None:
+        current.record['attributes'][name] = value
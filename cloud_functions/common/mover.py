@@ -0,0 +1,135 @@
+"""
+Moves of the landing files out of `input/` (to archive/, reject/, invalid/).
+
+A move is a copy followed by a delete of the source. Both are conditioned on
+the generation of the source, so a move retried after a new upload of the
+same file name neither archives nor deletes the new upload: it is reported
+as a conflict and the new file stays in `input/` for its own event.
+
+Many files are moved in parallel by a bounded pool of `move_workers`
+threads, sharing the HTTP connections of the storage client, and each move
+is reported separately.
+"""
+import contextvars
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from common import clients
+from common import instrumentation
+
+INPUT_PREFIX = 'input/'
+DEFAULT_WORKERS = 8
+
+MOVED = 'moved'
+ALREADY_MOVED = 'already_moved'
+CONFLICT = 'conflict'
+MISSING = 'missing'
+ERROR = 'error'
+
+
+def destination_path(blob_path: str, subfolder: str) -> str:
+    """
+    Path of a file of `input/` once moved to another subfolder:
+    `input/store_20220601.csv` -> `archive/store_20220601.csv`.
+
+    Only the `input/` prefix is rewritten, never the rest of the path.
+    """
+    if not blob_path.startswith(INPUT_PREFIX):
+        raise ValueError(f"{blob_path} n'est pas dans le dossier {INPUT_PREFIX}")
+    return f"{subfolder.strip('/')}/{blob_path[len(INPUT_PREFIX):]}"
+
+
+def move_blob(bucket_name: str, blob_path: str, subfolder: str, generation: int = None) -> dict:
+    """
+    Move one file of `input/` to a subfolder.
+
+    Args:
+         bucket_name (str): Bucket name of the file.
+         blob_path (str): Path of the blob inside the bucket.
+         subfolder (str): Subfolder where to move the file.
+         generation (int): Generation of the file to move (from the event).
+                           None reads the current one.
+
+    Returns:
+         dict: `blob_path`, `destination`, `status` (moved, already_moved,
+               conflict, missing or error) and `error`.
+    """
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+
+    result = {'blob_path': blob_path, 'destination': None, 'status': None, 'error': None}
+    try:
+        result['destination'] = destination_path(blob_path, subfolder)
+        bucket = clients.storage_client().bucket(bucket_name)
+
+        if generation is None:
+            instrumentation.count_call(instrumentation.GCS)
+            source = bucket.get_blob(blob_path)
+            if source is None:
+                result['status'] = MISSING
+                return result
+            generation = source.generation
+        else:
+            source = bucket.blob(blob_path)
+
+        try:
+            instrumentation.count_call(instrumentation.GCS)
+            bucket.copy_blob(source, bucket, result['destination'], if_source_generation_match=generation)
+        except NotFound:
+            # an earlier attempt already copied and deleted it
+            instrumentation.count_call(instrumentation.GCS)
+            result['status'] = ALREADY_MOVED if bucket.get_blob(result['destination']) is not None else MISSING
+            return result
+        except PreconditionFailed:
+            result['status'] = CONFLICT
+            return result
+
+        try:
+            instrumentation.count_call(instrumentation.GCS)
+            source.delete(if_generation_match=generation)
+        except NotFound:
+            pass
+        except PreconditionFailed:
+            # uploaded again meanwhile: the new upload stays in input/
+            result['status'] = CONFLICT
+            return result
+        result['status'] = MOVED
+
+    except Exception as e:
+        result['status'] = ERROR
+        result['error'] = repr(e)
+    return result
+
+
+def move_blobs(bucket_name: str, moves: list, workers: int = None) -> list:
+    """
+    Move many files of `input/` in parallel.
+
+    Args:
+         bucket_name (str): Bucket name of the files.
+         moves (list): (blob_path, subfolder) or (blob_path, subfolder,
+                       generation) tuples.
+         workers (int): Maximum number of parallel moves, `move_workers`
+                        by default.
+
+    Returns:
+         list: The result of each move (see `move_blob`), in the order of
+               `moves`.
+    """
+    if not moves:
+        return []
+    workers = workers or int(os.environ.get('move_workers', DEFAULT_WORKERS))
+    if len(moves) == 1 or workers <= 1:
+        results = [move_blob(bucket_name, *move) for move in moves]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(moves))) as pool:
+            # each worker counts its calls in the current invocation
+            futures = [pool.submit(contextvars.copy_context().run, move_blob, bucket_name, *move) for move in moves]
+            results = [future.result() for future in futures]
+
+    for result in results:
+        if result['status'] == MOVED:
+            print(f"{result['blob_path']} moved to {result['destination']}")
+        else:
+            print(f"[WARNING] {result['blob_path']} not moved to {result['destination']}: {result['status']} {result['error'] or ''}")
+    return results
@@ -0,0 +1,161 @@
+"""
+Opt-in profiling of the function invocations.
+
+The spans of `instrumentation.py` tell which stage of an invocation is slow,
+not which code inside it (client construction, schema download,
+`load_job.result()`, the polling of the workflow ...). When
+`profile_sample_rate` is set (for example '0.05'), an entry point decorated
+with `profiled` runs a sample of its invocations under `cProfile` and
+`tracemalloc`, then writes two compressed snapshots:
+    - `<function>/<time>_<id>.pstats.gz`: the cProfile statistics (marshal
+      format of `pstats`);
+    - `<function>/<time>_<id>.tracemalloc.gz`: the `tracemalloc.Snapshot` of
+      the memory allocated during the invocation and still held at its end,
+      with `profile_traceback_frames` frames per allocation (10 by default);
+under `profile_output`: a local directory (`/tmp/profiles` by default, the
+only writable place of a Cloud Function) or a `gs://bucket/prefix`.
+
+`tools/profile_report.py` aggregates many snapshots into a report of the hot
+functions and of the lines which allocate the most.
+
+The snapshots are written after the invocation, outside of its record, and a
+failure to write them is only reported. Without `profile_sample_rate`, the
+decorator only reads the environment variable.
+
+tracemalloc traces the whole process, while the asyncio dispatcher (see
+`async_dispatcher.py`) runs many invocations at once in its threads: the
+sampled invocations share the tracing, started by the first one and stopped
+when the last one ends, and the memory snapshot of an invocation which
+overlapped others also holds their allocations (reported when written).
+"""
+import cProfile
+import functools
+import gzip
+import marshal
+import os
+import pickle
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+
+DEFAULT_OUTPUT = '/tmp/profiles'
+DEFAULT_TRACEBACK_FRAMES = 10
+PSTATS_SUFFIX = '.pstats.gz'
+TRACEMALLOC_SUFFIX = '.tracemalloc.gz'
+
+
+# sampled invocations running, which share the tracing of tracemalloc
+_tracing_lock = threading.Lock()
+_tracing_calls = 0
+_tracing_started = False
+
+
+def sample_rate() -> float:
+    return float(os.environ.get('profile_sample_rate') or 0)
+
+
+def _output() -> str:
+    return os.environ.get('profile_output') or DEFAULT_OUTPUT
+
+
+def write_snapshot(path: str, data: bytes):
+    """
+    Write a compressed snapshot to `profile_output`.
+
+    Args:
+         path (str): Path of the snapshot under the output.
+         data (bytes): Content of the snapshot, not compressed.
+    """
+    data = gzip.compress(data)
+    output = _output()
+    if output.startswith('gs://'):
+        from common import clients
+
+        bucket_name, _, prefix = output[len('gs://'):].partition('/')
+        blob_path = f"{prefix.strip('/')}/{path}" if prefix.strip('/') else path
+        clients.storage_client().bucket(bucket_name).blob(blob_path).upload_from_string(
+            data, content_type='application/gzip')
+    else:
+        file_path = os.path.join(output, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as snapshot_file:
+            snapshot_file.write(data)
+
+
+def _write_snapshots(function_name: str, profiler: cProfile.Profile, snapshot):
+    name = f"{function_name}/{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}_{uuid.uuid4().hex[:8]}"
+    profiler.create_stats()
+    write_snapshot(name + PSTATS_SUFFIX, marshal.dumps(profiler.stats))
+    if snapshot is not None:
+        write_snapshot(name + TRACEMALLOC_SUFFIX, pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+    print(f'     profile {name} written to {_output()}')
+
+
+def _start_tracing() -> bool:
+    """
+    Start tracemalloc for a sampled invocation, unless it is already on.
+
+    Returns:
+         bool: True if other sampled invocations are running.
+    """
+    global _tracing_calls, _tracing_started
+
+    with _tracing_lock:
+        if _tracing_calls == 0:
+            # tracemalloc may already be tracing (python -X tracemalloc): keep it on then
+            _tracing_started = not tracemalloc.is_tracing()
+            if _tracing_started:
+                tracemalloc.start(int(os.environ.get('profile_traceback_frames', DEFAULT_TRACEBACK_FRAMES)))
+        _tracing_calls += 1
+        return _tracing_calls > 1
+
+
+def _stop_tracing():
+    """
+    Take the memory snapshot of a sampled invocation, and stop tracemalloc
+    if it is the last one running and started it.
+
+    Returns:
+         (tracemalloc.Snapshot, bool): The snapshot (None if tracemalloc is
+                                       off) and True if other sampled
+                                       invocations are still running.
+    """
+    global _tracing_calls
+
+    with _tracing_lock:
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        _tracing_calls -= 1
+        if _tracing_calls == 0 and _tracing_started:
+            tracemalloc.stop()
+        return snapshot, _tracing_calls > 0
+
+
+def profiled(function):
+    """
+    Decorator profiling a sample of the calls of a Cloud Function entry
+    point (see the module docstring).
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        rate = sample_rate()
+        if rate <= 0 or random.random() >= rate:
+            return function(*args, **kwargs)
+
+        shared = _start_tracing()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.disable()
+            snapshot, still_shared = _stop_tracing()
+            if (shared or still_shared) and snapshot is not None:
+                print(f'[WARNING] profile of {function.__name__}: the memory snapshot also holds the allocations '
+                      f'of the invocations run meanwhile')
+            try:
+                _write_snapshots(function.__name__, profiler, snapshot)
+            except Exception as e:
+                print(f'[WARNING] profile of {function.__name__} not written: {e!r}')
+    return wrapper
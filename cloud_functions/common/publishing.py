@@ -0,0 +1,160 @@
+"""
+Non blocking publication of Pub/Sub messages.
+
+`PublishBatch.publish` hands a message to the shared `PublisherClient` and
+returns at once: the client gathers the messages in batches (see the
+`pubsub_batch_*` settings in `clients.py`) and a completion callback records
+the result of each one. `flush`, called once at the end of the invocation,
+waits for the messages still in flight, publishes again the ones which
+failed (up to `pubsub_publish_retries` times) and hands the ones which still
+fail to their `on_failure` callback, without holding up the others. A message
+still in flight at the deadline is neither published nor failed: its outcome
+is unknown (it may still be published), it is counted apart and handed to its
+`on_unknown` callback, so its caller does not treat it as a failure.
+
+A batch can carry one message (a finalize event) or many (a backfill): they
+then go out in as few publish requests as the batch settings allow. The
+messages of an ordering key (with `pubsub_message_ordering`) keep their
+order: once one fails the client refuses the next ones of the key, and
+`flush` resumes the key before it publishes them again, in order.
+"""
+import math
+import os
+import threading
+import time
+
+from concurrent.futures import Future
+
+from common import clients
+from common import instrumentation
+
+DEFAULT_RETRIES = 2
+DEFAULT_FLUSH_TIMEOUT = 60
+
+
+class PublishBatch:
+    """
+    Messages published by one invocation, waited for together by `flush`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def publish(self, topic_path: str, data: bytes, attributes: dict, on_success=None, on_failure=None,
+                ordering_key: str = None, on_unknown=None):
+        """
+        Publish a message without waiting for its result.
+
+        Args:
+             topic_path (str): Full path of the topic.
+             data (bytes): Data of the message.
+             attributes (dict): Custom attributes of the message.
+             on_success (callable): `on_success(message_id)`, called from the
+                                    publisher thread once it is published.
+             on_failure (callable): `on_failure(error)`, called by `flush` if
+                                    it still fails after the retries.
+             ordering_key (str): Messages delivered in their publication
+                                 order, with `pubsub_message_ordering`.
+             on_unknown (callable): `on_unknown()`, called by `flush` if the
+                                    message is still in flight at its
+                                    deadline.
+        """
+        message = {
+            'topic_path': topic_path,
+            'data': data,
+            'attributes': attributes,
+            'ordering_key': ordering_key,
+            'on_success': on_success,
+            'on_failure': on_failure,
+            'on_unknown': on_unknown,
+            'attempts': 0,
+        }
+        self._send(message)
+
+    def _send(self, message: dict):
+        message['attempts'] += 1
+        options = {'ordering_key': message['ordering_key']} if message['ordering_key'] else {}
+        try:
+            future = clients.publisher_client().publish(message['topic_path'], message['data'], **options,
+                                                        **message['attributes'])
+        except Exception as e:
+            # refused before being sent (too large, ...): it fails like the others
+            future = Future()
+            future.set_exception(e)
+        message['future'] = future
+        if message['on_success'] is not None:
+            def done(published_future):
+                if published_future.exception() is None:
+                    message['on_success'](published_future.result())
+            future.add_done_callback(done)
+        with self._lock:
+            self._pending.append(message)
+
+    def flush(self, timeout: float = None) -> dict:
+        """
+        Wait for every message published so far, retrying the failed ones.
+
+        Args:
+             timeout (float): Maximum wait in seconds, `pubsub_flush_timeout`
+                              by default.
+
+        Returns:
+             dict: Number of messages published, retried, failed and still
+                   in flight at the deadline (`unknown`).
+        """
+        retries = int(os.environ.get('pubsub_publish_retries', DEFAULT_RETRIES))
+        timeout = timeout if timeout is not None else float(os.environ.get('pubsub_flush_timeout', DEFAULT_FLUSH_TIMEOUT))
+        deadline = time.monotonic() + timeout
+        summary = {'published': 0, 'retried': 0, 'failed': 0, 'unknown': 0}
+        # keys with a message given up: their next messages are given up too, never sent out of order
+        abandoned_keys = set()
+
+        while True:
+            with self._lock:
+                messages, self._pending = self._pending, []
+            if not messages:
+                break
+            # the client sends them in batches of at most `pubsub_batch_max_messages`
+            instrumentation.count_call(instrumentation.PUBSUB, math.ceil(len(messages) / clients.pubsub_batch_max_messages()))
+
+            retried = []
+            for message in messages:
+                try:
+                    message['future'].result(timeout=max(0.0, deadline - time.monotonic()))
+                    summary['published'] += 1
+                except Exception as e:
+                    if not message['future'].done():
+                        # the deadline came first: it may still be published, never sent twice
+                        print(f"[WARNING] Publication toujours en cours à l'échéance, issue inconnue | {message['attributes']}")
+                        summary['unknown'] += 1
+                        if message['on_unknown'] is not None:
+                            message['on_unknown']()
+                        continue
+                    key = (message['topic_path'], message['ordering_key']) if message['ordering_key'] else None
+                    if message['attempts'] <= retries and time.monotonic() < deadline and key not in abandoned_keys:
+                        print(f"[WARNING] Publication échouée ({e}), nouvel essai {message['attempts']}/{retries}")
+                        summary['retried'] += 1
+                        retried.append(message)
+                        continue
+                    print(f"[ERROR] Publication abandonnée après {message['attempts']} essai(s) : {e} | {message['attributes']}")
+                    summary['failed'] += 1
+                    if key is not None:
+                        abandoned_keys.add(key)
+                    if message['on_failure'] is not None:
+                        message['on_failure'](e)
+
+            # sent again once the pass is over and in their order, so that a
+            # message never overtakes an earlier one of its key; the keys are
+            # paused by their failure until resumed
+            for topic_path, ordering_key in {(message['topic_path'], message['ordering_key'])
+                                             for message in retried if message['ordering_key']}:
+                clients.publisher_client().resume_publish(topic_path, ordering_key)
+            for message in retried:
+                self._send(message)
+
+        for topic_path, ordering_key in abandoned_keys:
+            # the later messages of the key may be published again by a new batch
+            clients.publisher_client().resume_publish(topic_path, ordering_key)
+        instrumentation.add_metric('messages_published', summary['published'])
+        return summary
@@ -0,0 +1,169 @@
+"""
+Small JSON documents persisted in the utils bucket.
+
+The functions are stateless, so what must outlive an invocation (executions
+to track, pending triggers, ...) is written as one JSON object per document
+under the `state/` prefix of the `<project>_<util_bucket_suffix>` bucket.
+
+Concurrent writers are handled with the object generation: a document is
+only written if it has not changed since it was read (`if_generation_match`),
+else `StateConflict` is raised and `update_document` reads it again.
+"""
+import json
+import os
+
+from common import clients
+from common import instrumentation
+
+STATE_PREFIX = 'state'
+MAX_UPDATE_ATTEMPTS = 10
+
+# returned by the update of `update_document` to delete the document
+DELETE = 'DELETE'
+
+
+class StateConflict(Exception):
+    """
+    The document was changed by someone else since it was read.
+    """
+
+
+def utils_bucket_name() -> str:
+    """
+    Name of the utils bucket built from the environment variables.
+    """
+    project = os.environ.get('GCP_PROJECT')
+    if project is None:
+        raise ValueError("La variable d'environnement 'GCP_PROJECT' n'est pas définie.")
+    util_bucket_suffix = os.environ.get('util_bucket_suffix')
+    if util_bucket_suffix is None:
+        raise ValueError("La variable d'environnement 'util_bucket_suffix' n'est pas définie.")
+    return f'{project}_{util_bucket_suffix}'
+
+
+def _bucket():
+    return clients.storage_client().bucket(utils_bucket_name())
+
+
+def _object_name(path: str) -> str:
+    return f'{STATE_PREFIX}/{path}'
+
+
+def read_document(path: str):
+    """
+    Read a document.
+
+    Args:
+         path (str): Path of the document under the `state/` prefix.
+
+    Returns:
+         (dict, int): The document and its generation, or (None, 0) if it
+                      does not exist.
+    """
+    from google.api_core.exceptions import NotFound
+
+    blob = _bucket().blob(_object_name(path))
+    instrumentation.count_call(instrumentation.GCS)
+    try:
+        content = blob.download_as_bytes()
+    except NotFound:
+        return None, 0
+    return json.loads(content), blob.generation
+
+
+def write_document(path: str, document: dict, generation: int = None) -> int:
+    """
+    Write a document.
+
+    Args:
+         path (str): Path of the document under the `state/` prefix.
+         document (dict): JSON serializable content.
+         generation (int): Generation the document must still have (0 if it
+                           must not exist yet). None writes unconditionally.
+
+    Returns:
+         int: The new generation of the document.
+    """
+    from google.api_core.exceptions import PreconditionFailed
+
+    blob = _bucket().blob(_object_name(path))
+    instrumentation.count_call(instrumentation.GCS)
+    try:
+        blob.upload_from_string(
+            json.dumps(document),
+            content_type='application/json',
+            if_generation_match=generation,
+        )
+    except PreconditionFailed as e:
+        raise StateConflict(f'{path} changed since generation {generation}') from e
+    return blob.generation
+
+
+def update_document(path: str, update):
+    """
+    Read, update and write back a document, again and again until no one else
+    wrote it in the meantime.
+
+    Args:
+         path (str): Path of the document under the `state/` prefix.
+         update (callable): Called with the current document (None if it
+                            does not exist). Returns the new document, None
+                            to leave it unchanged, or `DELETE` to delete it.
+
+    Returns:
+         dict: The document as written (or as read if left unchanged), None
+               if it was deleted.
+    """
+    for _ in range(MAX_UPDATE_ATTEMPTS):
+        document, generation = read_document(path)
+        new_document = update(document)
+        if new_document is None:
+            return document
+        try:
+            if new_document is DELETE:
+                if document is not None:
+                    delete_document(path, generation)
+                return None
+            write_document(path, new_document, generation)
+            return new_document
+        except StateConflict:
+            continue
+    raise StateConflict(f'{path} could not be updated after {MAX_UPDATE_ATTEMPTS} attempts')
+
+
+def delete_document(path: str, generation: int = None):
+    """
+    Delete a document, if it still has the given generation.
+
+    Args:
+         path (str): Path of the document under the `state/` prefix.
+         generation (int): Generation the document must still have.
+                           None deletes unconditionally.
+    """
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+
+    blob = _bucket().blob(_object_name(path))
+    instrumentation.count_call(instrumentation.GCS)
+    try:
+        blob.delete(if_generation_match=generation)
+    except NotFound:
+        pass
+    except PreconditionFailed as e:
+        raise StateConflict(f'{path} changed since generation {generation}') from e
+
+
+def list_documents(prefix: str):
+    """
+    Iterate over the documents under a prefix.
+
+    Args:
+         prefix (str): Prefix of the documents under the `state/` prefix.
+
+    Yields:
+         (str, dict, int): The path, the document and its generation.
+    """
+    instrumentation.count_call(instrumentation.GCS)
+    for blob in clients.storage_client().list_blobs(utils_bucket_name(), prefix=_object_name(prefix)):
+        path = blob.name[len(STATE_PREFIX) + 1:]
+        instrumentation.count_call(instrumentation.GCS)
+        yield path, json.loads(blob.download_as_bytes()), blob.generation
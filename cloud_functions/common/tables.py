@@ -0,0 +1,189 @@
+"""
+Registry of the tables the pipeline can receive.
+
+Each table has one specification, used by both functions:
+    - `extension`: extension of the files (csv or json)
+    - `delimiter`, `skip_leading_rows`: CSV layout
+    - `dataset`, `table`: BigQuery raw table the files are loaded into
+    - `partitioning`: 'file_date' if the raw table is partitioned by day on
+      the date of the file name (each file replaces its `table$YYYYMMDD`
+      partition), None otherwise
+    - `clustering`: clustering columns of the raw table
+    - `cleaned`: the cleaned tables refreshed by the `cleaned_wkf` workflow
+      after a load, each from `queries/cleaned/<table>[_incremental].sql`; a
+      nested list is a chain refreshed in order (a table built from another
+      cleaned table comes after it), [] if the table has no cleaned layer
+The files are named `<table>_<YYYYMMDD>.<extension>`, optionally gzipped as
+`<table>_<YYYYMMDD>.<extension>.gz` (see `split_file_name`): BigQuery loads
+the compressed files as they are.
+
+The raw schema of the table comes from `schemas/raw/<table>.json`, which is
+copied into the deployment bundle (see `filter_dir.sh`).
+
+With `schema_source: 'bucket'` the schemas are instead read from the
+`raw_<table>_json` objects of the utils bucket, so they can be changed
+without a deployment. They are then kept in memory: a warm instance uses its
+copy for `schema_cache_ttl` seconds, then only checks the object generation
+(a metadata request) and downloads the schema again if it changed.
+"""
+import json
+import os
+import threading
+import time
+
+from common import clients
+from common import instrumentation
+
+TABLES_SPEC = {
+    'store': {
+        'extension': 'csv',
+        'delimiter': ',',
+        'skip_leading_rows': 1,
+        'dataset': 'raw',
+        'table': 'store',
+        'partitioning': 'file_date',
+        'clustering': ['id_store'],
+        'cleaned': ['store'],
+    },
+    'customer': {
+        'extension': 'csv',
+        'delimiter': ',',
+        'skip_leading_rows': 1,
+        'dataset': 'raw',
+        'table': 'customer',
+        'partitioning': 'file_date',
+        'clustering': ['id_customer'],
+        'cleaned': ['customer'],
+    },
+    'basket': {
+        'extension': 'json',
+        'delimiter': None,
+        'skip_leading_rows': 0,
+        'dataset': 'raw',
+        'table': 'basket',
+        'partitioning': 'file_date',
+        'clustering': ['id_cash_desk'],
+        'cleaned': ['basket', ['basket_detail', 'daily_sales']],
+    },
+}
+
+# the keys are the names of the files, the values the required extension
+FILES_AND_EXTENSION_SPEC = {table_name: spec['extension'] for table_name, spec in TABLES_SPEC.items()}
+
+# extensions of the accepted compressions, after the extension of the format
+COMPRESSION_EXTENSIONS = ['gz']
+
+DEFAULT_SCHEMA_CACHE_TTL = 300
+
+_SCHEMAS_PATHS = [
+    # deployment bundle: common/schemas/raw
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas', 'raw'),
+    # repository: schemas/raw
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'schemas', 'raw'),
+]
+
+_lock = threading.Lock()
+_bundled_schemas = {}
+_remote_schemas = {}
+
+
+def table_spec(table_name: str) -> dict:
+    """
+    Specification of a table.
+
+    Args:
+         table_name (str): Name of the table (first part of the file name).
+    """
+    if table_name not in TABLES_SPEC:
+        raise KeyError(f"La table '{table_name}' n'est pas autorisée. Les valeurs autorisées sont : {', '.join(TABLES_SPEC)}.")
+    return TABLES_SPEC[table_name]
+
+
+def split_file_name(file_name: str) -> tuple:
+    """
+    Split a file name into its name, its extension and its compression:
+        - `store_20220605.csv` -> ('store_20220605', 'csv', None)
+        - `store_20220605.csv.gz` -> ('store_20220605', 'csv', 'gz')
+        - `store_20220605` -> ('store_20220605', '', None)
+
+    Args:
+         file_name (str): Name of the file, without its folder.
+    """
+    name, dot, extension = file_name.rpartition('.')
+    if not dot:
+        return file_name, '', None
+    compression = None
+    if extension.lower() in COMPRESSION_EXTENSIONS and '.' in name:
+        compression = extension.lower()
+        name, _, extension = name.rpartition('.')
+    return name, extension, compression
+
+
+def bundled_schema(table_name: str) -> list:
+    """
+    Raw schema of a table from `schemas/raw/<table>.json`.
+    """
+    table_spec(table_name)
+    if table_name not in _bundled_schemas:
+        for schemas_path in _SCHEMAS_PATHS:
+            schema_path = os.path.join(schemas_path, f'{table_name}.json')
+            if os.path.isfile(schema_path):
+                with open(schema_path, encoding='utf-8') as schema_file:
+                    _bundled_schemas[table_name] = json.load(schema_file)
+                break
+        else:
+            raise FileNotFoundError(f'No raw schema {table_name}.json in {_SCHEMAS_PATHS}')
+    return _bundled_schemas[table_name]
+
+
+def _remote_schema(table_name: str) -> list:
+    from common import state_store
+
+    ttl = float(os.environ.get('schema_cache_ttl', DEFAULT_SCHEMA_CACHE_TTL))
+    now = time.time()
+
+    with _lock:
+        cached = _remote_schemas.get(table_name)
+        if cached is not None and now - cached['checked_at'] < ttl:
+            return cached['schema']
+
+        bucket = clients.storage_client().bucket(state_store.utils_bucket_name())
+        instrumentation.count_call(instrumentation.GCS)
+        blob = bucket.get_blob(f'raw_{table_name}_json')
+        if blob is None:
+            raise FileNotFoundError(f'raw_{table_name}_json inexistant dans {bucket.name}')
+
+        if cached is None or cached['generation'] != blob.generation:
+            instrumentation.count_call(instrumentation.GCS)
+            schema = json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+            cached = {'schema': schema, 'generation': blob.generation}
+            print(f'     schema raw_{table_name}_json loaded (generation {blob.generation})')
+
+        cached['checked_at'] = now
+        _remote_schemas[table_name] = cached
+        return cached['schema']
+
+
+def raw_schema(table_name: str) -> list:
+    """
+    Raw schema of a table, from the bundle or from the utils bucket according
+    to the `schema_source` environment variable ('bundle' by default).
+
+    Args:
+         table_name (str): Name of the table.
+    """
+    schema_source = os.environ.get('schema_source', 'bundle')
+    if schema_source == 'bundle':
+        return bundled_schema(table_name)
+    if schema_source == 'bucket':
+        return _remote_schema(table_name)
+    raise ValueError(f"La variable d'environnement 'schema_source' doit valoir 'bundle' ou 'bucket', pas '{schema_source}'.")
+
+
+def clear_schema_cache():
+    """
+    Forget the schemas read so far.
+    """
+    with _lock:
+        _bundled_schemas.clear()
+        _remote_schemas.clear()
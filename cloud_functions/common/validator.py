@@ -0,0 +1,304 @@
+"""
+Streaming validation of the content of a file against its raw schema.
+
+The file is read as a stream, in chunks of `content_validation_chunk_size`
+bytes, and checked line by line, so the memory used does not depend on the
+size of the file:
+    - CSV: the header (when the table skips one) must list the columns of
+      the schema in order, every row must have one value per column, and
+      each value must be accepted by BigQuery for the type of its column;
+    - NDJSON: every line must be a JSON object whose fields are in the
+      schema, with the REQUIRED ones present and the values of the right
+      type (RECORD / REPEATED included).
+
+A gzipped file is decompressed on the fly, with the same bounded memory.
+
+The validation stops at the first `max_errors` errors: one is enough to
+reject the file, the others only help to fix it. With `keep_rows`, the
+rows in error are kept with their errors (for the quarantine of the
+dispatcher) and the validation stops after `max_errors` rows in error.
+
+When `quarantine_max_bad_rows` is set, the dispatcher loads a file without
+its bad rows (see `cf_dispatch_workflow/src/quarantine.py`): `rejected`
+then only refuses the files the dispatcher would reject, those with an
+error of the whole file or more bad rows than that.
+"""
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import re
+
+from common import instrumentation
+from common import tables
+
+DEFAULT_MAX_ERRORS = 10
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+_BOOLEANS = {'true', 'false', 't', 'f', 'yes', 'no', 'y', 'n', '1', '0'}
+_DATE = re.compile(r'^\d{4}-\d{1,2}-\d{1,2}$')
+_TIMESTAMP = re.compile(
+    r'^\d{4}-\d{1,2}-\d{1,2}'
+    r'([T ]\d{1,2}:\d{2}(:\d{2}(\.\d{1,6})?)?)?'
+    r'\s*(Z|UTC|[+-]\d{1,2}(:?\d{2})?)?$'
+)
+
+
+class ValidationReport:
+    """
+    Result of the validation of a file.
+
+    Attributes:
+         rows (int): Number of data rows read.
+         errors (list): (line number, message) of the errors found, at most
+                        `max_errors`.
+         bad_rows (dict): With `keep_rows`, line number -> row in error (list
+                          of the CSV values or JSON line), None for the
+                          errors of the whole file (header, unreadable).
+    """
+
+    def __init__(self, max_errors: int, keep_rows: bool = False):
+        self.max_errors = max_errors
+        self.keep_rows = keep_rows
+        self.rows = 0
+        self.errors = []
+        self.bad_rows = {}
+
+    @property
+    def valid(self) -> bool:
+        return not self.errors
+
+    @property
+    def file_error(self) -> bool:
+        """
+        True if an error is about the whole file (header, unreadable file),
+        not a row. With `keep_rows` only.
+        """
+        return None in self.bad_rows.values()
+
+    @property
+    def complete(self) -> bool:
+        if self.keep_rows:
+            return len(self.bad_rows) > self.max_errors
+        return len(self.errors) >= self.max_errors
+
+    def add_error(self, line_number: int, message: str, row=None):
+        if not self.complete:
+            self.errors.append((line_number, message))
+            if self.keep_rows:
+                self.bad_rows.setdefault(line_number, row)
+
+    def __str__(self):
+        if self.valid:
+            return f'{self.rows} ligne(s) valide(s)'
+        return '\n'.join(f'ligne {line_number} : {message}' for line_number, message in self.errors)
+
+
+def max_errors() -> int:
+    return int(os.environ.get('content_validation_max_errors', DEFAULT_MAX_ERRORS))
+
+
+def validation_enabled() -> bool:
+    return os.environ.get('content_validation_max_errors') not in [None, '']
+
+
+def quarantine_enabled() -> bool:
+    return os.environ.get('quarantine_max_bad_rows') not in [None, '']
+
+
+def rejected(report: ValidationReport) -> bool:
+    """
+    True if the file must not be loaded: any error without the quarantine,
+    else an error of the whole file or too many bad rows.
+    """
+    if report.keep_rows:
+        return report.complete or report.file_error
+    return not report.valid
+
+
+def _check_scalar(field: dict, value) -> str:
+    """
+    Check a value read from a file against the type of its field.
+
+    Returns:
+         str: The error message, None if the value is accepted.
+    """
+    field_type = field['type'].upper()
+    text = value if isinstance(value, str) else None
+
+    if isinstance(value, (dict, list)):
+        return f"'{field['name']}' doit être un {field_type}, pas un {type(value).__name__}"
+    if field_type == 'STRING':
+        return None
+    if field_type in ['INTEGER', 'INT64']:
+        if isinstance(value, bool) or not (isinstance(value, int) or (text is not None and re.fullmatch(r'\s*[+-]?\d+\s*', text))):
+            return f"'{field['name']}' : '{value}' n'est pas un entier"
+        return None
+    if field_type in ['FLOAT', 'FLOAT64', 'NUMERIC', 'BIGNUMERIC']:
+        if isinstance(value, bool):
+            return f"'{field['name']}' : '{value}' n'est pas un nombre"
+        if text is not None:
+            try:
+                float(text)
+            except ValueError:
+                return f"'{field['name']}' : '{value}' n'est pas un nombre"
+        return None
+    if field_type in ['BOOLEAN', 'BOOL']:
+        if not isinstance(value, bool) and str(value).strip().lower() not in _BOOLEANS:
+            return f"'{field['name']}' : '{value}' n'est pas un booléen"
+        return None
+    if field_type == 'DATE':
+        if text is None or not _DATE.match(text.strip()):
+            return f"'{field['name']}' : '{value}' n'est pas une date YYYY-MM-DD"
+        return None
+    if field_type in ['TIMESTAMP', 'DATETIME']:
+        if text is None or not _TIMESTAMP.match(text.strip()):
+            return f"'{field['name']}' : '{value}' n'est pas un timestamp"
+        return None
+    # the other types (GEOGRAPHY, JSON, ...) are left to BigQuery
+    return None
+
+
+def _check_csv_row(schema: list, row: list) -> list:
+    if len(row) != len(schema):
+        return [f'{len(row)} colonne(s) au lieu de {len(schema)}']
+    errors = []
+    for field, value in zip(schema, row):
+        if value == '':
+            # an empty CSV field is loaded as NULL
+            if field.get('mode', 'NULLABLE').upper() == 'REQUIRED':
+                errors.append(f"'{field['name']}' est obligatoire")
+            continue
+        error = _check_scalar(field, value)
+        if error:
+            errors.append(error)
+    return errors
+
+
+def _check_json_record(fields: list, record, prefix: str = '') -> list:
+    if not isinstance(record, dict):
+        return [f'{prefix or "la ligne"} doit être un objet JSON']
+    errors = []
+    fields_by_name = {field['name']: field for field in fields}
+    for name in record:
+        if name not in fields_by_name:
+            errors.append(f"'{prefix}{name}' n'est pas dans le schéma")
+
+    for field in fields:
+        name = field['name']
+        mode = field.get('mode', 'NULLABLE').upper()
+        value = record.get(name)
+        if value is None:
+            if mode == 'REQUIRED':
+                errors.append(f"'{prefix}{name}' est obligatoire")
+            continue
+        values = value if mode == 'REPEATED' else [value]
+        if mode == 'REPEATED' and not isinstance(value, list):
+            errors.append(f"'{prefix}{name}' doit être une liste")
+            continue
+        for index, item in enumerate(values):
+            item_name = f'{prefix}{name}[{index}]' if mode == 'REPEATED' else f'{prefix}{name}'
+            if field['type'].upper() in ['RECORD', 'STRUCT']:
+                errors.extend(_check_json_record(field.get('fields', []), item, f'{item_name}.'))
+            else:
+                error = _check_scalar({**field, 'name': item_name}, item)
+                if error:
+                    errors.append(error)
+    return errors
+
+
+def _validate_csv(spec: dict, schema: list, lines, report: ValidationReport):
+    reader = csv.reader(lines, delimiter=spec['delimiter'])
+    expected_header = [field['name'] for field in schema]
+    for row in reader:
+        line_number = reader.line_num
+        if not row:
+            continue
+        if line_number <= spec['skip_leading_rows']:
+            if line_number == 1 and spec['skip_leading_rows'] and [name.strip() for name in row] != expected_header:
+                report.add_error(line_number, f"en-tête {row} au lieu de {expected_header}")
+        else:
+            report.rows += 1
+            for message in _check_csv_row(schema, row):
+                report.add_error(line_number, message, row)
+        if report.complete:
+            return
+
+
+def _validate_ndjson(schema: list, lines, report: ValidationReport):
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        report.rows += 1
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            report.add_error(line_number, f'JSON invalide : {e}', line.rstrip('\r\n'))
+        else:
+            for message in _check_json_record(schema, record):
+                report.add_error(line_number, message, line.rstrip('\r\n'))
+        if report.complete:
+            return
+
+
+def validate_stream(table_name: str, stream, extension: str = None, max_errors_count: int = None,
+                    compression: str = None, keep_rows: bool = False) -> ValidationReport:
+    """
+    Validate the content of a file read from a binary stream.
+
+    Args:
+         table_name (str): Name of the table of the file.
+         stream: Binary file-like object, read line by line.
+         extension (str): Extension of the file, the one of the table by
+                          default.
+         max_errors_count (int): Number of errors after which the validation
+                                 stops, `content_validation_max_errors` by
+                                 default.
+         compression (str): 'gz' if the stream is gzipped, else None.
+         keep_rows (bool): Keep the rows in error in `bad_rows`, then
+                           `max_errors_count` counts the rows, not the errors.
+
+    Returns:
+         ValidationReport: The rows read and the errors found.
+    """
+    spec = tables.table_spec(table_name)
+    schema = tables.raw_schema(table_name)
+    report = ValidationReport(max_errors_count or max_errors(), keep_rows)
+
+    if compression == 'gz':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        if (extension or spec['extension']).lower() == 'csv':
+            _validate_csv(spec, schema, lines, report)
+        else:
+            _validate_ndjson(schema, lines, report)
+    except (UnicodeDecodeError, csv.Error, OSError, EOFError) as e:
+        report.add_error(report.rows + 1, f'fichier illisible : {e}')
+    finally:
+        # do not close the stream of the caller
+        lines.detach()
+    return report
+
+
+def validate_blob(table_name: str, blob, extension: str = None, max_errors_count: int = None,
+                  compression: str = None, keep_rows: bool = False) -> ValidationReport:
+    """
+    Validate the content of a Cloud Storage blob, downloaded in chunks of
+    `content_validation_chunk_size` bytes.
+
+    Args:
+         table_name (str): Name of the table of the file.
+         blob (google.cloud.storage.Blob): Blob of the file.
+         extension, max_errors_count, compression, keep_rows: See `validate_stream`.
+    """
+    chunk_size = int(os.environ.get('content_validation_chunk_size', DEFAULT_CHUNK_SIZE))
+    with blob.open('rb', chunk_size=chunk_size) as stream:
+        report = validate_stream(table_name, stream, extension, max_errors_count, compression, keep_rows)
+        bytes_read = stream.tell()
+    instrumentation.count_call(instrumentation.GCS, max(1, math.ceil(bytes_read / chunk_size)))
+    instrumentation.add_metric('bytes_validated', bytes_read)
+    instrumentation.add_metric('rows_validated', report.rows)
+    return report
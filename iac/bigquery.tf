@@ -21,6 +21,20 @@ resource "google_bigquery_table" "raw_store" {
   dataset_id = google_bigquery_dataset.raw.dataset_id
   table_id   = "store"
 
+  # one partition per file date, written with the store$YYYYMMDD decorator.
+  # A table created before it was partitioned must be migrated first with
+  # queries/migrations/partition_tables.sql: terraform would else replace it,
+  # which the protections below refuse, the raw history cannot be rebuilt.
+  time_partitioning {
+    type = "DAY"
+  }
+  clustering = ["id_store"]
+
+  deletion_protection = true
+  lifecycle {
+    prevent_destroy = true
+  }
+
   schema = <<EOF
 [
     {
@@ -87,6 +101,15 @@ resource "google_bigquery_table" "cleaned_store" {
   dataset_id = google_bigquery_dataset.cleaned.dataset_id
   table_id   = "store"
 
+  # migrated by queries/migrations/partition_tables.sql if created before
+  time_partitioning {
+    type  = "DAY"
+    field = "update_time"
+  }
+  clustering = ["id_store", "country"]
+
+  deletion_protection = true
+
   schema = <<EOF
 [
     {
@@ -147,3 +170,63 @@ resource "google_bigquery_table" "cleaned_store" {
 EOF
 
 }
+resource "google_bigquery_table" "cleaned_customer" {
+    project  = var.project_id
+
+  dataset_id = google_bigquery_dataset.cleaned.dataset_id
+  table_id   = "customer"
+
+  clustering = ["id_customer"]
+
+  schema = file(var.cleaned_customer_json)
+
+}
+resource "google_bigquery_table" "cleaned_basket" {
+    project  = var.project_id
+
+  dataset_id = google_bigquery_dataset.cleaned.dataset_id
+  table_id   = "basket"
+
+  # one partition per purchase date, replaced by basket_incremental.sql
+  time_partitioning {
+    type  = "DAY"
+    field = "purchase_date"
+  }
+  clustering = ["id_store", "id_customer"]
+
+  schema = file(var.cleaned_basket_json)
+
+}
+resource "google_bigquery_table" "cleaned_basket_detail" {
+    project  = var.project_id
+
+  dataset_id = google_bigquery_dataset.cleaned.dataset_id
+  table_id   = "basket_detail"
+
+  # one partition per purchase date, replaced by basket_detail_incremental.sql
+  time_partitioning {
+    type  = "DAY"
+    field = "purchase_date"
+  }
+  clustering = ["id_store", "product_name"]
+
+  schema = file(var.cleaned_basket_detail_json)
+
+}
+resource "google_bigquery_table" "cleaned_daily_sales" {
+    project  = var.project_id
+
+  dataset_id = google_bigquery_dataset.cleaned.dataset_id
+  table_id   = "daily_sales"
+
+  # pre-aggregated sales per day, store and product, read by the dashboards
+  # instead of scanning basket_detail
+  time_partitioning {
+    type  = "DAY"
+    field = "sale_date"
+  }
+  clustering = ["id_store", "product_name"]
+
+  schema = file(var.cleaned_daily_sales_json)
+
+}
@@ -63,4 +63,60 @@ resource "google_cloudfunctions_function" "function" {
     google_storage_bucket_object.zip
    ]
 
-}
\ No newline at end of file
+}
+
+
+# The dispatcher's scheduled entry point: `track_executions` follows the
+# `async` executions and fires what waits for a deadline (load batches, daily
+# manifests, coalesced triggers). Without it these are never fired.
+resource "null_resource" "filter_dir_dispatch" {
+  provisioner "local-exec" {
+    command = "bash ../cloud_functions/cf_dispatch_workflow/filter_dir.sh"
+  }
+}
+
+data "archive_file" "source_dispatch" {
+  type        = "zip"
+  source_dir  = "../cloud_functions/cf_dispatch_workflow/src_filtered"
+  output_path = "../cloud_functions/cf_dispatch_workflow/src/function.zip"
+  depends_on = [ 
+    null_resource.filter_dir_dispatch
+   ]
+}
+
+resource "google_storage_bucket_object" "zip_dispatch" {
+  source                = data.archive_file.source_dispatch.output_path
+  content_type          = "application/zip"
+  name = "src-dispatch-${data.archive_file.source_dispatch.output_md5}.zip"
+  bucket = google_storage_bucket.cloud_functions_sources.name
+  depends_on = [ 
+    google_storage_bucket.cloud_functions_sources,
+    data.archive_file.source_dispatch
+   ]
+}
+
+# Triggered by the `track_executions_tick` messages of the Cloud Scheduler job
+resource "google_cloudfunctions_function" "track_executions" {
+  project               = var.project_id
+  region                = var.region 
+  name                  = "cf_track_executions"
+  runtime               = "python310"
+
+  source_archive_bucket = google_storage_bucket.cloud_functions_sources.name
+  source_archive_object = google_storage_bucket_object.zip_dispatch.name
+
+  # Must match the function name in the cloud function `main.py` source code
+  entry_point = "track_executions"
+
+  environment_variables = yamldecode(file("../cloud_functions/cf_dispatch_workflow/env.yaml"))
+
+  event_trigger {
+    event_type          = "google.pubsub.topic.publish"
+    resource            = google_pubsub_topic.track_executions_tick.id
+  }
+
+  depends_on = [ 
+    google_storage_bucket.cloud_functions_sources,
+    google_storage_bucket_object.zip_dispatch
+   ]
+}
@@ -55,17 +55,24 @@ resource "google_storage_bucket" "cloud_functions_sources" {
 }
 
 # load le fichier dans le bucket
-resource "google_storage_bucket_object" "cleaned_store_sql" {
+resource "google_storage_bucket_object" "raw_store_json" {
   bucket   = google_storage_bucket.magasin_cie_utils.name
-  name = "cleaned_store.sql"
-  source = var.cleaned_store_sql
+  name = "raw_store_json"
+  source = var.raw_store_json
 }
 
 # load le fichier dans le bucket
-resource "google_storage_bucket_object" "raw_store_json" {
+resource "google_storage_bucket_object" "raw_customer_json" {
   bucket   = google_storage_bucket.magasin_cie_utils.name
-  name = "raw_store_json"
-  source = var.raw_store_json
+  name = "raw_customer_json"
+  source = var.raw_customer_json
+}
+
+# load le fichier dans le bucket
+resource "google_storage_bucket_object" "raw_basket_json" {
+  bucket   = google_storage_bucket.magasin_cie_utils.name
+  name = "raw_basket_json"
+  source = var.raw_basket_json
 }
 
 # load le fichier dans le bucket
@@ -75,6 +82,34 @@ resource "google_storage_bucket_object" "cleaned_store_json" {
   source = var.cleaned_store_json
 }
 
+# load le fichier dans le bucket
+resource "google_storage_bucket_object" "cleaned_customer_json" {
+  bucket   = google_storage_bucket.magasin_cie_utils.name
+  name = "cleaned_customer_json"
+  source = var.cleaned_customer_json
+}
+
+# load le fichier dans le bucket
+resource "google_storage_bucket_object" "cleaned_basket_json" {
+  bucket   = google_storage_bucket.magasin_cie_utils.name
+  name = "cleaned_basket_json"
+  source = var.cleaned_basket_json
+}
+
+# load le fichier dans le bucket
+resource "google_storage_bucket_object" "cleaned_basket_detail_json" {
+  bucket   = google_storage_bucket.magasin_cie_utils.name
+  name = "cleaned_basket_detail_json"
+  source = var.cleaned_basket_detail_json
+}
+
+# load le fichier dans le bucket
+resource "google_storage_bucket_object" "cleaned_daily_sales_json" {
+  bucket   = google_storage_bucket.magasin_cie_utils.name
+  name = "cleaned_daily_sales_json"
+  source = var.cleaned_daily_sales_json
+}
+
 resource "google_storage_bucket_iam_member" "workflow_storage_access" {
   bucket = google_storage_bucket.magasin_cie_utils.name
   role   = "roles/storage.objectViewer"
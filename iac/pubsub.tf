@@ -2,4 +2,10 @@ resource "google_pubsub_topic" "valid_file" {
   name = "valid_file"
   project = var.project_id
 
-}
\ No newline at end of file
+}
+
+# Ticks of the `track_executions` schedule (see scheduler.tf)
+resource "google_pubsub_topic" "track_executions_tick" {
+  name = "track_executions_tick"
+  project = var.project_id
+}
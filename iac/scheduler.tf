@@ -0,0 +1,27 @@
+resource "google_project_service" "cloudscheduler" {
+  service            = "cloudscheduler.googleapis.com"
+  disable_on_destroy = false
+  project            = var.project_id
+}
+
+# Runs `track_executions` on a schedule: the coalesced workflow triggers
+# (`wkf_coalesce_window`), the load batches, the daily manifests and the
+# `async` executions are only fired or followed by it.
+resource "google_cloud_scheduler_job" "track_executions" {
+  project     = var.project_id
+  region      = var.region
+  name        = "track_executions"
+  description = "Tick of the cf_track_executions function"
+  schedule    = var.track_executions_schedule
+  time_zone   = "Europe/Paris"
+
+  pubsub_target {
+    topic_name = google_pubsub_topic.track_executions_tick.id
+    data       = base64encode("tick")
+  }
+
+  depends_on = [
+    google_project_service.cloudscheduler,
+    google_pubsub_topic.track_executions_tick
+  ]
+}
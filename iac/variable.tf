@@ -35,15 +35,55 @@ variable "python_code_location" {
   default = "../cloud_functions/cf_trigger_on_file/src"
 }
 
-variable "cleaned_store_sql" {
+# <table>.sql and <table>_incremental.sql, embedded in the cleaned_wkf workflow
+variable "cleaned_queries_path" {
   type = string
-  default = "../queries/cleaned/store.sql"
+  default = "../queries/cleaned"
+}
+variable "cleaned_wkf_concurrency" {
+  type = number
+  description = "Maximum number of cleaned queries run together by cleaned_wkf"
+  default = 4
+}
+variable "cleaned_wkf_tables" {
+  type = any
+  description = "Cleaned tables refreshed by default by cleaned_wkf, a list is a chain refreshed in order"
+  default = ["store", "customer", "basket", ["basket_detail", "daily_sales"]]
 }
 variable "raw_store_json" {
   type = string
   default = "../schemas/raw/store.json"
 }
+variable "raw_customer_json" {
+  type = string
+  default = "../schemas/raw/customer.json"
+}
+variable "raw_basket_json" {
+  type = string
+  default = "../schemas/raw/basket.json"
+}
 variable "cleaned_store_json" {
   type = string
   default = "../schemas/cleaned/store.json"
+}
+variable "cleaned_customer_json" {
+  type = string
+  default = "../schemas/cleaned/customer.json"
+}
+variable "cleaned_basket_json" {
+  type = string
+  default = "../schemas/cleaned/basket.json"
+}
+variable "cleaned_basket_detail_json" {
+  type = string
+  default = "../schemas/cleaned/basket_detail.json"
+}
+variable "cleaned_daily_sales_json" {
+  type = string
+  default = "../schemas/cleaned/daily_sales.json"
+}
+variable "track_executions_schedule" {
+  type = string
+  description = "Cron schedule of track_executions, the coalescing window and the batch and manifest deadlines are fired at this pace"
+  default = "* * * * *"
 }
\ No newline at end of file
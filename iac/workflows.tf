@@ -16,13 +16,29 @@ output "service_account" {
   value = "${google_service_account.workflows_service_account}"
 }
 
-resource "google_workflows_workflow" "store_wkf" {
+# queries of the cleaned tables, embedded in the workflow at deploy time:
+# queries/cleaned/<table>_incremental.sql (MERGE) and <table>.sql (full rebuild)
+locals {
+  cleaned_queries = {
+    for file_name in fileset(var.cleaned_queries_path, "*_incremental.sql") :
+    trimsuffix(file_name, "_incremental.sql") => {
+      incremental = file("${var.cleaned_queries_path}/${file_name}")
+      full        = file("${var.cleaned_queries_path}/${trimsuffix(file_name, "_incremental.sql")}.sql")
+    }
+  }
+}
+
+resource "google_workflows_workflow" "cleaned_wkf" {
   #project        = var.project_id
-  name            = "store_wkf"
+  name            = "cleaned_wkf"
   region          = var.region
-  description     = "A sample workflow"
+  description     = "Refresh of the cleaned tables, one parallel branch per table or chain"
   service_account = google_service_account.workflows_service_account.id
-  source_contents = file("../cloud_workflows/store_wkf.yaml")
+  source_contents = replace(replace(
+    replace(file("../cloud_workflows/cleaned_wkf.yaml"), "__CLEANED_QUERIES__", jsonencode(local.cleaned_queries)),
+    "__CLEANED_TABLES__", jsonencode(var.cleaned_wkf_tables)),
+    "__CONCURRENCY_LIMIT__", tostring(var.cleaned_wkf_concurrency)
+  )
   depends_on = [
     google_project_service.workflows,
     google_service_account.workflows_service_account,
@@ -87,19 +103,19 @@ output "workflows_service_account_email" {
 }
 
 # Workflow
-output "store_wkf" {
-  description = "Le workflow 'store_wkf'."
-  value       = google_workflows_workflow.store_wkf
+output "cleaned_wkf" {
+  description = "Le workflow 'cleaned_wkf'."
+  value       = google_workflows_workflow.cleaned_wkf
 }
 
-output "store_wkf_name" {
-  description = "Le nom du workflow 'store_wkf'."
-  value       = google_workflows_workflow.store_wkf.name
+output "cleaned_wkf_name" {
+  description = "Le nom du workflow 'cleaned_wkf'."
+  value       = google_workflows_workflow.cleaned_wkf.name
 }
 
-output "store_wkf_state" {
-  description = "L'état du workflow 'store_wkf'."
-  value       = google_workflows_workflow.store_wkf.state
+output "cleaned_wkf_state" {
+  description = "L'état du workflow 'cleaned_wkf'."
+  value       = google_workflows_workflow.cleaned_wkf.state
 }
 
 # Rôles IAM
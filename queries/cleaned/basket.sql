@@ -0,0 +1,21 @@
+-- One row per basket, the lines of `detail` summed up (see basket_detail.sql
+-- for the lines themselves).
+-- A basket without cash desk or whose purchase date cannot be parsed has no
+-- id_basket: it is left out instead of failing the whole refresh.
+SELECT 
+  CONCAT(id_cash_desk, '_', purchase_date, '_', IFNULL(id_customer, ''))      AS `id_basket`,
+  CAST(REGEXP_EXTRACT(id_cash_desk, '^([0-9]+)-') AS INTEGER)                 AS `id_store`,
+  id_cash_desk,
+  SAFE_CAST(id_customer AS INTEGER)                                           AS `id_customer`,
+  payment_mode,
+  SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", purchase_date)                    AS `purchase_time`,
+  DATE(SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", purchase_date))              AS `purchase_date`,
+  ARRAY_LENGTH(detail)                                                        AS `nb_products`,
+  (SELECT SUM(SAFE_CAST(item.quantity AS INTEGER)) FROM UNNEST(detail) AS item) AS `quantity`,
+  (SELECT ROUND(SUM(SAFE_CAST(item.quantity AS INTEGER) * item.unit_price), 2)
+   FROM UNNEST(detail) AS item)                                               AS `amount`,
+  update_time,
+  CURRENT_TIMESTAMP()                                                         AS `insertion_time`
+FROM `{{ project_id }}.raw.basket`
+WHERE id_cash_desk IS NOT NULL
+  AND SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", purchase_date) IS NOT NULL;
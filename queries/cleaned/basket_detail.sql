@@ -0,0 +1,19 @@
+-- One row per line of the baskets: `detail` unnested once, its quantity cast.
+-- The baskets without id_basket are left out, as in basket.sql.
+SELECT 
+  CONCAT(basket.id_cash_desk, '_', basket.purchase_date, '_', IFNULL(basket.id_customer, '')) AS `id_basket`,
+  CAST(REGEXP_EXTRACT(basket.id_cash_desk, '^([0-9]+)-') AS INTEGER)                          AS `id_store`,
+  basket.id_cash_desk,
+  SAFE_CAST(basket.id_customer AS INTEGER)                                                    AS `id_customer`,
+  SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", basket.purchase_date)                             AS `purchase_time`,
+  DATE(SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", basket.purchase_date))                       AS `purchase_date`,
+  item.product_name                                                                           AS `product_name`,
+  SAFE_CAST(item.quantity AS INTEGER)                                                         AS `quantity`,
+  item.unit_price                                                                             AS `unit_price`,
+  ROUND(SAFE_CAST(item.quantity AS INTEGER) * item.unit_price, 2)                             AS `amount`,
+  basket.update_time,
+  CURRENT_TIMESTAMP()                                                                         AS `insertion_time`
+FROM `{{ project_id }}.raw.basket` AS basket
+CROSS JOIN UNNEST(basket.detail) AS item
+WHERE basket.id_cash_desk IS NOT NULL
+  AND SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", basket.purchase_date) IS NOT NULL;
@@ -0,0 +1,45 @@
+-- Incremental refresh of cleaned.basket_detail, by purchase date, as for
+-- cleaned.basket (basket_incremental.sql): the purchase dates of the raw rows
+-- more recent than the watermark are deleted and inserted again.
+-- The baskets without id_basket are left out, as in basket.sql.
+-- The full refresh (basket_detail.sql, WRITE_TRUNCATE) stays available for backfills.
+DECLARE watermark TIMESTAMP DEFAULT (
+  SELECT IFNULL(MAX(update_time), TIMESTAMP '1970-01-01 00:00:00 UTC')
+  FROM `{{ project_id }}.cleaned.basket_detail`
+);
+DECLARE first_date DATE DEFAULT (
+  SELECT MIN(DATE(SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", purchase_date)))
+  FROM `{{ project_id }}.raw.basket`
+  WHERE update_time > watermark
+);
+
+BEGIN TRANSACTION;
+
+DELETE FROM `{{ project_id }}.cleaned.basket_detail`
+WHERE purchase_date >= first_date;
+
+INSERT INTO `{{ project_id }}.cleaned.basket_detail` (
+  id_basket, id_store, id_cash_desk, id_customer, purchase_time, purchase_date,
+  product_name, quantity, unit_price, amount, update_time, insertion_time
+)
+SELECT 
+  CONCAT(basket.id_cash_desk, '_', basket.purchase_date, '_', IFNULL(basket.id_customer, '')) AS `id_basket`,
+  CAST(REGEXP_EXTRACT(basket.id_cash_desk, '^([0-9]+)-') AS INTEGER)                          AS `id_store`,
+  basket.id_cash_desk,
+  SAFE_CAST(basket.id_customer AS INTEGER)                                                    AS `id_customer`,
+  SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", basket.purchase_date)                             AS `purchase_time`,
+  DATE(SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", basket.purchase_date))                       AS `purchase_date`,
+  item.product_name                                                                           AS `product_name`,
+  SAFE_CAST(item.quantity AS INTEGER)                                                         AS `quantity`,
+  item.unit_price                                                                             AS `unit_price`,
+  ROUND(SAFE_CAST(item.quantity AS INTEGER) * item.unit_price, 2)                             AS `amount`,
+  basket.update_time,
+  CURRENT_TIMESTAMP()                                                                         AS `insertion_time`
+FROM `{{ project_id }}.raw.basket` AS basket
+CROSS JOIN UNNEST(basket.detail) AS item
+WHERE basket._PARTITIONDATE >= first_date
+  AND basket.id_cash_desk IS NOT NULL
+  AND SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", basket.purchase_date) IS NOT NULL
+  AND DATE(SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", basket.purchase_date)) >= first_date;
+
+COMMIT TRANSACTION;
@@ -0,0 +1,48 @@
+-- Incremental refresh of cleaned.basket, by purchase date.
+-- The purchase dates of the raw rows more recent than the watermark (the
+-- latest update_time already in cleaned.basket) are rebuilt as a whole: their
+-- rows are deleted and inserted again from the raw partitions of these dates
+-- on (a basket is never in the file of a day before its purchase), so a day
+-- loaded again replaces its baskets instead of adding them twice.
+-- The baskets without id_basket are left out, as in basket.sql.
+-- The full refresh (basket.sql, WRITE_TRUNCATE) stays available for backfills.
+DECLARE watermark TIMESTAMP DEFAULT (
+  SELECT IFNULL(MAX(update_time), TIMESTAMP '1970-01-01 00:00:00 UTC')
+  FROM `{{ project_id }}.cleaned.basket`
+);
+DECLARE first_date DATE DEFAULT (
+  SELECT MIN(DATE(SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", purchase_date)))
+  FROM `{{ project_id }}.raw.basket`
+  WHERE update_time > watermark
+);
+
+BEGIN TRANSACTION;
+
+DELETE FROM `{{ project_id }}.cleaned.basket`
+WHERE purchase_date >= first_date;
+
+INSERT INTO `{{ project_id }}.cleaned.basket` (
+  id_basket, id_store, id_cash_desk, id_customer, payment_mode, purchase_time,
+  purchase_date, nb_products, quantity, amount, update_time, insertion_time
+)
+SELECT 
+  CONCAT(id_cash_desk, '_', purchase_date, '_', IFNULL(id_customer, ''))      AS `id_basket`,
+  CAST(REGEXP_EXTRACT(id_cash_desk, '^([0-9]+)-') AS INTEGER)                 AS `id_store`,
+  id_cash_desk,
+  SAFE_CAST(id_customer AS INTEGER)                                           AS `id_customer`,
+  payment_mode,
+  SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", purchase_date)                    AS `purchase_time`,
+  DATE(SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", purchase_date))              AS `purchase_date`,
+  ARRAY_LENGTH(detail)                                                        AS `nb_products`,
+  (SELECT SUM(SAFE_CAST(item.quantity AS INTEGER)) FROM UNNEST(detail) AS item) AS `quantity`,
+  (SELECT ROUND(SUM(SAFE_CAST(item.quantity AS INTEGER) * item.unit_price), 2)
+   FROM UNNEST(detail) AS item)                                               AS `amount`,
+  update_time,
+  CURRENT_TIMESTAMP()                                                         AS `insertion_time`
+FROM `{{ project_id }}.raw.basket`
+WHERE _PARTITIONDATE >= first_date
+  AND id_cash_desk IS NOT NULL
+  AND SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", purchase_date) IS NOT NULL
+  AND DATE(SAFE.PARSE_TIMESTAMP("%d-%m-%Y %H:%M:%S", purchase_date)) >= first_date;
+
+COMMIT TRANSACTION;
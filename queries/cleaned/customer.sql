@@ -0,0 +1,12 @@
+SELECT 
+  CAST(id_customer AS INTEGER)                    AS `id_customer`,
+  first_name,
+  last_name,
+  LOWER(email)                                    AS `email`,
+  PARSE_DATE("%d-%b-%y", creation_date)           AS `creation_date`,
+  update_time,
+  CURRENT_TIMESTAMP()                             AS `insertion_time`
+FROM `{{ project_id }}.raw.customer`
+WHERE TRUE
+-- latest version of each customer, as in the incremental refresh (customer_incremental.sql)
+QUALIFY ROW_NUMBER() OVER (PARTITION BY CAST(id_customer AS INTEGER) ORDER BY update_time DESC) = 1;
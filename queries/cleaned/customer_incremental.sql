@@ -0,0 +1,38 @@
+-- Incremental refresh of cleaned.customer.
+-- Only the raw rows more recent than the watermark (the latest update_time
+-- already in cleaned.customer) are read, and only the latest version of each
+-- customer is merged on id_customer. A file only holds rows updated on or before
+-- its date, so these rows are all in the partitions of the watermark date on:
+-- the filter on _PARTITIONDATE prunes the older partitions of the raw history.
+-- The full refresh (customer.sql, WRITE_TRUNCATE) stays available for backfills.
+DECLARE watermark TIMESTAMP DEFAULT (
+  SELECT IFNULL(MAX(update_time), TIMESTAMP '1970-01-01 00:00:00 UTC')
+  FROM `{{ project_id }}.cleaned.customer`
+);
+
+MERGE `{{ project_id }}.cleaned.customer` AS cleaned
+USING (
+  SELECT 
+    CAST(id_customer AS INTEGER)                    AS `id_customer`,
+    first_name,
+    last_name,
+    LOWER(email)                                    AS `email`,
+    PARSE_DATE("%d-%b-%y", creation_date)           AS `creation_date`,
+    update_time,
+    CURRENT_TIMESTAMP()                             AS `insertion_time`
+  FROM `{{ project_id }}.raw.customer`
+  WHERE _PARTITIONDATE >= DATE(watermark)
+    AND update_time > watermark
+  QUALIFY ROW_NUMBER() OVER (PARTITION BY CAST(id_customer AS INTEGER) ORDER BY update_time DESC) = 1
+) AS raw
+ON cleaned.id_customer = raw.id_customer
+WHEN MATCHED AND raw.update_time > cleaned.update_time THEN
+  UPDATE SET
+    first_name     = raw.first_name,
+    last_name      = raw.last_name,
+    email          = raw.email,
+    creation_date  = raw.creation_date,
+    update_time    = raw.update_time,
+    insertion_time = raw.insertion_time
+WHEN NOT MATCHED THEN
+  INSERT ROW;
@@ -0,0 +1,12 @@
+-- Sales per day, store and product, from cleaned.basket_detail: the
+-- dashboards read this small table instead of the baskets.
+SELECT 
+  purchase_date                      AS `sale_date`,
+  id_store,
+  product_name,
+  COUNT(DISTINCT id_basket)          AS `nb_baskets`,
+  SUM(quantity)                      AS `quantity`,
+  ROUND(SUM(amount), 2)              AS `amount`,
+  CURRENT_TIMESTAMP()                AS `insertion_time`
+FROM `{{ project_id }}.cleaned.basket_detail`
+GROUP BY purchase_date, id_store, product_name;
@@ -0,0 +1,37 @@
+-- Incremental refresh of cleaned.daily_sales, run after basket_detail in the
+-- same branch of cleaned_wkf.
+-- The sale dates of the basket lines inserted since the last refresh (an
+-- insertion_time more recent than the latest one of cleaned.daily_sales) are
+-- aggregated again and replace their rows.
+-- The full refresh (daily_sales.sql, WRITE_TRUNCATE) stays available for backfills.
+DECLARE watermark TIMESTAMP DEFAULT (
+  SELECT IFNULL(MAX(insertion_time), TIMESTAMP '1970-01-01 00:00:00 UTC')
+  FROM `{{ project_id }}.cleaned.daily_sales`
+);
+DECLARE first_date DATE DEFAULT (
+  SELECT MIN(purchase_date)
+  FROM `{{ project_id }}.cleaned.basket_detail`
+  WHERE insertion_time > watermark
+);
+
+BEGIN TRANSACTION;
+
+DELETE FROM `{{ project_id }}.cleaned.daily_sales`
+WHERE sale_date >= first_date;
+
+INSERT INTO `{{ project_id }}.cleaned.daily_sales` (
+  sale_date, id_store, product_name, nb_baskets, quantity, amount, insertion_time
+)
+SELECT 
+  purchase_date                      AS `sale_date`,
+  id_store,
+  product_name,
+  COUNT(DISTINCT id_basket)          AS `nb_baskets`,
+  SUM(quantity)                      AS `quantity`,
+  ROUND(SUM(amount), 2)              AS `amount`,
+  CURRENT_TIMESTAMP()                AS `insertion_time`
+FROM `{{ project_id }}.cleaned.basket_detail`
+WHERE purchase_date >= first_date
+GROUP BY purchase_date, id_store, product_name;
+
+COMMIT TRANSACTION;
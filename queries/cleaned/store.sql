@@ -12,4 +12,7 @@ SELECT
   PARSE_DATE("%d-%m-%Y", creation_date)    AS `creation_date`,
   update_time,
   CURRENT_TIMESTAMP()                      AS `insertion_time`
-FROM `{{ project_id }}.raw.store`;
+FROM `{{ project_id }}.raw.store`
+WHERE TRUE
+-- latest version of each store, as in the incremental refresh (store_incremental.sql)
+QUALIFY ROW_NUMBER() OVER (PARTITION BY CAST(id_store AS INTEGER) ORDER BY update_time DESC) = 1;
@@ -0,0 +1,46 @@
+-- Incremental refresh of cleaned.store.
+-- Only the raw rows more recent than the watermark (the latest update_time
+-- already in cleaned.store) are read, and only the latest version of each
+-- store is merged on id_store. A file only holds rows updated on or before
+-- its date, so these rows are all in the partitions of the watermark date on:
+-- the filter on _PARTITIONDATE prunes the older partitions of the raw history.
+-- The full refresh (store.sql, WRITE_TRUNCATE) stays available for backfills.
+DECLARE watermark TIMESTAMP DEFAULT (
+  SELECT IFNULL(MAX(update_time), TIMESTAMP '1970-01-01 00:00:00 UTC')
+  FROM `{{ project_id }}.cleaned.store`
+);
+
+MERGE `{{ project_id }}.cleaned.store` AS cleaned
+USING (
+  SELECT 
+    CAST(id_store   AS INTEGER)              AS `id_store`,
+    CAST(id_manager AS INTEGER)              AS `id_manager`,
+    city,
+    UPPER(country)                           AS `country`,
+    ST_GEOGPOINT(x_coordinate, y_coordinate) AS `coordinate`,
+    CASE UPPER(is_closed) 
+      WHEN 'N' THEN False 
+      WHEN 'Y' THEN True 
+      ELSE NULL 
+    END                                      AS `is_closed`,
+    PARSE_DATE("%d-%m-%Y", creation_date)    AS `creation_date`,
+    update_time,
+    CURRENT_TIMESTAMP()                      AS `insertion_time`
+  FROM `{{ project_id }}.raw.store`
+  WHERE _PARTITIONDATE >= DATE(watermark)
+    AND update_time > watermark
+  QUALIFY ROW_NUMBER() OVER (PARTITION BY CAST(id_store AS INTEGER) ORDER BY update_time DESC) = 1
+) AS raw
+ON cleaned.id_store = raw.id_store
+WHEN MATCHED AND raw.update_time > cleaned.update_time THEN
+  UPDATE SET
+    id_manager     = raw.id_manager,
+    city           = raw.city,
+    country        = raw.country,
+    coordinate     = raw.coordinate,
+    is_closed      = raw.is_closed,
+    creation_date  = raw.creation_date,
+    update_time    = raw.update_time,
+    insertion_time = raw.insertion_time
+WHEN NOT MATCHED THEN
+  INSERT ROW;
@@ -0,0 +1,112 @@
+-- One-off migration of the tables created before they were partitioned:
+--   - raw.store, raw.customer and raw.basket, by day on the date of their file
+--     (each load writes the table$YYYYMMDD partition of its file);
+--   - cleaned.store, by day on update_time.
+-- Terraform cannot add a partitioning to an existing table: it would destroy
+-- the table and create it again, empty. Run this script before the terraform
+-- apply which adds the partitioning (iac/bigquery.tf), the apply then finds
+-- the tables as it expects them:
+--
+--   sed "s/{{ project_id }}/$PROJECT_ID/g" queries/migrations/partition_tables.sql \
+--     | bq query --use_legacy_sql=false
+--
+-- A table already partitioned (or missing) is skipped, so the script can be run
+-- again. Each table is copied into a new partitioned table which replaces it.
+-- The raw rows did not keep the date of their file: a row goes to the partition
+-- of its update_time, which is never after the date of its file (a file only
+-- holds rows updated on or before its date) nor before a basket purchase, so
+-- the incremental queries of queries/cleaned/ still read it. Loading again a
+-- day loaded before the migration only replaces the rows migrated to its date.
+
+IF EXISTS (
+  SELECT 1 FROM `{{ project_id }}.raw.INFORMATION_SCHEMA.TABLES` WHERE table_name = 'store'
+) AND NOT EXISTS (
+  SELECT 1 FROM `{{ project_id }}.raw.INFORMATION_SCHEMA.COLUMNS`
+  WHERE table_name = 'store' AND is_partitioning_column = 'YES'
+) THEN
+  CREATE TABLE `{{ project_id }}.raw.store_partitioned` (
+    id_store      STRING NOT NULL,
+    id_manager    STRING,
+    city          STRING,
+    country       STRING,
+    x_coordinate  FLOAT64,
+    y_coordinate  FLOAT64,
+    is_closed     STRING,
+    creation_date STRING,
+    update_time   TIMESTAMP
+  )
+  PARTITION BY _PARTITIONDATE
+  CLUSTER BY id_store;
+
+  INSERT INTO `{{ project_id }}.raw.store_partitioned` (_PARTITIONTIME, id_store, id_manager, city, country, x_coordinate, y_coordinate, is_closed, creation_date, update_time)
+  SELECT TIMESTAMP(IFNULL(DATE(update_time), CURRENT_DATE())), id_store, id_manager, city, country, x_coordinate, y_coordinate, is_closed, creation_date, update_time
+  FROM `{{ project_id }}.raw.store`;
+
+  DROP TABLE `{{ project_id }}.raw.store`;
+  ALTER TABLE `{{ project_id }}.raw.store_partitioned` RENAME TO store;
+END IF;
+
+IF EXISTS (
+  SELECT 1 FROM `{{ project_id }}.raw.INFORMATION_SCHEMA.TABLES` WHERE table_name = 'customer'
+) AND NOT EXISTS (
+  SELECT 1 FROM `{{ project_id }}.raw.INFORMATION_SCHEMA.COLUMNS`
+  WHERE table_name = 'customer' AND is_partitioning_column = 'YES'
+) THEN
+  CREATE TABLE `{{ project_id }}.raw.customer_partitioned` (
+    id_customer   STRING NOT NULL,
+    first_name    STRING,
+    last_name     STRING,
+    email         STRING,
+    creation_date STRING,
+    update_time   TIMESTAMP
+  )
+  PARTITION BY _PARTITIONDATE
+  CLUSTER BY id_customer;
+
+  INSERT INTO `{{ project_id }}.raw.customer_partitioned` (_PARTITIONTIME, id_customer, first_name, last_name, email, creation_date, update_time)
+  SELECT TIMESTAMP(IFNULL(DATE(update_time), CURRENT_DATE())), id_customer, first_name, last_name, email, creation_date, update_time
+  FROM `{{ project_id }}.raw.customer`;
+
+  DROP TABLE `{{ project_id }}.raw.customer`;
+  ALTER TABLE `{{ project_id }}.raw.customer_partitioned` RENAME TO customer;
+END IF;
+
+IF EXISTS (
+  SELECT 1 FROM `{{ project_id }}.raw.INFORMATION_SCHEMA.TABLES` WHERE table_name = 'basket'
+) AND NOT EXISTS (
+  SELECT 1 FROM `{{ project_id }}.raw.INFORMATION_SCHEMA.COLUMNS`
+  WHERE table_name = 'basket' AND is_partitioning_column = 'YES'
+) THEN
+  CREATE TABLE `{{ project_id }}.raw.basket_partitioned` (
+    id_cash_desk  STRING NOT NULL,
+    id_customer   STRING,
+    detail        ARRAY<STRUCT<product_name STRING, quantity STRING, unit_price FLOAT64>>,
+    payment_mode  STRING,
+    purchase_date STRING,
+    update_time   TIMESTAMP
+  )
+  PARTITION BY _PARTITIONDATE
+  CLUSTER BY id_cash_desk;
+
+  INSERT INTO `{{ project_id }}.raw.basket_partitioned` (_PARTITIONTIME, id_cash_desk, id_customer, detail, payment_mode, purchase_date, update_time)
+  SELECT TIMESTAMP(IFNULL(DATE(update_time), CURRENT_DATE())), id_cash_desk, id_customer, detail, payment_mode, purchase_date, update_time
+  FROM `{{ project_id }}.raw.basket`;
+
+  DROP TABLE `{{ project_id }}.raw.basket`;
+  ALTER TABLE `{{ project_id }}.raw.basket_partitioned` RENAME TO basket;
+END IF;
+
+IF EXISTS (
+  SELECT 1 FROM `{{ project_id }}.cleaned.INFORMATION_SCHEMA.TABLES` WHERE table_name = 'store'
+) AND NOT EXISTS (
+  SELECT 1 FROM `{{ project_id }}.cleaned.INFORMATION_SCHEMA.COLUMNS`
+  WHERE table_name = 'store' AND is_partitioning_column = 'YES'
+) THEN
+  CREATE TABLE `{{ project_id }}.cleaned.store_partitioned`
+  PARTITION BY DATE(update_time)
+  CLUSTER BY id_store, country
+  AS SELECT * FROM `{{ project_id }}.cleaned.store`;
+
+  DROP TABLE `{{ project_id }}.cleaned.store`;
+  ALTER TABLE `{{ project_id }}.cleaned.store_partitioned` RENAME TO store;
+END IF;
@@ -0,0 +1,80 @@
+"""
+Fixtures of the tests: the functions run on the in-process GCP services of
+`tools/local_emulator.py`, with the environment of the pipeline benchmark.
+
+Run from the repository root:
+
+    python -m pytest -q
+"""
+import os
+import sys
+
+import pytest
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+sys.path.insert(0, os.path.join(REPOSITORY_PATH, 'tools'))
+
+import benchmark_pipeline  # noqa: E402
+import local_emulator  # noqa: E402
+
+# the local modules of the dispatcher (batch_loader, daily_manifest, ...)
+sys.path.insert(0, benchmark_pipeline.FUNCTIONS['cf_dispatch_workflow'])
+
+DATA_PATH = os.path.join(REPOSITORY_PATH, '__materials__', 'data')
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    """
+    The environment of the benchmark; a test sets its own settings with
+    `environment.setenv`, undone at its end.
+    """
+    for name, value in benchmark_pipeline.ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    return monkeypatch
+
+
+@pytest.fixture
+def emulator(environment):
+    """
+    A new emulated project, with the schemas, cleaned tables and workflows
+    deployed, used by the shared clients for the duration of the test.
+    """
+    emulator = local_emulator.LocalEmulator(os.environ['GCP_PROJECT'], os.environ['util_bucket_suffix'])
+    emulator.install()
+    emulator.deploy()
+    yield emulator
+    emulator.uninstall()
+
+
+@pytest.fixture(scope='session')
+def trigger_main():
+    return benchmark_pipeline.load_function_main('cf_trigger_on_file')
+
+
+@pytest.fixture(scope='session')
+def dispatcher_main():
+    return benchmark_pipeline.load_function_main('cf_dispatch_workflow')
+
+
+def read_data(day: str, file_name: str) -> bytes:
+    """
+    Content of a file of `__materials__/data/<day>/`.
+    """
+    with open(os.path.join(DATA_PATH, day, file_name), 'rb') as data:
+        return data.read()
+
+
+class Calls:
+    """
+    Callable recording the arguments of its calls, returning `result`.
+    """
+
+    def __init__(self, result=None):
+        self.calls = []
+        self.result = result
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        return self.result(*args) if callable(self.result) else self.result
@@ -0,0 +1,103 @@
+"""
+Tests of `batch_loader`: redelivered messages, vanished files and the
+takeover of an interrupted flush.
+"""
+import pytest
+
+import batch_loader
+from common import state_store
+
+from conftest import Calls, read_data
+
+TABLE = 'customer'
+
+
+class Crash(BaseException):
+    """
+    An instance which dies in the middle of a load.
+    """
+
+
+@pytest.fixture
+def batching(emulator, environment):
+    environment.setenv('load_batch_max_files', '10')
+    environment.setenv('load_batch_max_age', '300')
+    environment.setenv('load_batch_flush_timeout', '900')
+    return emulator
+
+
+def put(emulator, day: str):
+    return emulator.landing_bucket.put(f'input/customer_{day}.csv', read_data(day, f'customer_{day}.csv'))
+
+
+def add(blob, load, move, on_loaded, now: float, day: str = '20220601') -> bool:
+    return batch_loader.add_blob(TABLE, blob.bucket.name, blob.name, blob.size, load, move, on_loaded,
+                                 file_date=day, generation=blob.generation, now=now)
+
+
+def batch_document():
+    document, _ = state_store.read_document(batch_loader._path(TABLE, 'csv'))
+    return document
+
+
+def test_redelivered_message_adds_nothing(batching):
+    blob = put(batching, '20220601')
+    load, move, on_loaded = Calls(), Calls(), Calls()
+
+    add(blob, load, move, on_loaded, now=0)
+    add(blob, load, move, on_loaded, now=1)
+
+    assert [entry['blob_path'] for entry in batch_document()['blobs']] == [blob.name]
+
+
+def test_message_redelivered_during_the_flush_adds_nothing(batching):
+    blob = put(batching, '20220601')
+    move, on_loaded = Calls(), Calls()
+    # the message comes again while its batch is being loaded
+    load = Calls(lambda *args: add(blob, load, move, on_loaded, now=2))
+
+    add(blob, load, move, on_loaded, now=0)
+    assert batch_loader.flush(TABLE, 'csv', load, move, on_loaded, now=1)
+
+    assert len(load.calls) == 1
+    assert batch_document() is None
+    assert on_loaded.calls == [(TABLE,)]
+
+
+def test_flush_drops_the_files_no_longer_in_the_bucket(batching):
+    first, second = put(batching, '20220601'), put(batching, '20220602')
+    load, move, on_loaded = Calls(), Calls(), Calls()
+    add(first, load, move, on_loaded, now=0, day='20220601')
+    add(second, load, move, on_loaded, now=0, day='20220602')
+    # archived meanwhile by the load of a redelivered message
+    batching.landing_bucket.delete_blob(first.name)
+
+    batch_loader.flush(TABLE, 'csv', load, move, on_loaded, now=1)
+
+    (_, source_uris, _, file_dates), = load.calls
+    assert source_uris == [f'gs://{second.bucket.name}/{second.name}']
+    assert file_dates == ['20220602']
+    assert move.calls == [(second.bucket.name, [second.name], 'archive', [second.generation])]
+
+
+def test_interrupted_flush_is_taken_over_after_its_timeout(batching):
+    blob = put(batching, '20220601')
+    move, on_loaded = Calls(), Calls()
+
+    def crash(*args):
+        raise Crash()
+
+    add(blob, Calls(), move, on_loaded, now=0)
+    with pytest.raises(Crash):
+        batch_loader.flush(TABLE, 'csv', crash, move, on_loaded, now=1)
+    assert batch_document()['flushing'] is not None
+
+    load = Calls()
+    # still being loaded for all the others
+    assert batch_loader.flush_due_batches(load, move, on_loaded, now=100) == []
+    assert load.calls == []
+
+    assert batch_loader.flush_due_batches(load, move, on_loaded, now=1000) == [f'{TABLE}.csv']
+    assert len(load.calls) == 1
+    assert batch_document() is None
+    assert on_loaded.calls == [(TABLE,)]
@@ -0,0 +1,84 @@
+"""
+Tests of `content_index`: the contents found in the partition of their date
+or in another one, the expiry of the entries and the forced loads.
+"""
+import base64
+import hashlib
+
+import pytest
+
+from common import content_index
+
+TABLE = 'store'
+
+
+@pytest.fixture
+def index(emulator, environment):
+    environment.setenv('content_index', 'true')
+    return emulator
+
+
+def md5(data: bytes) -> str:
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+def record(data: bytes, day: str):
+    content_index.record_loaded(TABLE, f'input/store_{day}.csv', md5(data), size=len(data), file_date=day)
+
+
+def test_content_is_found_in_the_partition_of_its_date(index):
+    record(b'snapshot', '20220601')
+
+    loaded = content_index.find_loaded(TABLE, md5(b'snapshot'), size=8, file_date='20220601')
+
+    assert loaded['file_date'] == '20220601'
+    assert content_index.find_loaded(TABLE, md5(b'other'), size=5, file_date='20220601') is None
+
+
+def test_unchanged_snapshot_points_to_the_partition_loaded_last(index):
+    record(b'snapshot', '20220601')
+    record(b'snapshot', '20220602')
+
+    loaded = content_index.find_loaded(TABLE, md5(b'snapshot'), size=8, file_date='20220603')
+
+    assert loaded['file_date'] == '20220602'
+    assert loaded['blob_path'] == 'input/store_20220602.csv'
+
+
+def test_partition_loaded_since_with_another_content_is_not_used(index):
+    record(b'snapshot', '20220601')
+    record(b'corrected', '20220601')
+
+    assert content_index.find_loaded(TABLE, md5(b'snapshot'), size=8, file_date='20220601') is None
+    assert content_index.find_loaded(TABLE, md5(b'snapshot'), size=8, file_date='20220602') is None
+
+
+def test_entries_older_than_the_ttl_are_not_used(index, environment):
+    environment.setenv('content_index_ttl', '3600')
+    record(b'snapshot', '20220601')
+    loaded_at = content_index.find_loaded(TABLE, md5(b'snapshot'), size=8, file_date='20220601')['loaded_at']
+
+    assert content_index.find_loaded(TABLE, md5(b'snapshot'), size=8, file_date='20220601',
+                                     now=loaded_at + 3599) is not None
+    assert content_index.find_loaded(TABLE, md5(b'snapshot'), size=8, file_date='20220601',
+                                     now=loaded_at + 3601) is None
+    assert content_index.find_loaded(TABLE, md5(b'snapshot'), size=8, file_date='20220602',
+                                     now=loaded_at + 3601) is None
+
+
+def test_content_key_without_md5_uses_the_crc32c_and_size():
+    crc32c = base64.b64encode(b'\x01\x02\x03\x04').decode('ascii')
+
+    assert content_index.content_key(crc32c=crc32c, size=10) == 'crc32c-01020304-10'
+    assert content_index.content_key(crc32c=crc32c) is None
+
+
+@pytest.mark.parametrize('values, expected', [
+    ({'force_load': 'true'}, True),
+    ({'force_load': 'True'}, True),
+    ({'force_load': 'false'}, False),
+    ({}, False),
+    (None, False),
+])
+def test_forced(values, expected):
+    assert content_index.forced(values) is expected
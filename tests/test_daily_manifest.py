@@ -0,0 +1,104 @@
+"""
+Tests of `daily_manifest`: the commit of a complete manifest, redelivered
+messages, the deadline and the takeover of an interrupted commit.
+"""
+import pytest
+
+import daily_manifest
+from common import state_store
+
+from conftest import Calls
+
+DAY = '20220601'
+
+
+class Crash(BaseException):
+    """
+    An instance which dies in the middle of a commit.
+    """
+
+
+@pytest.fixture
+def manifest(emulator, environment):
+    environment.setenv('manifest_tables', 'store,customer')
+    environment.setenv('manifest_deadline', '3600')
+    environment.setenv('manifest_commit_timeout', '900')
+    return emulator
+
+
+def add(table_name: str, load, move, on_committed, now: float, generation: int = 1) -> bool:
+    extension = 'json' if table_name == 'basket' else 'csv'
+    return daily_manifest.add_file(table_name, DAY, 'landing', f'input/{table_name}_{DAY}.{extension}', 100,
+                                   load, move, on_committed, generation=generation, now=now)
+
+
+def manifest_document():
+    document, _ = state_store.read_document(daily_manifest._path(DAY))
+    return document
+
+
+def test_complete_manifest_is_committed_once(manifest):
+    load, move, on_committed = Calls(), Calls(), Calls()
+
+    assert not add('store', load, move, on_committed, now=0)
+    assert add('customer', load, move, on_committed, now=1)
+
+    assert sorted(call[0] for call in load.calls) == ['customer', 'store']
+    assert sorted(call[2] for call in move.calls) == ['archive', 'archive']
+    assert on_committed.calls == [(DAY, ['store', 'customer'])]
+    assert manifest_document() is None
+
+
+def test_redelivered_message_adds_nothing(manifest):
+    load, move, on_committed = Calls(), Calls(), Calls()
+
+    add('store', load, move, on_committed, now=0)
+    add('store', load, move, on_committed, now=1)
+
+    assert list(manifest_document()['files']) == ['store']
+    assert manifest_document()['opened_at'] == 0
+
+
+def test_manifest_is_committed_without_the_missing_tables_after_its_deadline(manifest):
+    load, move, on_committed = Calls(), Calls(), Calls()
+    add('store', load, move, on_committed, now=0)
+
+    assert daily_manifest.commit_due_manifests(load, move, on_committed, now=3599) == []
+    assert daily_manifest.commit_due_manifests(load, move, on_committed, now=3600) == [DAY]
+    assert on_committed.calls == [(DAY, ['store'])]
+
+
+def test_interrupted_commit_is_taken_over_after_its_timeout(manifest):
+    def crash(*args):
+        raise Crash()
+
+    move, on_committed = Calls(), Calls()
+    add('store', Calls(), move, on_committed, now=0)
+    with pytest.raises(Crash):
+        add('customer', crash, move, on_committed, now=1)
+    assert manifest_document()['committing'] is not None
+
+    load = Calls()
+    # still being committed for all the others
+    assert daily_manifest.commit_due_manifests(load, move, on_committed, now=100) == []
+    assert load.calls == []
+
+    assert daily_manifest.commit_due_manifests(load, move, on_committed, now=1000) == [DAY]
+    assert sorted(call[0] for call in load.calls) == ['customer', 'store']
+    assert on_committed.calls == [(DAY, ['store', 'customer'])]
+    assert manifest_document() is None
+
+
+def test_file_of_a_date_being_committed_opens_a_new_manifest(manifest):
+    move, on_committed = Calls(), Calls()
+    # the store file of the date is uploaded again while the manifest is loaded
+    load = Calls(lambda table_name, *args: table_name == 'customer' and add('store', Calls(), move, on_committed,
+                                                                               now=2, generation=2))
+
+    add('store', load, move, on_committed, now=0)
+    add('customer', load, move, on_committed, now=1)
+
+    document = manifest_document()
+    assert document['committing'] is None
+    assert list(document['files']) == ['store']
+    assert document['files']['store']['generation'] == 2
@@ -0,0 +1,77 @@
+"""
+Tests of `execution_ledger`: the executions finished, still running or no
+longer found by the tracker.
+"""
+import json
+import os
+import time
+
+import pytest
+
+import execution_ledger
+from common import state_store
+
+from conftest import Calls
+
+
+@pytest.fixture
+def workflow(emulator):
+    return f"projects/{os.environ['GCP_PROJECT']}/locations/{os.environ['wkf_location']}/workflows/cleaned_wkf"
+
+
+def create_execution(emulator, workflow: str) -> str:
+    from google.cloud.workflows.executions_v1.types import Execution
+
+    execution = Execution(argument=json.dumps({'tables': ['daily_sales']}))
+    return emulator.executions.create_execution(parent=workflow, execution=execution).name
+
+
+def pending_paths():
+    return [path for path, _, _ in state_store.list_documents(execution_ledger.PENDING_PREFIX)]
+
+
+def test_finished_execution_is_moved_to_the_day_of_the_check(emulator, workflow):
+    execution_name = create_execution(emulator, workflow)
+    execution_ledger.record_execution('basket', execution_name)
+    on_finished = Calls()
+    now = time.time() + 3 * 86400
+
+    summary = execution_ledger.check_executions(on_finished, now=now)
+
+    assert summary['succeeded'] == 1
+    assert [document['execution_name'] for document, in on_finished.calls] == [execution_name]
+    assert pending_paths() == []
+    day = time.strftime('%Y%m%d', time.gmtime(now))
+    document, _ = state_store.read_document(f"{execution_ledger.FINISHED_PREFIX}{day}/cleaned_wkf/"
+                                            f"{execution_name.rsplit('/', 1)[-1]}.json")
+    assert document['state'] == 'SUCCEEDED'
+
+
+def test_running_execution_is_checked_again_later(emulator, workflow):
+    from google.cloud.workflows.executions_v1.types import Execution
+
+    execution_name = create_execution(emulator, workflow)
+    emulator.executions.get_execution(name=execution_name).state = Execution.State.ACTIVE
+    execution_ledger.record_execution('basket', execution_name)
+    now = time.time() + 60
+
+    summary = execution_ledger.check_executions(now=now)
+
+    assert summary['active'] == 1
+    (_, document, _), = state_store.list_documents(execution_ledger.PENDING_PREFIX)
+    assert document['next_check_at'] == now + 2 * execution_ledger.DEFAULT_INITIAL_INTERVAL
+    # not due yet
+    assert execution_ledger.check_executions(now=now + 1)['due'] == 0
+
+
+def test_execution_no_longer_found_is_finished_without_holding_up_the_others(emulator, workflow):
+    execution_name = create_execution(emulator, workflow)
+    execution_ledger.record_execution('basket', execution_name)
+    execution_ledger.record_execution('store', f'{workflow}/executions/past-retention')
+    on_finished = Calls()
+
+    summary = execution_ledger.check_executions(on_finished, now=time.time() + 60)
+
+    assert (summary['succeeded'], summary['not_found'], summary['errors']) == (1, 1, 0)
+    assert sorted(document['state'] for document, in on_finished.calls) == ['NOT_FOUND', 'SUCCEEDED']
+    assert pending_paths() == []
@@ -0,0 +1,91 @@
+"""
+End-to-end tests: the days of `__materials__/data` through `check_file_format`
+and `receive_messages` on the emulator, as the pipeline benchmark runs them.
+"""
+import contextlib
+import io
+import time
+from concurrent.futures import Future
+
+import benchmark_pipeline
+
+from conftest import read_data
+
+DAYS = '__materials__/data/2022060[1-2]'
+RAW_TABLES = ['store', 'customer', 'basket']
+
+
+def run(trigger_main, dispatcher_main, days: list = None, wait: float = 0):
+    emulator = benchmark_pipeline.run_pipeline(days or benchmark_pipeline.list_days(DAYS), trigger_main,
+                                               dispatcher_main)['emulator']
+    # the batches left open are flushed by the scheduled entry point
+    time.sleep(wait)
+    with contextlib.redirect_stdout(io.StringIO()):
+        dispatcher_main.track_executions({}, {})
+    emulator.uninstall()
+    return emulator
+
+
+def partitions(emulator) -> dict:
+    return {
+        table_name: emulator.bigquery.connection.execute(
+            f'SELECT _PARTITIONTIME, COUNT(*) FROM raw.{table_name} GROUP BY 1 ORDER BY 1').fetchall()
+        for table_name in RAW_TABLES
+    }
+
+
+def test_files_are_loaded_into_the_partition_of_their_date(environment, trigger_main, dispatcher_main):
+    emulator = run(trigger_main, dispatcher_main)
+
+    assert all(len(rows) == 2 for rows in partitions(emulator).values())
+    assert emulator.landing_bucket.object_names('input/') == []
+    assert len(emulator.landing_bucket.object_names('archive/')) == 6
+    assert emulator.bigquery.count_rows('cleaned.basket') > 0
+
+
+def test_days_loaded_again_replace_their_partitions(environment, trigger_main, dispatcher_main):
+    days = benchmark_pipeline.list_days(DAYS)
+    once = partitions(run(trigger_main, dispatcher_main, days))
+
+    assert partitions(run(trigger_main, dispatcher_main, days + days)) == once
+
+
+def test_batches_load_the_same_partitions_as_single_files(environment, trigger_main, dispatcher_main):
+    expected = partitions(run(trigger_main, dispatcher_main))
+    environment.setenv('load_batch_max_files', '2')
+    environment.setenv('load_batch_max_age', '0.01')
+
+    emulator = run(trigger_main, dispatcher_main, wait=0.05)
+
+    assert partitions(emulator) == expected
+    assert emulator.landing_bucket.object_names('input/') == []
+
+
+def test_unchanged_snapshots_keep_a_partition_per_date(environment, trigger_main, dispatcher_main):
+    expected = partitions(run(trigger_main, dispatcher_main))
+    environment.setenv('content_index', 'true')
+
+    emulator = run(trigger_main, dispatcher_main)
+
+    assert partitions(emulator) == expected
+    assert emulator.landing_bucket.object_names('input/') == []
+
+
+def test_publication_still_in_flight_leaves_the_file_in_input(emulator, environment, trigger_main):
+    environment.setenv('pubsub_flush_timeout', '0.05')
+    # a publication which never completes
+    emulator.publisher.publish = lambda *args, **kwargs: Future()
+    blob = emulator.landing_bucket.put('input/store_20220601.csv', read_data('20220601', 'store_20220601.csv'))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        trigger_main.check_file_format({
+            'bucket': blob.bucket.name,
+            'name': blob.name,
+            'generation': str(blob.generation),
+            'size': str(blob.size),
+            'md5Hash': blob.md5_hash,
+            'crc32c': blob.crc32c,
+            'metadata': None,
+        }, {})
+
+    assert emulator.landing_bucket.object_names('') == [blob.name]
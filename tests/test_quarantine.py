@@ -0,0 +1,69 @@
+"""
+Tests of `quarantine`: the bad rows of a file set aside and the good ones
+loaded without them.
+"""
+import pytest
+
+import quarantine
+
+from conftest import read_data
+
+DAY = '20220601'
+BLOB_PATH = f'input/customer_{DAY}.csv'
+
+
+@pytest.fixture
+def quarantined(emulator, environment):
+    environment.setenv('quarantine_max_bad_rows', '2')
+    return emulator
+
+
+def put_customers(emulator, bad_lines: list):
+    """
+    The customer file of the day with bad lines inserted after its third line.
+    """
+    lines = read_data(DAY, f'customer_{DAY}.csv').decode('utf-8').splitlines(keepends=True)
+    content = ''.join(lines[:3] + [line + '\n' for line in bad_lines] + lines[3:])
+    return emulator.landing_bucket.put(BLOB_PATH, content.encode('utf-8')), len(lines) - 1
+
+
+def test_bad_rows_are_found_with_their_line(quarantined):
+    blob, good_rows = put_customers(quarantined, ['1141,Meara'])
+
+    report = quarantine.split_rows('customer', blob.bucket.name, BLOB_PATH)
+
+    assert list(report.bad_rows) == [4]
+    assert report.rows == good_rows + 1
+
+
+def test_file_with_too_many_bad_rows_is_rejected(quarantined):
+    blob, _ = put_customers(quarantined, ['1141,Meara', '1224,Athena', '1225,Rose'])
+
+    with pytest.raises(ValueError):
+        quarantine.split_rows('customer', blob.bucket.name, BLOB_PATH)
+
+
+def test_good_rows_are_copied_without_the_bad_ones(quarantined):
+    blob, _ = put_customers(quarantined, ['1141,Meara'])
+    report = quarantine.split_rows('customer', blob.bucket.name, BLOB_PATH)
+
+    good_rows_uri = quarantine.write_good_rows('customer', blob.bucket.name, BLOB_PATH, report)
+
+    copy = quarantined.landing_bucket.read(good_rows_uri.split('/', 3)[3]).decode('utf-8')
+    assert '1141,Meara\n' not in copy
+    assert copy == read_data(DAY, f'customer_{DAY}.csv').decode('utf-8')
+    quarantine.delete_good_rows(good_rows_uri)
+    assert quarantined.landing_bucket.object_names('quarantine/') == []
+
+
+def test_file_is_loaded_without_its_bad_rows(quarantined, dispatcher_main):
+    blob, good_rows = put_customers(quarantined, ['1141,Meara'])
+
+    dispatcher_main.insert_into_raw('customer', blob.bucket.name, BLOB_PATH, DAY, blob.size)
+
+    assert quarantined.bigquery.count_rows('raw.customer') == good_rows
+    assert quarantined.landing_bucket.object_names('quarantine/') == []
+    sidecar = quarantined.landing_bucket.blob(quarantine.sidecar_path(BLOB_PATH))
+    sidecar.reload()
+    assert sidecar.metadata['rows_quarantined'] == '1'
+    assert sidecar.metadata['rows_loaded'] == str(good_rows)
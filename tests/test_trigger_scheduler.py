@@ -0,0 +1,88 @@
+"""
+Tests of `trigger_scheduler`: the coalescing window, the follow-up of a
+running execution and the expiry of its lease.
+"""
+import pytest
+
+import trigger_scheduler
+from common import state_store
+
+from conftest import Calls
+
+TABLE = 'store'
+
+
+@pytest.fixture
+def coalescing(emulator, environment):
+    environment.setenv('wkf_coalesce_window', '60')
+    environment.setenv('wkf_coalesce_lease', '3600')
+    return emulator
+
+
+def trigger_document():
+    document, _ = state_store.read_document(trigger_scheduler._path(TABLE))
+    return document
+
+
+def test_requests_of_a_window_trigger_once(coalescing):
+    launch = Calls()
+
+    assert trigger_scheduler.request_trigger(TABLE, launch, now=0) == 'deferred'
+    assert trigger_scheduler.request_trigger(TABLE, launch, now=10) == 'deferred'
+    assert trigger_scheduler.fire_due_triggers(launch, now=59) == []
+    assert trigger_scheduler.fire_due_triggers(launch, now=60) == [TABLE]
+
+    assert launch.calls == [(TABLE,)]
+    # the execution was already over: nothing left to fire
+    assert trigger_scheduler.fire_due_triggers(launch, now=200) == []
+
+
+def test_request_during_an_execution_is_a_follow_up_fired_at_its_release(coalescing):
+    launch = Calls('executions/1')
+    trigger_scheduler.request_trigger(TABLE, launch, now=0)
+    trigger_scheduler.fire_due_triggers(launch, now=60)
+
+    assert trigger_scheduler.request_trigger(TABLE, launch, now=70) == 'queued'
+    assert trigger_scheduler.request_trigger(TABLE, launch, now=80) == 'queued'
+    assert trigger_scheduler.fire_due_triggers(launch, now=200) == []
+    assert len(launch.calls) == 1
+
+    # the window of the follow-up started with its first request
+    trigger_scheduler.release(TABLE, 'executions/1', launch, now=200)
+    assert len(launch.calls) == 2
+    assert trigger_document()['running'] == 'executions/1'
+
+
+def test_release_of_another_execution_keeps_the_lease(coalescing):
+    launch = Calls('executions/1')
+    trigger_scheduler.request_trigger(TABLE, launch, now=0)
+    trigger_scheduler.fire_due_triggers(launch, now=60)
+
+    trigger_scheduler.release(TABLE, 'executions/0', now=100)
+
+    assert trigger_document()['running'] == 'executions/1'
+
+
+def test_expired_lease_is_taken_over(coalescing):
+    launch = Calls('executions/1')
+    trigger_scheduler.request_trigger(TABLE, launch, now=0)
+    trigger_scheduler.fire_due_triggers(launch, now=60)
+    # the end of executions/1 is never seen
+    assert trigger_scheduler.request_trigger(TABLE, launch, now=100) == 'queued'
+    assert trigger_scheduler.fire_due_triggers(launch, now=60 + 3600) == []
+
+    launch.result = 'executions/2'
+    assert trigger_scheduler.fire_due_triggers(launch, now=60 + 3601) == [TABLE]
+    assert len(launch.calls) == 2
+    assert trigger_document()['running'] == 'executions/2'
+
+
+def test_failed_launch_releases_the_lease(coalescing):
+    def failing(table_name):
+        raise RuntimeError('workflow unavailable')
+
+    trigger_scheduler.request_trigger(TABLE, failing, now=0)
+    with pytest.raises(RuntimeError):
+        trigger_scheduler.fire_due_triggers(failing, now=60)
+
+    assert trigger_document()['running'] is None
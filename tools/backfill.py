@@ -0,0 +1,336 @@
+"""
+Backfill of the landing bucket from a local directory tree or a GCS prefix.
+
+The files whose name is valid for `verifier_nom_fichier` are uploaded (or
+copied, from GCS) to the `input/` subfolder of the landing bucket with a
+bounded thread pool, then published to the Pub/Sub topic of the dispatcher
+like `check_file_format` would. The files of a table are published one at a
+time in the order of their file date, so the dispatcher receives the days of
+a table in order; the tables go in parallel. With `--bulk`, the files of a
+table are published together once they are uploaded, in a single batch
+(see `common/publishing.py` for the batch settings), with the table as
+ordering key: the publisher sends them in order and gives up the later days
+of a table whose day failed. Pub/Sub only delivers them in that order if the
+subscription of the dispatcher was created with message ordering
+(`gcloud pubsub subscriptions create ... --enable-message-ordering`, it
+cannot be enabled afterwards); else send them without `--bulk`.
+
+The uploaded files carry a `backfill` metadata, so the trigger function
+ignores their finalize event: they are published once, by this script.
+With `--force`, the dispatcher loads them even if their content is already
+in its content index (a day to reload as it is).
+
+Every published file is written to the checkpoint file: running the same
+command again resumes after the last file published for each table. The
+command exits with status 1 if a file was not published.
+
+Usage (from the repository root):
+
+    python tools/backfill.py '__materials__/data/2022060*/' --bucket <project>_magasin_cie_landing
+    python tools/backfill.py 'gs://<bucket>/data/2022060*/' --bucket <project>_magasin_cie_landing --workers 32
+    python tools/backfill.py '__materials__/data/2022*/' --bucket <bucket> --bulk
+    python tools/backfill.py '__materials__/data/20220601/' --bucket <bucket> --force --checkpoint reload.json
+    python tools/backfill.py '__materials__/data/2022*/' --bucket <bucket> --dry-run
+
+The project and the topic come from `--project` / `--topic` or from the
+`GCP_PROJECT` / `pubsub_topic_id` environment variables.
+"""
+import argparse
+import fnmatch
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+TRIGGER_MAIN_PATH = os.path.join(REPOSITORY_PATH, 'cloud_functions', 'cf_trigger_on_file', 'src', 'main.py')
+
+sys.path.append(os.path.join(REPOSITORY_PATH, 'cloud_functions'))
+
+from common import clients  # noqa: E402
+from common import content_index  # noqa: E402
+from common import publishing  # noqa: E402
+from common import tables  # noqa: E402
+from common import validator  # noqa: E402
+
+DEFAULT_CHECKPOINT = 'backfill_checkpoint.json'
+GLOB_CHARACTERS = '*?['
+
+
+def load_trigger_main():
+    """
+    Import `main.py` of the trigger function, for `verifier_nom_fichier`.
+    """
+    spec = importlib.util.spec_from_file_location('cf_trigger_on_file_main', TRIGGER_MAIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _static_prefix(pattern: str) -> str:
+    """
+    Part of a pattern before its first glob character.
+    """
+    positions = [pattern.index(character) for character in GLOB_CHARACTERS if character in pattern]
+    return pattern[:min(positions)] if positions else pattern
+
+
+def _matches(path: str, pattern: str) -> bool:
+    # `data/2022060*/` matches every file under the matching folders
+    return fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(path, pattern.rstrip('/') + '/*')
+
+
+def list_source_files(source: str) -> list:
+    """
+    List the files matching a local or `gs://` pattern.
+
+    Returns:
+         list: One dict per file with its `source` path or URI, `name` and
+               `size`.
+    """
+    files = []
+    if source.startswith('gs://'):
+        bucket_name, _, pattern = source[len('gs://'):].partition('/')
+        for blob in clients.storage_client().list_blobs(bucket_name, prefix=_static_prefix(pattern)):
+            if not blob.name.endswith('/') and _matches(blob.name, pattern):
+                files.append({'source': f'gs://{bucket_name}/{blob.name}', 'name': blob.name.rsplit('/', 1)[-1], 'size': blob.size})
+        return files
+
+    pattern = os.path.normpath(source)
+    # a plain directory: every file under it
+    whole_tree = os.path.isdir(pattern)
+    root = pattern if whole_tree else os.path.dirname(_static_prefix(pattern)) or '.'
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if whole_tree or _matches(path, pattern):
+                files.append({'source': path, 'name': filename, 'size': os.path.getsize(path)})
+    return files
+
+
+class Checkpoint:
+    """
+    Files already published, kept in a JSON file rewritten after each one.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.published = {}
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as checkpoint_file:
+                self.published = json.load(checkpoint_file)['published']
+
+    def done(self, source: str) -> bool:
+        return source in self.published
+
+    def record(self, source: str, blob_path: str):
+        with self.lock:
+            self.published[source] = blob_path
+            temporary_path = f'{self.path}.tmp'
+            with open(temporary_path, 'w', encoding='utf-8') as checkpoint_file:
+                json.dump({'published': self.published}, checkpoint_file, indent=1)
+            os.replace(temporary_path, self.path)
+
+
+class Stats:
+    """
+    Counters and stage durations of the backfill, shared by the threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.stages_ms = {}
+
+    def add(self, name: str, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def time(self, stage: str, start: float):
+        with self.lock:
+            self.stages_ms[stage] = self.stages_ms.get(stage, 0.0) + (time.perf_counter() - start) * 1000
+
+
+def stage_file(file: dict, bucket, run_id: str, validate_content: bool, stats: Stats) -> str:
+    """
+    Upload or copy a file to the `input/` subfolder of the landing bucket.
+
+    Returns:
+         str: The path of the blob in the landing bucket.
+    """
+    if validate_content:
+        start = time.perf_counter()
+        if file['source'].startswith('gs://'):
+            bucket_name, _, blob_path = file['source'][len('gs://'):].partition('/')
+            blob = clients.storage_client().bucket(bucket_name).blob(blob_path)
+            report = validator.validate_blob(file['table'], blob, compression=file['compression'])
+        else:
+            with open(file['source'], 'rb') as stream:
+                report = validator.validate_stream(file['table'], stream, compression=file['compression'])
+        stats.time('validate_content', start)
+        if not report.valid:
+            raise ValueError(f"{file['source']}: contenu invalide\n{report}")
+
+    start = time.perf_counter()
+    blob_path = f"input/{file['name']}"
+    blob = bucket.blob(blob_path)
+    blob.metadata = {'backfill': run_id}
+    if file['source'].startswith('gs://'):
+        source_bucket_name, _, source_path = file['source'][len('gs://'):].partition('/')
+        source_blob = clients.storage_client().bucket(source_bucket_name).blob(source_path)
+        # server side copy, in several calls for the large objects
+        token, _, _ = blob.rewrite(source_blob)
+        while token is not None:
+            token, _, _ = blob.rewrite(source_blob, token=token)
+    else:
+        blob.upload_from_filename(file['source'])
+    stats.time('upload', start)
+    stats.add('bytes', file['size'])
+    return blob_path
+
+
+def publish_table(files: list, uploads: dict, topic_path: str, bucket_name: str, checkpoint: Checkpoint, stats: Stats,
+                  bulk: bool = False, force: bool = False):
+    """
+    Publish the files of one table in order, each one once it is uploaded.
+    A table stops at its first failure, so a later day is never published
+    before an earlier one.
+
+    In bulk mode, the files of the table are published together, in as few
+    publish requests as the batch settings allow, once they are all uploaded,
+    with the table as ordering key.
+
+    With `force`, the messages ask the dispatcher to load the files even if
+    their content is in the index (see `content_index`).
+    """
+    attributes = {content_index.FORCE_ATTRIBUTE: 'true'} if force else {}
+    batch = publishing.PublishBatch()
+    start = time.perf_counter()
+    for file in files:
+        try:
+            blob_path = uploads[file['source']].result()
+        except Exception as e:
+            print(f"[ERROR] {file['source']}: {e}")
+            print(f"[ERROR] {file['table']}: arrêt avant {file['name']}, relancer pour reprendre")
+            stats.add('failed')
+            break
+
+        def published(message_id, file=file, blob_path=blob_path):
+            stats.add('published')
+            checkpoint.record(file['source'], blob_path)
+            print(f"     {file['table']} {file['date']} publié : {blob_path}")
+
+        if not bulk:
+            start = time.perf_counter()
+        batch.publish(
+            topic_path,
+            file['table'].encode('utf-8'),
+            {'bucket_name': bucket_name, 'blob_path': blob_path, 'file_date': file['date'], **attributes},
+            on_success=published,
+            on_failure=lambda error: stats.add('failed'),
+            # maybe published: not written to the checkpoint, published again by the next run
+            on_unknown=lambda: stats.add('unknown'),
+            ordering_key=file['table'] if bulk else None,
+        )
+        if not bulk:
+            summary = batch.flush()
+            stats.time('publish', start)
+            if summary['failed'] or summary['unknown']:
+                print(f"[ERROR] {file['table']}: arrêt après {file['name']}, relancer pour reprendre")
+                return
+
+    if bulk:
+        batch.flush()
+        stats.time('publish', start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill of the landing bucket.')
+    parser.add_argument('source', help="Local directory or pattern, or gs://<bucket>/<pattern> (e.g. 'data/2022060*/').")
+    parser.add_argument('--bucket', required=True, help='Landing bucket.')
+    parser.add_argument('--project', default=os.environ.get('GCP_PROJECT'), help='GCP project of the topic.')
+    parser.add_argument('--topic', default=os.environ.get('pubsub_topic_id', 'valid_file'), help='Pub/Sub topic of the dispatcher.')
+    parser.add_argument('--workers', type=int, default=16, help='Maximum number of concurrent uploads.')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help='Checkpoint file of the published files.')
+    parser.add_argument('--validate-content', action='store_true', help='Check the content of the files before uploading them.')
+    parser.add_argument('--bulk', action='store_true', help='Publish the files of a table together once they are all uploaded.')
+    parser.add_argument('--force', action='store_true', help='Load the files even if their content was already loaded.')
+    parser.add_argument('--dry-run', action='store_true', help='Only list what would be published.')
+    args = parser.parse_args()
+
+    trigger_main = load_trigger_main()
+    checkpoint = Checkpoint(args.checkpoint)
+    stats = Stats()
+
+    # check the names and group the files per table, in file date order
+    files_per_table = {}
+    for file in list_source_files(args.source):
+        valid, message, table_name, file_date = trigger_main.verifier_nom_fichier(file['name'])
+        if not valid:
+            print(f"[WARNING] {file['source']} ignoré : {message}")
+            stats.add('invalid_name')
+            continue
+        if checkpoint.done(file['source']):
+            stats.add('already_published')
+            continue
+        _, _, compression = tables.split_file_name(file['name'])
+        files_per_table.setdefault(table_name, []).append({**file, 'table': table_name, 'date': file_date, 'compression': compression})
+    for files in files_per_table.values():
+        files.sort(key=lambda file: (file['date'], file['name']))
+
+    to_publish = sum(len(files) for files in files_per_table.values())
+    print(f"{to_publish} fichier(s) à publier, {stats.counters.get('already_published', 0)} déjà publié(s), "
+          f"{stats.counters.get('invalid_name', 0)} nom(s) invalide(s)")
+    for table_name, files in sorted(files_per_table.items()):
+        print(f"    {table_name}: {len(files)} fichier(s), {files[0]['date']} -> {files[-1]['date']}")
+    if args.dry_run or not to_publish:
+        return
+
+    if args.project is None:
+        raise ValueError("Le projet est requis : --project ou la variable d'environnement 'GCP_PROJECT'.")
+    if args.bulk:
+        # read when the publisher client is built
+        os.environ['pubsub_message_ordering'] = 'true'
+    bucket = clients.storage_client().bucket(args.bucket)
+    topic_path = clients.publisher_client().topic_path(args.project, args.topic)
+    run_id = uuid.uuid4().hex
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as upload_pool, \
+            ThreadPoolExecutor(max_workers=len(files_per_table)) as publish_pool:
+        # the uploads of the earliest days are submitted first
+        uploads = {}
+        for file in sorted((file for files in files_per_table.values() for file in files), key=lambda file: file['date']):
+            uploads[file['source']] = upload_pool.submit(stage_file, file, bucket, run_id, args.validate_content, stats)
+        publications = {table_name: publish_pool.submit(publish_table, files, uploads, topic_path, args.bucket,
+                                                        checkpoint, stats, args.bulk, args.force)
+                        for table_name, files in files_per_table.items()}
+    elapsed = time.perf_counter() - start
+
+    for table_name, publication in publications.items():
+        try:
+            publication.result()
+        except Exception as e:
+            print(f'[ERROR] {table_name}: publication interrompue : {e!r}, relancer pour reprendre')
+            stats.add('failed')
+
+    published = stats.counters.get('published', 0)
+    megabytes = stats.counters.get('bytes', 0) / 1024 ** 2
+    print(f'\n{published} fichier(s) publié(s) sur {to_publish}, '
+          f"{stats.counters.get('failed', 0)} échec(s), {stats.counters.get('unknown', 0)} incertaine(s), "
+          f'en {elapsed:.1f} s')
+    print(f'    débit : {published / elapsed:.1f} fichiers/s, {megabytes / elapsed:.1f} Mo/s ({megabytes:.1f} Mo)')
+    for stage, total_ms in sorted(stats.stages_ms.items()):
+        print(f'    {stage:<16}: {total_ms / 1000:8.1f} s cumulées')
+    if published < to_publish or stats.counters.get('failed', 0):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Cold start benchmark of the Cloud Functions.
+
+Each run starts a fresh Python interpreter (like a new function instance),
+imports the function `main.py` and, for the trigger function, handles an
+`archive/` finalize event, which must exit before any GCP SDK is imported.
+
+Usage (from the repository root):
+
+    python tools/benchmark_cold_start.py --runs 20
+    python tools/benchmark_cold_start.py --runs 20 --budget-ms 250
+
+For each function it reports the median / p95 / max of:
+    - process_ms: the whole interpreter run (start, import, event, exit)
+    - import_ms: the import of `main.py`
+    - fast_exit_ms: the handling of the ignored `archive/` event
+and the slowest imported modules (from `python -X importtime`).
+With `--budget-ms`, the script exits with an error when the p95 of the
+import of a function is over the budget, so it can run in a CI step.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+FUNCTIONS = {
+    'cf_trigger_on_file': os.path.join(REPOSITORY_PATH, 'cloud_functions', 'cf_trigger_on_file', 'src'),
+    'cf_dispatch_workflow': os.path.join(REPOSITORY_PATH, 'cloud_functions', 'cf_dispatch_workflow', 'src'),
+}
+
+RESULT_MARKER = '__benchmark_result__'
+
+# Runs inside the fresh interpreter, from the `src/` folder of the function.
+RUN_SCRIPT = f'''
+import json, sys, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+result = {{'import_ms': (t1 - t0) * 1000}}
+if hasattr(main, 'check_file_format'):
+    main.check_file_format({{'bucket': 'benchmark', 'name': 'archive/store_20220601.csv'}}, {{}})
+    result['fast_exit_ms'] = (time.perf_counter() - t1) * 1000
+result['google_modules'] = len([m for m in sys.modules if m == 'google' or m.startswith('google.')])
+print('{RESULT_MARKER}' + json.dumps(result))
+'''
+
+ENVIRONMENT = {
+    'GCP_PROJECT': 'benchmark-project',
+    'pubsub_topic_id': 'valid_file',
+    'util_bucket_suffix': 'magasin_cie_utils',
+    'wkf_location': 'europe-west1',
+}
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    Nearest-rank percentile of a list of values.
+    """
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, round(q / 100 * len(values) + 0.5) - 1))
+    return values[rank]
+
+
+def parse_importtime(stderr: str) -> dict:
+    """
+    Parse the `-X importtime` output into {module: cumulative time in ms}.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # import time: <self us> | <cumulative us> | <indented module name>
+        _, cumulative_us, module = line[len('import time:'):].split('|')
+        modules[module.strip()] = int(cumulative_us) / 1000
+    return modules
+
+
+def run_once(src_path: str) -> dict:
+    """
+    Run the cold start of a function once in a new interpreter.
+
+    Args:
+         src_path (str): Path of the `src/` folder of the function.
+    """
+    env = {**os.environ, **ENVIRONMENT}
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', RUN_SCRIPT],
+        cwd=src_path,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    process_ms = (time.perf_counter() - start) * 1000
+
+    if process.returncode != 0:
+        raise RuntimeError(f'The cold start run failed in {src_path}:\n{process.stderr[-2000:]}')
+
+    result_line = next(line for line in process.stdout.splitlines() if line.startswith(RESULT_MARKER))
+    result = json.loads(result_line[len(RESULT_MARKER):])
+    result['process_ms'] = process_ms
+    result['modules'] = parse_importtime(process.stderr)
+    return result
+
+
+def summarize(values: list) -> str:
+    return (f'median {statistics.median(values):8.1f} ms | '
+            f'p95 {percentile(values, 95):8.1f} ms | '
+            f'max {max(values):8.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark of the Cloud Functions.')
+    parser.add_argument('--runs', type=int, default=10, help='Number of fresh interpreters per function.')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest modules to show.')
+    parser.add_argument('--budget-ms', type=float, default=None, help='Maximum p95 import time of a function.')
+    parser.add_argument('--function', choices=list(FUNCTIONS), default=None, help='Benchmark only this function.')
+    args = parser.parse_args()
+
+    over_budget = []
+    for function_name, src_path in FUNCTIONS.items():
+        if args.function and args.function != function_name:
+            continue
+
+        runs = [run_once(src_path) for _ in range(args.runs)]
+
+        print(f'\n{function_name} ({args.runs} runs)')
+        for metric in ['process_ms', 'import_ms', 'fast_exit_ms']:
+            values = [run[metric] for run in runs if metric in run]
+            if values:
+                print(f'    {metric:<14}: {summarize(values)}')
+
+        google_modules = max(run['google_modules'] for run in runs)
+        print(f'    google.* modules imported: {google_modules}')
+
+        # average cumulative import time of the slowest top level imports of main.py
+        modules = {}
+        for run in runs:
+            for module, cumulative_ms in run['modules'].items():
+                modules.setdefault(module, []).append(cumulative_ms)
+        slowest = sorted(modules.items(), key=lambda item: -statistics.mean(item[1]))[:args.top]
+        print(f'    slowest imports:')
+        for module, values in slowest:
+            print(f'        {statistics.mean(values):8.1f} ms  {module}')
+
+        p95_import_ms = percentile([run['import_ms'] for run in runs], 95)
+        if args.budget_ms is not None and p95_import_ms > args.budget_ms:
+            over_budget.append(f'{function_name}: p95 import {p95_import_ms:.1f} ms > budget {args.budget_ms:.1f} ms')
+
+    if over_budget:
+        print('\n' + '\n'.join(over_budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+End to end benchmark of the pipeline on the local emulator (see
+`local_emulator.py`): no GCP project is needed.
+
+The day folders of the data are replayed in order. Each file of a day is:
+    - uploaded to `input/` of the emulated landing bucket and handed to
+      `check_file_format` as its finalize event;
+    - each message published is delivered to `receive_messages`, which loads
+      the file into the raw table (SQLite), moves it and triggers the
+      workflow of the table, which merges the raw rows into the cleaned table.
+At the end of each day, `track_executions` runs as its schedule would (for the
+`async` wait mode, the load batches and the coalesced workflows).
+
+With `--concurrent`, the messages of a day are instead delivered together,
+once all its files are checked, and handled at once by the dispatcher of the
+push entry point (see `async_dispatcher.py`).
+
+Usage (from the repository root):
+
+    python tools/benchmark_pipeline.py
+    python tools/benchmark_pipeline.py '__materials__/data/2022060*' --runs 3
+    python tools/benchmark_pipeline.py --env load_batch_max_files=3 --env wkf_wait_mode=async
+    python tools/benchmark_pipeline.py --env content_validation_max_errors=10 --json pipeline_benchmark.json
+    python tools/benchmark_pipeline.py --env stream_max_bytes=65536 --env content_index=true
+    python tools/benchmark_pipeline.py --concurrent --env async_table_concurrency=2
+
+It reports the p50 / p95 latency of each function and of each of its stages
+(the instrumentation spans), the messages delivered per second, the API calls
+counted by the functions next to the calls received by the emulated services,
+and the rows of the tables at the end. The output of the functions is hidden
+unless `--verbose`.
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import glob
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+
+from collections import Counter, defaultdict
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+FUNCTIONS = {
+    'cf_trigger_on_file': os.path.join(REPOSITORY_PATH, 'cloud_functions', 'cf_trigger_on_file', 'src'),
+    'cf_dispatch_workflow': os.path.join(REPOSITORY_PATH, 'cloud_functions', 'cf_dispatch_workflow', 'src'),
+}
+
+ENVIRONMENT = {
+    'GCP_PROJECT': 'emulator-project',
+    'pubsub_topic_id': 'valid_file',
+    'util_bucket_suffix': 'magasin_cie_utils',
+    'wkf_location': 'europe-west1',
+}
+
+DEFAULT_DAYS = os.path.join('__materials__', 'data', '2022*')
+
+import local_emulator  # noqa: E402
+from benchmark_cold_start import percentile  # noqa: E402
+from common import instrumentation  # noqa: E402
+
+
+def load_function_main(function_name: str):
+    """
+    Import `main.py` of a function under its own module name, its `src/`
+    folder first in the path for its local modules.
+    """
+    src_path = FUNCTIONS[function_name]
+    if src_path not in sys.path:
+        sys.path.insert(0, src_path)
+    spec = importlib.util.spec_from_file_location(f'{function_name}_main', os.path.join(src_path, 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def list_days(pattern: str) -> list:
+    """
+    Day folders matching the pattern, with their files, in order.
+    """
+    days = []
+    for day_path in sorted(glob.glob(os.path.join(REPOSITORY_PATH, pattern) if not os.path.isabs(pattern) else pattern)):
+        if os.path.isdir(day_path):
+            files = sorted(path for path in glob.glob(os.path.join(day_path, '*')) if os.path.isfile(path))
+            if files:
+                days.append((os.path.basename(day_path), files))
+    return days
+
+
+def run_pipeline(days: list, trigger, dispatcher, verbose: bool = False, concurrent: bool = False) -> dict:
+    """
+    Replay the days on a new emulator.
+
+    Returns:
+         dict: The invocation records, the counts and the emulator of the run.
+    """
+    project_id = os.environ['GCP_PROJECT']
+    emulator = local_emulator.LocalEmulator(project_id, os.environ['util_bucket_suffix'])
+    emulator.install()
+    emulator.deploy()
+    exporter = instrumentation.InMemoryExporter()
+    instrumentation.set_exporter(exporter)
+    topic_path = emulator.publisher.topic_path(project_id, os.environ['pubsub_topic_id'])
+
+    def call(function, event):
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        try:
+            with output:
+                function(event, {})
+        except Exception as e:
+            # recorded with the `error` status by the instrumentation
+            print(f'[ERROR] {function.__name__}: {e!r}')
+
+    def dispatch_together(events):
+        # one dispatcher per run: its table limits live on the event loop of the run
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            errors = asyncio.run(dispatcher.async_dispatcher.Dispatcher(dispatcher.receive_messages).dispatch_all(events))
+        for error in errors:
+            if error is not None:
+                print(f'[ERROR] receive_messages: {error!r}')
+
+    delivered = 0
+    start = time.perf_counter()
+    for _, files in days:
+        events = []
+        for path in files:
+            with open(path, 'rb') as source:
+                blob = emulator.landing_bucket.put(f'input/{os.path.basename(path)}', source.read())
+            call(trigger.check_file_format, {
+                'bucket': emulator.landing_bucket.name,
+                'name': blob.name,
+                'generation': str(blob.generation),
+                'size': str(blob.size),
+                'md5Hash': blob.md5_hash,
+                'crc32c': blob.crc32c,
+                'metadata': None,
+            })
+            for message in emulator.publisher.pull(topic_path):
+                delivered += 1
+                event = {
+                    'data': base64.b64encode(message['data']),
+                    'attributes': message['attributes'],
+                    'messageId': message['message_id'],
+                }
+                if concurrent:
+                    events.append(event)
+                else:
+                    call(dispatcher.receive_messages, event)
+        if events:
+            dispatch_together(events)
+        call(dispatcher.track_executions, {})
+    elapsed = time.perf_counter() - start
+
+    return {
+        'records': list(exporter.records),
+        'elapsed': elapsed,
+        'files': sum(len(files) for _, files in days),
+        'delivered': delivered,
+        'emulator': emulator,
+    }
+
+
+def latency(values: list) -> dict:
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50), 2),
+        'p95_ms': round(percentile(values, 95), 2),
+        'max_ms': round(max(values), 2),
+    }
+
+
+def summarize(runs: list) -> dict:
+    """
+    Gather the results of the runs into the figures of the report.
+    """
+    durations = defaultdict(list)
+    stages = defaultdict(list)
+    errors = Counter()
+    counted_calls = defaultdict(Counter)
+    metrics = Counter()
+    received_calls = Counter()
+    for run in runs:
+        received_calls.update(run['emulator'].api_calls())
+        for record in run['records']:
+            function_name = record['function']
+            durations[function_name].append(record['duration_ms'])
+            errors[function_name] += record['status'] == 'error'
+            counted_calls[function_name].update(record['api_calls'])
+            metrics.update({name: value for name, value in record['metrics'].items() if isinstance(value, (int, float))})
+            for stage, span_record in record['spans'].items():
+                stages[(function_name, stage)].append(span_record['total_ms'])
+
+    elapsed = sum(run['elapsed'] for run in runs)
+    delivered = sum(run['delivered'] for run in runs)
+    last = runs[-1]['emulator']
+    return {
+        'runs': len(runs),
+        'files': sum(run['files'] for run in runs),
+        'messages_delivered': delivered,
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_second': round(delivered / elapsed, 2) if elapsed else None,
+        'functions': {
+            function_name: {
+                **latency(values),
+                'errors': errors[function_name],
+                'api_calls': dict(counted_calls[function_name]),
+                'stages': {stage: latency(stage_values) for (name, stage), stage_values in sorted(stages.items())
+                           if name == function_name},
+            }
+            for function_name, values in durations.items()
+        },
+        'api_calls_counted': dict(sum(counted_calls.values(), Counter())),
+        'api_calls_received': dict(received_calls),
+        'metrics': dict(metrics),
+        'tables': {table_id: last.bigquery.count_rows(table_id) for table_id in last.bigquery.table_ids()},
+        'executions': dict(Counter(execution.state.name for execution in last.executions.executions())),
+    }
+
+
+def print_report(summary: dict):
+    print(f"\n{summary['runs']} run(s): {summary['files']} files, {summary['messages_delivered']} messages "
+          f"in {summary['elapsed_s']:.2f} s ({summary['messages_per_second']} messages/s)")
+    print(f"\n{'':<24}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for function_name, figures in summary['functions'].items():
+        print(f"{function_name:<24}{figures['count']:>8}{figures['errors']:>8}"
+              f"{figures['p50_ms']:>10.1f}{figures['p95_ms']:>10.1f}{figures['max_ms']:>10.1f}")
+        for stage, stage_figures in figures['stages'].items():
+            print(f"    {stage:<20}{stage_figures['count']:>8}{'':>8}"
+                  f"{stage_figures['p50_ms']:>10.1f}{stage_figures['p95_ms']:>10.1f}{stage_figures['max_ms']:>10.1f}")
+        print(f"    api calls: {figures['api_calls']}")
+    print(f"\nAPI calls counted by the functions: {summary['api_calls_counted']}")
+    print(f"API calls received by the emulator: {summary['api_calls_received']}")
+    print(f"metrics: {summary['metrics']}")
+    print(f"workflow executions (last run): {summary['executions']}")
+    print(f"rows (last run): {summary['tables']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end benchmark of the pipeline on the local emulator.')
+    parser.add_argument('days', nargs='?', default=DEFAULT_DAYS, help='Glob pattern of the day folders to replay.')
+    parser.add_argument('--runs', type=int, default=1, help='Number of replays, each on a new emulator.')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='Environment variable of the functions (can be repeated).')
+    parser.add_argument('--json', default=None, help='Write the figures to this JSON file.')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the functions.')
+    parser.add_argument('--concurrent', action='store_true',
+                        help='Deliver the messages of a day together to the asyncio dispatcher.')
+    args = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT)
+    for assignment in args.env:
+        name, _, value = assignment.partition('=')
+        os.environ[name] = value
+
+    days = list_days(args.days)
+    if not days:
+        parser.error(f'No day folder matches {args.days}')
+
+    trigger = load_function_main('cf_trigger_on_file')
+    dispatcher = load_function_main('cf_dispatch_workflow')
+
+    runs = [run_pipeline(days, trigger, dispatcher, args.verbose, args.concurrent) for _ in range(args.runs)]
+    local_emulator.LocalEmulator.uninstall()
+
+    summary = summarize(runs)
+    print_report(summary)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(summary, json_file, indent=2)
+        print(f'\nfigures written to {args.json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+"""
+Seeded generator of synthetic landing files, for load and scale tests.
+
+`__materials__/data/` only holds 30 days of a few MB. This script writes as
+many days as needed, in the same layout and formats, from a few KB to tens of
+GB per day:
+
+    <output>/<YYYYMMDD>/store_<YYYYMMDD>.csv
+    <output>/<YYYYMMDD>/customer_<YYYYMMDD>.csv
+    <output>/<YYYYMMDD>/basket_<YYYYMMDD>.json[.gz]
+
+The columns follow the raw schemas (`schemas/raw/<table>.json`) and the
+values the layouts of the real files (8 digit store ids, `%d-%b-%y` creation
+dates of the customers, `quantity` as a string in the basket lines, ...):
+    - store: the snapshot of `--stores` stores, every day;
+    - customer: `--customers` updates of the day, a customer keeps the same
+      name and email from day to day;
+    - basket: baskets of the day from a catalog of `--products` products,
+      until the file reaches `--size` bytes (before compression).
+
+The quality of the rows is controlled by fractions of the rows:
+    - `--bad-rows`: rows rejected by the raw schema (missing column, value
+      of the wrong type, truncated JSON, missing REQUIRED field);
+    - `--duplicates`: copies of the previous row;
+    - `--late-updates`: rows of a previous day (purchase or update time one
+      to three days before the file date, store updated on the day).
+
+The files are generated in chunks of `--chunk-rows` rows, each from its own
+seed (`--seed`, table, date and chunk number), by a pool of `--workers`
+processes (all the cores by default), then written in order: the output
+only depends on the arguments, not on the number of workers, and the memory
+used only on the chunk size. With `--gzip`, each chunk is compressed by its
+worker as one gzip member of the basket file.
+
+Usage (from the repository root):
+
+    python tools/generate_data.py
+    python tools/generate_data.py --output /tmp/data --days 3 --size 200M --bad-rows 0.001 --duplicates 0.01
+    python tools/generate_data.py --output /tmp/big --days 1 --size 20G --gzip --late-updates 0.05
+    python tools/benchmark_pipeline.py '/tmp/data/2022*'
+"""
+import argparse
+import csv
+import functools
+import gzip
+import io
+import json
+import os
+import random
+import re
+import sys
+import time
+
+from collections import deque
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+DEFAULT_OUTPUT = os.path.join('__materials__', 'data', 'generated')
+DEFAULT_CHUNK_ROWS = 5000
+INITIAL_CUSTOMERS = 1000
+
+# kinds of a generated line (bits)
+BAD = 1
+DUPLICATE = 2
+LATE = 4
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+CITIES = [
+    ('Paris 09', 'France', 2.3203606, 48.8770819), ('Nevers', 'France', 3.162845, 46.990896),
+    ('Arles', 'France', 4.6277769, 43.676647), ('Carcassonne', 'France', 2.2790497, 43.2077677),
+    ('Laval', 'France', -0.8042021, 48.0577888), ('Paris La Défense', 'France', 2.238988, 48.8909967),
+    ('Marseille', 'France', 5.3698, 43.2965), ('Lyon', 'France', 4.7650903, 45.7579293),
+    ('Lille', 'France', 2.9033727, 50.6309924), ('La Rochelle', 'France', -1.2114931, 46.1620459),
+    ('Bruxelles', 'Belgique', 4.3053775, 50.855103), ('Nantes', 'France', -1.5536, 47.2184),
+    ('Bordeaux', 'France', -0.5792, 44.8378), ('Genève', 'Suisse', 6.1432, 46.2044),
+]
+PAYMENT_MODES = [('Mastercard', 44), ('Visa', 29), ('Cash', 27)]
+SYLLABLES = ['an', 'bel', 'car', 'da', 'el', 'fen', 'gal', 'hor', 'is', 'jo', 'ka', 'lin', 'mar', 'no', 'or',
+             'pe', 'qui', 'ros', 'sa', 'ti', 'ul', 'val', 'wen', 'xa', 'yo', 'zel']
+DOMAINS = ['ebay.com', 'yahoo.co.jp', 'nytimes.com', 'weebly.com', 'wiley.com', 'admin.ch', 'mayoclinic.com']
+PRODUCT_FAMILIES = ['Bread', 'Cheese', 'Coffee', 'Wine', 'Pasta', 'Fish', 'Beef', 'Fruit', 'Juice', 'Tea',
+                    'Soup', 'Spice', 'Rice', 'Oil', 'Cake', 'Sauce', 'Nuts', 'Yogurt', 'Chocolate', 'Salad']
+
+
+@functools.lru_cache(maxsize=None)
+def raw_columns(table_name: str) -> tuple:
+    """
+    Column names of a raw schema, in order.
+    """
+    with open(os.path.join(REPOSITORY_PATH, 'schemas', 'raw', f'{table_name}.json'), encoding='utf-8-sig') as schema:
+        return tuple(field['name'] for field in json.load(schema))
+
+
+def parse_size(size: str) -> int:
+    """
+    '512', '64K', '200M', '20G' -> bytes.
+    """
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMGT]?)B?', size.strip().upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(f'Taille invalide : {size}')
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2) or ' '))
+
+
+def _rng(options: dict, *keys) -> random.Random:
+    # a str seed is hashed with SHA-512: the same on every platform and run
+    return random.Random(':'.join(str(key) for key in (options['seed'],) + keys))
+
+
+def _name(rng: random.Random) -> str:
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+
+
+# --------------------------------------------------------------------------
+# Reference data, the same in every worker (derived from the seed only)
+# --------------------------------------------------------------------------
+
+def store(options: dict, number: int) -> dict:
+    rng = _rng(options, 'store', number)
+    city, country, x, y = CITIES[(number - 1) % len(CITIES)]
+    if number > len(CITIES):
+        city = f'{city} {number // len(CITIES) + 1}'
+    created = datetime(2012, 1, 1) + timedelta(days=rng.randint(0, 3650))
+    return {
+        'id_store': f'{number:08d}',
+        'id_manager': f'{rng.randint(1, 99):08d}',
+        'city': city,
+        'country': country,
+        'x_coordinate': str(round(x + rng.uniform(-0.05, 0.05), 7)),
+        'y_coordinate': str(round(y + rng.uniform(-0.05, 0.05), 7)),
+        'is_closed': 'Y' if rng.random() < 0.05 else 'N',
+        'creation_date': created.strftime('%d-%m-%Y'),
+        'update_time': (options['start'] - timedelta(days=rng.randint(1, 30), minutes=rng.randint(0, 1439)))
+        .strftime('%Y-%m-%dT%H:%M:00Z'),
+    }
+
+
+def cash_desks(options: dict) -> list:
+    if '_cash_desks' not in options:
+        rng = _rng(options, 'cash_desks')
+        options['_cash_desks'] = [f'{number:08d}-{desk:08d}'
+                                  for number in range(1, options['stores'] + 1)
+                                  for desk in rng.sample(range(1, 121), 11)]
+    return options['_cash_desks']
+
+
+def products(options: dict) -> list:
+    if '_products' not in options:
+        rng = _rng(options, 'products')
+        catalog = []
+        for number in range(options['products']):
+            family = PRODUCT_FAMILIES[number % len(PRODUCT_FAMILIES)]
+            catalog.append((f'{family} - {_name(rng)} {number}', round(rng.uniform(0.5, 15), 2)))
+        options['_products'] = catalog
+    return options['_products']
+
+
+def customers_until(options: dict, day_index: int) -> int:
+    """
+    Number of customers which exist at the end of a day.
+    """
+    return INITIAL_CUSTOMERS + (day_index + 1) * options['customers']
+
+
+def customer(options: dict, id_customer: int) -> dict:
+    rng = _rng(options, 'customer', id_customer)
+    first_name, last_name = _name(rng), _name(rng)
+    if id_customer <= INITIAL_CUSTOMERS:
+        created = options['start'] - timedelta(days=rng.randint(1, 30))
+    else:
+        created = options['start'] + timedelta(days=(id_customer - INITIAL_CUSTOMERS - 1) // options['customers'])
+    return {
+        'id_customer': str(id_customer),
+        'first_name': first_name,
+        'last_name': last_name,
+        'email': f'{first_name[0]}{last_name}{rng.randint(1, 99)}@{rng.choice(DOMAINS)}'.lower(),
+        'creation_date': f'{created.day:02d}-{MONTHS[created.month - 1]}-{created.strftime("%y")}',
+        'update_time': None,
+    }
+
+
+# --------------------------------------------------------------------------
+# Chunks, generated by the workers
+# --------------------------------------------------------------------------
+
+def _timestamp(day: datetime, rng: random.Random, late: bool) -> datetime:
+    moment = day + timedelta(seconds=rng.randint(0, 86399))
+    return moment - timedelta(days=rng.randint(1, 3)) if late else moment
+
+
+def _csv_line(columns: tuple, row: dict) -> str:
+    output = io.StringIO()
+    csv.writer(output, lineterminator='\n').writerow([row[column] for column in columns])
+    return output.getvalue()
+
+
+def _bad_csv_line(columns: tuple, row: dict, rng: random.Random) -> str:
+    if rng.random() < 0.5:
+        # one column missing
+        return _csv_line(columns[:-1], row)
+    # a value of the wrong type for the raw schema
+    row = dict(row, update_time='32-13-2022 25:61')
+    if 'x_coordinate' in row:
+        row['x_coordinate'] = 'n/a'
+    return _csv_line(columns, row)
+
+
+def _store_rows(options: dict, day: datetime, rng: random.Random, first: int, count: int):
+    numbers = list(range(1, options['stores'] + 1))
+    _rng(options, 'store_order', day.date()).shuffle(numbers)
+    for number in numbers[first:first + count]:
+        row = store(options, number)
+        is_late = rng.random() < options['late_updates']
+        if is_late:
+            # changed on the day: new manager, new update time
+            row.update(id_manager=f'{rng.randint(1, 99):08d}',
+                       update_time=_timestamp(day, rng, False).strftime('%Y-%m-%dT%H:%M:00Z'))
+        yield row, is_late
+
+
+def _customer_rows(options: dict, day: datetime, rng: random.Random, count: int):
+    for _ in range(count):
+        row = customer(options, rng.randint(1, customers_until(options, options['_day_index'])))
+        is_late = rng.random() < options['late_updates']
+        row['update_time'] = _timestamp(day, rng, is_late).strftime('%Y-%m-%dT%H:%M:00Z')
+        yield row, is_late
+
+
+def _basket_line(options: dict, day: datetime, rng: random.Random) -> tuple:
+    is_late = rng.random() < options['late_updates']
+    purchase = _timestamp(day, rng, is_late)
+    if is_late:
+        updated = day + timedelta(seconds=rng.randint(0, 86399))
+    else:
+        updated = min(purchase + timedelta(seconds=rng.randint(60, 600)), day + timedelta(seconds=86399))
+    catalog = products(options)
+    lines = 1
+    while lines < 40 and rng.random() < 0.75:
+        lines += 1
+    record = {
+        'id_cash_desk': rng.choice(cash_desks(options)),
+        'id_customer': str(rng.randint(1, customers_until(options, options['_day_index']))),
+        'detail': [{'product_name': name, 'quantity': str(round(rng.uniform(1, 13))),
+                    'unit_price': round(price * rng.uniform(0.9, 1.1), 2)}
+                   for name, price in (rng.choice(catalog) for _ in range(lines))],
+        'payment_mode': rng.choices([mode for mode, _ in PAYMENT_MODES], [weight for _, weight in PAYMENT_MODES])[0],
+        'purchase_date': purchase.strftime('%d-%m-%Y %H:%M:%S'),
+        'update_time': updated.strftime('%Y-%m-%d %H:%M:%S UTC'),
+    }
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n', is_late
+
+
+def _bad_basket_line(line: str, rng: random.Random) -> str:
+    kind = rng.randrange(3)
+    if kind == 0:
+        # truncated JSON
+        return line[:len(line) // 2] + '\n'
+    record = json.loads(line)
+    if kind == 1:
+        # REQUIRED field missing
+        del record['id_cash_desk']
+    else:
+        record['detail'][0]['unit_price'] = 'abc'
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+
+def generate_chunk(task: tuple) -> dict:
+    """
+    Rows `first` to `first + count` of a file, from the seed of the chunk.
+
+    Returns:
+         dict: `lines` (list of str), `kinds` (for each line, BAD, DUPLICATE
+               and LATE bits) and `packed` (the chunk as one gzip member with
+               `--gzip`).
+    """
+    table_name, day_index, chunk, first, count, options = task
+    options = dict(options, _day_index=day_index)
+    day = options['start'] + timedelta(days=day_index)
+    rng = _rng(options, table_name, day.date(), chunk)
+    columns = raw_columns(table_name)
+
+    if table_name == 'store':
+        clean_lines = ((_csv_line(columns, row), is_late)
+                       for row, is_late in _store_rows(options, day, rng, first, count))
+    elif table_name == 'customer':
+        clean_lines = ((_csv_line(columns, row), is_late) for row, is_late in _customer_rows(options, day, rng, count))
+    else:
+        clean_lines = (_basket_line(options, day, rng) for _ in range(count))
+
+    lines, kinds, previous = [], [], None
+    for line, is_late in clean_lines:
+        kind = LATE if is_late else 0
+        draw = rng.random()
+        if draw < options['bad_rows']:
+            kind |= BAD
+            if table_name == 'basket':
+                line = _bad_basket_line(line, rng)
+            else:
+                line = _bad_csv_line(columns, dict(zip(columns, next(csv.reader([line])))), rng)
+        elif draw < options['bad_rows'] + options['duplicates'] and previous is not None:
+            # a copy of the previous good row
+            line, kind = previous
+            kind |= DUPLICATE
+        else:
+            previous = line, kind
+        lines.append(line)
+        kinds.append(kind)
+
+    packed = gzip.compress(''.join(lines).encode('utf-8'), compresslevel=6) if options['gzip'] else None
+    return {'lines': lines, 'kinds': kinds, 'packed': packed}
+
+
+def _count(summary: dict, kinds: list):
+    summary['rows'] += len(kinds)
+    summary['bad_rows'] += sum(1 for kind in kinds if kind & BAD)
+    summary['duplicates'] += sum(1 for kind in kinds if kind & DUPLICATE)
+    summary['late'] += sum(1 for kind in kinds if kind & LATE)
+
+
+# --------------------------------------------------------------------------
+# Files, written in order by the main process
+# --------------------------------------------------------------------------
+
+def _tasks(table_name: str, day_index: int, options: dict):
+    """
+    Chunks of a file, endless for the baskets (written until `--size`).
+    """
+    chunk_rows = options['chunk_rows']
+    total = {'store': options['stores'], 'customer': options['customers']}.get(table_name)
+    chunk = 0
+    while total is None or chunk * chunk_rows < total:
+        count = chunk_rows if total is None else min(chunk_rows, total - chunk * chunk_rows)
+        yield table_name, day_index, chunk, chunk * chunk_rows, count, options
+        chunk += 1
+
+
+def write_file(pool: Pool, path: str, table_name: str, day_index: int, options: dict) -> dict:
+    """
+    Generate the chunks of a file in parallel and write them in order, at
+    most two chunks per worker in memory.
+
+    Returns:
+         dict: Rows, bad rows, duplicates, late rows and bytes written.
+    """
+    header = ','.join(raw_columns(table_name)) + '\n' if table_name != 'basket' else ''
+    target = options['size'] if table_name == 'basket' else None
+    summary = {'rows': 0, 'bad_rows': 0, 'duplicates': 0, 'late': 0, 'bytes': 0}
+    compressed = options['gzip'] and table_name == 'basket'
+
+    tasks = _tasks(table_name, day_index, options)
+    pending = deque()
+    with open(path, 'wb') as output:
+        if header:
+            output.write(header.encode('utf-8'))
+            summary['bytes'] += len(header.encode('utf-8'))
+        while True:
+            while len(pending) < 2 * options['workers']:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                pending.append(pool.apply_async(generate_chunk, (task,)))
+            if not pending:
+                break
+            result = pending.popleft().get()
+            data = ''.join(result['lines']).encode('utf-8')
+            if target is not None and summary['bytes'] + len(data) > target:
+                # last chunk: only the lines up to the size
+                lines = []
+                size = summary['bytes']
+                for line in result['lines']:
+                    if size >= target:
+                        break
+                    lines.append(line)
+                    size += len(line.encode('utf-8'))
+                data = ''.join(lines).encode('utf-8')
+                output.write(gzip.compress(data, compresslevel=6) if compressed else data)
+                _count(summary, result['kinds'][:len(lines)])
+                summary['bytes'] += len(data)
+                for future in pending:
+                    future.wait()
+                break
+            output.write(result['packed'] if compressed else data)
+            _count(summary, result['kinds'])
+            summary['bytes'] += len(data)
+            if target is not None and summary['bytes'] >= target:
+                break
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seeded generator of synthetic landing files.')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='Folder of the day folders.')
+    parser.add_argument('--start', default='20220601', help='First day, YYYYMMDD.')
+    parser.add_argument('--days', type=int, default=30, help='Number of days.')
+    parser.add_argument('--size', type=parse_size, default='2M',
+                        help='Size of the basket file of a day before compression (64K, 200M, 20G).')
+    parser.add_argument('--stores', type=int, default=11, help='Stores of the store snapshot.')
+    parser.add_argument('--customers', type=int, default=10, help='Customer updates per day.')
+    parser.add_argument('--products', type=int, default=850, help='Products of the catalog.')
+    parser.add_argument('--bad-rows', type=float, default=0.0, help='Fraction of rows rejected by the raw schema.')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='Fraction of rows copied from the previous one.')
+    parser.add_argument('--late-updates', type=float, default=0.0, help='Fraction of rows of a previous day.')
+    parser.add_argument('--gzip', action='store_true', help='Write basket_<date>.json.gz.')
+    parser.add_argument('--seed', default='0', help='Seed of the generation.')
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS, help='Rows generated per task.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Generating processes.')
+    args = parser.parse_args()
+
+    options = {
+        'seed': args.seed,
+        'start': datetime.strptime(args.start, '%Y%m%d'),
+        'size': args.size,
+        'stores': args.stores,
+        'customers': args.customers,
+        'products': args.products,
+        'bad_rows': args.bad_rows,
+        'duplicates': args.duplicates,
+        'late_updates': args.late_updates,
+        'gzip': args.gzip,
+        'chunk_rows': args.chunk_rows,
+        'workers': args.workers,
+    }
+
+    start = time.perf_counter()
+    total_bytes = 0
+    with Pool(processes=args.workers) as pool:
+        for day_index in range(args.days):
+            file_date = (options['start'] + timedelta(days=day_index)).strftime('%Y%m%d')
+            folder = os.path.join(args.output, file_date)
+            os.makedirs(folder, exist_ok=True)
+            for table_name, extension in [('store', 'csv'), ('customer', 'csv'), ('basket', 'json')]:
+                suffix = '.gz' if args.gzip and table_name == 'basket' else ''
+                path = os.path.join(folder, f'{table_name}_{file_date}.{extension}{suffix}')
+                summary = write_file(pool, path, table_name, day_index, options)
+                total_bytes += summary['bytes']
+                print(f"{path}: {summary['rows']} rows ({summary['bad_rows']} bad, {summary['duplicates']} duplicates, "
+                      f"{summary['late']} late), {summary['bytes'] / 1024 ** 2:.1f} MiB")
+    elapsed = time.perf_counter() - start
+    print(f'{args.days} day(s), {total_bytes / 1024 ** 2:.1f} MiB in {elapsed:.1f} s '
+          f'({total_bytes / 1024 ** 2 / elapsed:.1f} MiB/s, {args.workers} workers)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1579 @@
+"""
+In-process emulator of the GCP services used by the pipeline, to run the
+functions locally (and benchmark them) without a project:
+    - `EmulatedStorage`: buckets and objects kept in memory, with their
+      generations and the generation preconditions used by the functions;
+    - `EmulatedPublisher`: topics whose messages are queued until the caller
+      delivers them (`pull`);
+    - `EmulatedBigQuery`: load jobs from the emulated buckets (CSV,
+      newline-delimited JSON or Parquet, gzipped or not), copy jobs and
+      queries, on an embedded SQLite database with one attached database per
+      dataset; the `table$YYYYMMDD` partitions are kept in a
+      `_PARTITIONTIME` column;
+    - `EmulatedBigQueryWrite`: PENDING write streams of Arrow rows,
+      appended to the SQLite table of their `EmulatedBigQuery` at the commit;
+    - `EmulatedExecutions`: the `cleaned_wkf` workflow, run as soon as it is
+      created: the cleaned query of each table of its arguments is run on the
+      SQLite database (merged, or written over the cleaned table with
+      `{"full_refresh": true}`), and the statistics of the jobs returned.
+
+SQLite does not speak BigQuery: `run_script` rewrites the subset used by the
+queries of `queries/` (project-qualified table names, QUALIFY, DECLARE ...
+DEFAULT, MERGE ... WHEN [NOT] MATCHED, transactions, UNNEST of the REPEATED
+columns, ST_GEOGPOINT, PARSE_DATE, REGEXP_EXTRACT, TIMESTAMP literals and
+TIMESTAMP(), CURRENT_TIMESTAMP(), _PARTITIONDATE, `@name` query parameters,
+the arrays and structs as JSON texts). A query outside of this subset fails
+in the emulator, not necessarily in BigQuery.
+
+`LocalEmulator.install()` registers the emulated clients with
+`common.clients.set_client`, so the functions run unchanged, and `deploy()`
+creates what terraform would (schemas, cleaned tables, workflows with their
+embedded queries). Each emulated service counts the calls it receives in `calls`.
+
+Needs `google-api-core` and `google-cloud-workflows` (as the functions), and
+`pyarrow` only to load Parquet files or stream Arrow rows
+(with `google-cloud-bigquery-storage`).
+"""
+import base64
+import csv
+import glob
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from collections import Counter, deque
+from concurrent.futures import Future
+from datetime import date, datetime, timezone
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+sys.path.append(os.path.join(REPOSITORY_PATH, 'cloud_functions'))
+
+from common import clients  # noqa: E402
+from common import tables  # noqa: E402
+
+DATASETS = ['raw', 'cleaned']
+PARTITION_COLUMN = '_PARTITIONTIME'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f+00:00'
+
+
+def _not_found(message: str):
+    from google.api_core.exceptions import NotFound
+    return NotFound(message)
+
+
+def _precondition_failed(message: str):
+    from google.api_core.exceptions import PreconditionFailed
+    return PreconditionFailed(message)
+
+
+def _conflict(message: str):
+    from google.api_core.exceptions import Conflict
+    return Conflict(message)
+
+
+def _bad_request(message: str):
+    from google.api_core.exceptions import BadRequest
+    return BadRequest(message)
+
+
+# --------------------------------------------------------------------------
+# Cloud Storage
+# --------------------------------------------------------------------------
+
+def _crc32c(data: bytes):
+    """
+    Base64 CRC32C of an object, as Cloud Storage gives it (None without the
+    `google-crc32c` package).
+    """
+    try:
+        import google_crc32c
+    except ImportError:
+        return None
+    return base64.b64encode(google_crc32c.value(data).to_bytes(4, 'big')).decode('ascii')
+
+
+class EmulatedStorage:
+    """
+    Storage client: buckets of in-memory objects, created on first use.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buckets = {}
+        self._generations = itertools.count(int(time.time() * 1000000))
+        self.calls = Counter()
+
+    def _count(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+
+    def _next_generation(self) -> int:
+        with self._lock:
+            return next(self._generations)
+
+    def bucket(self, bucket_name: str):
+        with self._lock:
+            if bucket_name not in self._buckets:
+                self._buckets[bucket_name] = EmulatedBucket(self, bucket_name)
+            return self._buckets[bucket_name]
+
+    def list_blobs(self, bucket_or_name, prefix: str = None, **kwargs):
+        bucket = bucket_or_name if isinstance(bucket_or_name, EmulatedBucket) else self.bucket(bucket_or_name)
+        return bucket.list_blobs(prefix=prefix)
+
+
+class EmulatedBucket:
+
+    def __init__(self, storage: EmulatedStorage, name: str):
+        self._storage = storage
+        self.name = name
+        # name -> {'data', 'md5_hash', 'crc32c', 'generation', 'metadata', 'content_type', 'updated'}
+        self._objects = {}
+
+    def _object(self, blob_name: str):
+        with self._storage._lock:
+            return self._objects.get(blob_name)
+
+    def _write(self, blob_name: str, data: bytes, content_type: str, metadata: dict, if_generation_match: int = None) -> dict:
+        with self._storage._lock:
+            current = self._objects.get(blob_name)
+            if if_generation_match is not None and (current['generation'] if current else 0) != if_generation_match:
+                raise _precondition_failed(f'{self.name}/{blob_name}: generation {if_generation_match} does not match')
+            self._objects[blob_name] = {
+                'data': data,
+                'md5_hash': base64.b64encode(hashlib.md5(data).digest()).decode('ascii'),
+                'crc32c': _crc32c(data),
+                'generation': self._storage._next_generation(),
+                'metadata': dict(metadata) if metadata else None,
+                'content_type': content_type,
+                'updated': datetime.now(timezone.utc),
+            }
+            return self._objects[blob_name]
+
+    def blob(self, blob_name: str, generation: int = None, **kwargs):
+        return EmulatedBlob(self, blob_name, generation=generation)
+
+    def get_blob(self, blob_name: str, **kwargs):
+        self._storage._count('get_blob')
+        current = self._object(blob_name)
+        if current is None:
+            return None
+        blob = EmulatedBlob(self, blob_name)
+        blob._set_properties(current)
+        return blob
+
+    def copy_blob(self, blob, destination_bucket, new_name: str = None, if_source_generation_match: int = None, **kwargs):
+        self._storage._count('copy_blob')
+        source = self._object(blob.name)
+        if source is None:
+            raise _not_found(f'{self.name}/{blob.name}')
+        if if_source_generation_match is not None and source['generation'] != if_source_generation_match:
+            raise _precondition_failed(f'{self.name}/{blob.name}: generation {if_source_generation_match} does not match')
+        new_name = new_name or blob.name
+        copied = destination_bucket._write(new_name, source['data'], source['content_type'], source['metadata'])
+        new_blob = EmulatedBlob(destination_bucket, new_name)
+        new_blob._set_properties(copied)
+        return new_blob
+
+    def delete_blob(self, blob_name: str, **kwargs):
+        self.blob(blob_name).delete(**kwargs)
+
+    def list_blobs(self, prefix: str = None, **kwargs):
+        self._storage._count('list_blobs')
+        with self._storage._lock:
+            objects = sorted(self._objects.items())
+        blobs = []
+        for blob_name, current in objects:
+            if prefix and not blob_name.startswith(prefix):
+                continue
+            blob = EmulatedBlob(self, blob_name)
+            blob._set_properties(current)
+            blobs.append(blob)
+        return iter(blobs)
+
+    def object_names(self, prefix: str = '') -> list:
+        """
+        Names of the objects of the bucket (not counted as a call).
+        """
+        with self._storage._lock:
+            return sorted(name for name in self._objects if name.startswith(prefix))
+
+    def put(self, blob_name: str, data: bytes, metadata: dict = None, content_type: str = None):
+        """
+        Write an object (not counted as a call), as an upload from outside of
+        the functions would.
+
+        Returns:
+             EmulatedBlob: The new object, with its generation.
+        """
+        blob = EmulatedBlob(self, blob_name)
+        blob._set_properties(self._write(blob_name, data, content_type, metadata))
+        return blob
+
+    def read(self, blob_name: str) -> bytes:
+        """
+        Content of an object (not counted as a call), for the other emulated
+        services.
+        """
+        current = self._object(blob_name)
+        if current is None:
+            raise _not_found(f'{self.name}/{blob_name}')
+        return current['data']
+
+
+class EmulatedBlob:
+
+    def __init__(self, bucket: EmulatedBucket, name: str, generation: int = None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+        self.size = None
+        self.md5_hash = None
+        self.crc32c = None
+        self.metadata = None
+        self.content_type = None
+        self.updated = None
+
+    def _set_properties(self, current: dict):
+        self.generation = current['generation']
+        self.size = len(current['data'])
+        self.md5_hash = current['md5_hash']
+        self.crc32c = current['crc32c']
+        self.metadata = dict(current['metadata']) if current['metadata'] else None
+        self.content_type = current['content_type']
+        self.updated = current['updated']
+
+    def _current(self, if_generation_match: int = None) -> dict:
+        current = self.bucket._object(self.name)
+        if current is None:
+            raise _not_found(f'{self.bucket.name}/{self.name}')
+        expected = if_generation_match if if_generation_match is not None else self.generation
+        if expected is not None and current['generation'] != expected:
+            if if_generation_match is not None:
+                raise _precondition_failed(f'{self.bucket.name}/{self.name}: generation {expected} does not match')
+            raise _not_found(f'{self.bucket.name}/{self.name}#{expected}')
+        return current
+
+    def exists(self, **kwargs) -> bool:
+        self.bucket._storage._count('exists')
+        return self.bucket._object(self.name) is not None
+
+    def reload(self, **kwargs):
+        self.bucket._storage._count('reload')
+        self._set_properties(self._current())
+
+    def download_as_bytes(self, if_generation_match: int = None, **kwargs) -> bytes:
+        self.bucket._storage._count('download')
+        current = self._current(if_generation_match)
+        self._set_properties(current)
+        return current['data']
+
+    download_as_string = download_as_bytes
+
+    def download_as_text(self, encoding: str = 'utf-8', **kwargs) -> str:
+        return self.download_as_bytes(**kwargs).decode(encoding)
+
+    def upload_from_string(self, data, content_type: str = None, if_generation_match: int = None, **kwargs):
+        self.bucket._storage._count('upload')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._set_properties(self.bucket._write(self.name, data, content_type, self.metadata, if_generation_match))
+
+    def upload_from_filename(self, filename: str, content_type: str = None, if_generation_match: int = None, **kwargs):
+        with open(filename, 'rb') as source:
+            self.upload_from_string(source.read(), content_type, if_generation_match)
+
+    def upload_from_file(self, file_obj, content_type: str = None, if_generation_match: int = None, **kwargs):
+        self.upload_from_string(file_obj.read(), content_type, if_generation_match)
+
+    def rewrite(self, source, token=None, **kwargs):
+        self.bucket._storage._count('rewrite')
+        current = source.bucket._object(source.name)
+        if current is None:
+            raise _not_found(f'{source.bucket.name}/{source.name}')
+        metadata = self.metadata if self.metadata is not None else current['metadata']
+        self._set_properties(self.bucket._write(self.name, current['data'], current['content_type'], metadata))
+        return None, self.size, self.size
+
+    def delete(self, if_generation_match: int = None, **kwargs):
+        self.bucket._storage._count('delete')
+        with self.bucket._storage._lock:
+            self._current(if_generation_match)
+            del self.bucket._objects[self.name]
+
+    def open(self, mode: str = 'r', chunk_size: int = None, ignore_flush: bool = False, encoding: str = None, **kwargs):
+        if mode in ['r', 'rb', 'rt']:
+            data = self.download_as_bytes()
+            reader = io.BytesIO(data)
+            return reader if mode == 'rb' else io.TextIOWrapper(reader, encoding=encoding or 'utf-8')
+        if mode in ['w', 'wb', 'wt']:
+            writer = _BlobWriter(self)
+            return writer if mode == 'wb' else io.TextIOWrapper(writer, encoding=encoding or 'utf-8')
+        raise ValueError(f'Unsupported mode {mode}')
+
+
+class _BlobWriter(io.BytesIO):
+    """
+    Binary file uploaded to its blob when it is closed.
+    """
+
+    def __init__(self, blob: EmulatedBlob):
+        super().__init__()
+        self._blob = blob
+
+    def close(self):
+        if not self.closed:
+            self._blob.upload_from_string(self.getvalue())
+        super().close()
+
+
+# --------------------------------------------------------------------------
+# Pub/Sub
+# --------------------------------------------------------------------------
+
+class EmulatedPublisher:
+    """
+    Publisher client: the messages of each topic are queued until `pull`.
+
+    Args:
+         failure_rate (float): Share of the publications which fail, to
+                               exercise the retries.
+         seed (int): Seed of the failures.
+    """
+
+    def __init__(self, failure_rate: float = 0.0, seed: int = 0):
+        self._lock = threading.Lock()
+        self._topics = {}
+        self._ids = itertools.count(1)
+        self._random = random.Random(seed)
+        self.failure_rate = failure_rate
+        self._paused = set()
+        self.calls = Counter()
+
+    @staticmethod
+    def topic_path(project: str, topic: str) -> str:
+        return f'projects/{project}/topics/{topic}'
+
+    def publish(self, topic: str, data: bytes, ordering_key: str = '', **attributes) -> Future:
+        future = Future()
+        with self._lock:
+            self.calls['publish'] += 1
+            if ordering_key and (topic, ordering_key) in self._paused:
+                # like the client: a failed key refuses the next messages until `resume_publish`
+                future.set_exception(RuntimeError(f'ordering key {ordering_key} paused'))
+                return future
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                from google.api_core.exceptions import ServiceUnavailable
+                if ordering_key:
+                    self._paused.add((topic, ordering_key))
+                future.set_exception(ServiceUnavailable('emulated publication failure'))
+                return future
+            message_id = str(next(self._ids))
+            self._topics.setdefault(topic, deque()).append({
+                'message_id': message_id,
+                'data': data,
+                'attributes': {name: str(value) for name, value in attributes.items()},
+                'ordering_key': ordering_key,
+                'publish_time': datetime.now(timezone.utc).isoformat(),
+            })
+        future.set_result(message_id)
+        return future
+
+    def resume_publish(self, topic: str, ordering_key: str):
+        with self._lock:
+            self._paused.discard((topic, ordering_key))
+
+    def pull(self, topic: str, max_messages: int = None) -> list:
+        """
+        Take the messages waiting in a topic, oldest first.
+        """
+        with self._lock:
+            queue = self._topics.get(topic, deque())
+            count = len(queue) if max_messages is None else min(max_messages, len(queue))
+            return [queue.popleft() for _ in range(count)]
+
+    def pending(self, topic: str) -> int:
+        with self._lock:
+            return len(self._topics.get(topic, ()))
+
+
+# --------------------------------------------------------------------------
+# BigQuery on SQLite
+# --------------------------------------------------------------------------
+
+def _parse_timestamp(value) -> datetime:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day, tzinfo=timezone.utc)
+    text = str(value).strip()
+    if text.endswith(' UTC'):
+        text = text[:-len(' UTC')] + '+00:00'
+    elif text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+    parsed = datetime.fromisoformat(text)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def format_timestamp(value) -> str:
+    """
+    Text of a TIMESTAMP in the database: fixed width, in UTC, so that the
+    timestamps compare as text.
+    """
+    return _parse_timestamp(value).astimezone(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+_TRUE = {'true', 't', 'yes', 'y', '1'}
+_FALSE = {'false', 'f', 'no', 'n', '0'}
+
+
+def _field_dict(field) -> dict:
+    return field if isinstance(field, dict) else field.to_api_repr()
+
+
+def _json_value(field: dict, value):
+    """
+    Value of a nested field, typed but kept JSON serializable.
+    """
+    if value is None:
+        return None
+    if field.get('mode', 'NULLABLE').upper() == 'REPEATED':
+        item_field = {**field, 'mode': 'NULLABLE'}
+        return [_json_value(item_field, item) for item in value]
+    field_type = field['type'].upper()
+    if field_type in ['RECORD', 'STRUCT']:
+        return {sub_field['name']: _json_value(sub_field, value.get(sub_field['name'])) for sub_field in field.get('fields', [])}
+    return _column_value(field, value)
+
+
+def _column_value(field: dict, value):
+    """
+    Value of a loaded field as stored in SQLite.
+    """
+    if value is None:
+        return None
+    field_type = field['type'].upper()
+    if field.get('mode', 'NULLABLE').upper() == 'REPEATED' or field_type in ['RECORD', 'STRUCT']:
+        if isinstance(value, str):
+            value = json.loads(value)
+        return json.dumps(_json_value(field, value))
+    if value == '' and field_type != 'STRING':
+        return None
+    if field_type in ['INTEGER', 'INT64']:
+        return int(value)
+    if field_type in ['FLOAT', 'FLOAT64', 'NUMERIC', 'BIGNUMERIC']:
+        return float(value)
+    if field_type in ['BOOLEAN', 'BOOL']:
+        if isinstance(value, bool):
+            return int(value)
+        text = str(value).strip().lower()
+        if text not in _TRUE | _FALSE:
+            raise ValueError(f"'{value}' is not a BOOLEAN")
+        return int(text in _TRUE)
+    if field_type == 'TIMESTAMP':
+        return format_timestamp(value)
+    if field_type == 'DATE':
+        return value.isoformat() if isinstance(value, date) else date.fromisoformat(str(value).strip()).isoformat()
+    return value if isinstance(value, str) else str(value)
+
+
+def _arrow_field(arrow_field) -> dict:
+    import pyarrow as pa
+
+    arrow_type, mode = arrow_field.type, 'NULLABLE'
+    if pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type):
+        arrow_type, mode = arrow_type.value_type, 'REPEATED'
+    field = {'name': arrow_field.name, 'mode': mode}
+    if pa.types.is_struct(arrow_type):
+        field.update(type='RECORD', fields=[_arrow_field(arrow_type.field(index)) for index in range(arrow_type.num_fields)])
+    elif pa.types.is_integer(arrow_type):
+        field['type'] = 'INTEGER'
+    elif pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+        field['type'] = 'FLOAT'
+    elif pa.types.is_boolean(arrow_type):
+        field['type'] = 'BOOLEAN'
+    elif pa.types.is_timestamp(arrow_type):
+        field['type'] = 'TIMESTAMP'
+    elif pa.types.is_date(arrow_type):
+        field['type'] = 'DATE'
+    else:
+        field['type'] = 'STRING'
+    return field
+
+
+def arrow_fields(arrow_schema) -> list:
+    """
+    BigQuery schema of a Parquet file from its Arrow schema, as a Parquet
+    load infers it (lists as REPEATED fields, structs as RECORD).
+    """
+    return [_arrow_field(arrow_schema.field(index)) for index in range(len(arrow_schema.names))]
+
+
+def _split_table_id(table_id: str) -> tuple:
+    """
+    'project.dataset.table$YYYYMMDD' -> (dataset, table, 'YYYYMMDD' or None)
+    """
+    table_id = str(table_id)
+    table_id, _, partition = table_id.partition('$')
+    parts = table_id.replace(':', '.').split('.')
+    return parts[-2], parts[-1], partition or None
+
+
+def _partition_time(partition: str) -> str:
+    return format_timestamp(datetime.strptime(partition, '%Y%m%d'))
+
+
+def _bq_parse_date(date_format: str, text: str):
+    if text is None:
+        return None
+    return datetime.strptime(text, date_format).date().isoformat()
+
+
+def _bq_parse_timestamp(timestamp_format: str, text: str):
+    if text is None:
+        return None
+    return format_timestamp(datetime.strptime(text, timestamp_format.replace('%Z', '').strip()))
+
+
+def _bq_safe_parse_timestamp(timestamp_format: str, text: str):
+    try:
+        return _bq_parse_timestamp(timestamp_format, text)
+    except ValueError:
+        return None
+
+
+def _bq_regexp_extract(text: str, pattern: str):
+    if text is None:
+        return None
+    match = re.search(pattern, text)
+    if match is None:
+        return None
+    return match.group(1) if match.groups() else match.group(0)
+
+
+def _bq_concat(*values):
+    # NULL if one of the values is NULL, as in BigQuery
+    if any(value is None for value in values):
+        return None
+    return ''.join(str(value) for value in values)
+
+
+def _bq_geogpoint(longitude, latitude):
+    if longitude is None or latitude is None:
+        return None
+    return f'POINT({float(longitude)} {float(latitude)})'
+
+
+class EmulatedJob:
+    """
+    Load, copy or query job, finished as soon as it is created.
+    """
+
+    def __init__(self, job_type: str, count=None):
+        self._count = count
+        self.job_id = f'emulated_{job_type}_{uuid.uuid4().hex[:12]}'
+        self.job_type = job_type
+        self.state = 'DONE'
+        self.error_result = None
+        self.errors = None
+        self.input_files = 0
+        self.input_file_bytes = 0
+        self.output_rows = 0
+        self.bad_records = 0
+        self.total_bytes_processed = 0
+        self.num_dml_affected_rows = 0
+        self.destination = None
+        self._rows = []
+        self._exception = None
+
+    def _fail(self, exception: Exception):
+        self._exception = exception
+        self.error_result = {'reason': 'invalid', 'message': str(exception)}
+        self.errors = [self.error_result]
+
+    def done(self, **kwargs) -> bool:
+        return True
+
+    def exception(self, **kwargs):
+        return self._exception
+
+    def result(self, **kwargs):
+        if self._count is not None:
+            self._count('job_result')
+        if self._exception is not None:
+            raise self._exception
+        return _RowIterator(self._rows) if self.job_type == 'query' else self
+
+
+class _RowIterator:
+    """
+    Rows of a query, with their number as `RowIterator.total_rows`.
+    """
+
+    def __init__(self, rows: list):
+        self.total_rows = len(rows)
+        self._rows = iter(rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def __next__(self):
+        return next(self._rows)
+
+
+class EmulatedBigQuery:
+    """
+    BigQuery client on an in-memory SQLite database.
+
+    Args:
+         storage (EmulatedStorage): Storage the load jobs read the files from.
+    """
+
+    def __init__(self, storage: EmulatedStorage):
+        self._storage = storage
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False, isolation_level=None)
+        for dataset in DATASETS:
+            self.connection.execute(f"ATTACH DATABASE ':memory:' AS {dataset}")
+        self.connection.create_function('ST_GEOGPOINT', 2, _bq_geogpoint, deterministic=True)
+        self.connection.create_function('PARSE_DATE', 2, _bq_parse_date, deterministic=True)
+        self.connection.create_function('PARSE_TIMESTAMP', 2, _bq_parse_timestamp, deterministic=True)
+        self.connection.create_function('SAFE_PARSE_TIMESTAMP', 2, _bq_safe_parse_timestamp, deterministic=True)
+        self.connection.create_function('BQ_TIMESTAMP', 1, format_timestamp, deterministic=True)
+        self.connection.create_function('REGEXP_EXTRACT', 2, _bq_regexp_extract, deterministic=True)
+        self.connection.create_function('CONCAT', -1, _bq_concat, deterministic=True)
+        self.connection.create_function('BQ_CURRENT_TIMESTAMP', 0, lambda: format_timestamp(datetime.now(timezone.utc)))
+        # (dataset, table) -> {'schema': [fields], 'partitioned': bool}
+        self._tables = {}
+        self.calls = Counter()
+
+    def _count(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+
+    # ----- tables
+
+    def create_table(self, table, schema: list = None, partitioned: bool = False, exists_ok: bool = False, **kwargs):
+        """
+        Create a table from its id and a BigQuery schema (list of fields), or
+        from a `bigquery.Table` as the client does.
+        """
+        if not isinstance(table, str):
+            self._count('create_table')
+            schema, partitioned = table.schema, table.time_partitioning is not None
+            table = f'{table.dataset_id}.{table.table_id}'
+            if self.table_exists(table):
+                if exists_ok:
+                    return
+                raise _conflict(f'Table {table} already exists')
+        dataset, table, _ = _split_table_id(table)
+        schema = [_field_dict(field) for field in schema]
+        columns = [field['name'] for field in schema] + ([PARTITION_COLUMN] if partitioned else [])
+        with self._lock:
+            if dataset not in DATASETS:
+                raise _not_found(f'Dataset {dataset} not found')
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {dataset}.{table} ({", ".join(columns)})')
+            self._tables[(dataset, table)] = {'schema': schema, 'partitioned': partitioned}
+
+    def delete_table(self, table, not_found_ok: bool = False, **kwargs):
+        self._count('delete_table')
+        dataset, table, _ = _split_table_id(table)
+        with self._lock:
+            if (dataset, table) not in self._tables:
+                if not_found_ok:
+                    return
+                raise _not_found(f'Table {dataset}.{table} not found')
+            self.connection.execute(f'DROP TABLE {dataset}.{table}')
+            del self._tables[(dataset, table)]
+
+    def table_ids(self) -> list:
+        with self._lock:
+            return sorted(f'{dataset}.{table}' for dataset, table in self._tables)
+
+    def table_exists(self, table_id: str) -> bool:
+        dataset, table, _ = _split_table_id(table_id)
+        return (dataset, table) in self._tables
+
+    def rows(self, table_id: str) -> list:
+        """
+        Rows of a table (or of one of its partitions) as dicts.
+        """
+        dataset, table, partition = _split_table_id(table_id)
+        query = f'SELECT * FROM {dataset}.{table}'
+        parameters = []
+        if partition:
+            query += f' WHERE {PARTITION_COLUMN} = ?'
+            parameters.append(_partition_time(partition))
+        with self._lock:
+            cursor = self.connection.execute(query, parameters)
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def count_rows(self, table_id: str) -> int:
+        dataset, table, _ = _split_table_id(table_id)
+        with self._lock:
+            return self.connection.execute(f'SELECT COUNT(*) FROM {dataset}.{table}').fetchone()[0]
+
+    # ----- load jobs
+
+    def _read_uri(self, source_uri: str) -> tuple:
+        """
+        Content of a file, decompressed, and its size in the bucket.
+        """
+        bucket_name, _, blob_path = source_uri[len('gs://'):].partition('/')
+        data = self._storage.bucket(bucket_name).read(blob_path)
+        size = len(data)
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        return data, size
+
+    @staticmethod
+    def _records(job_config, schema: list, data: bytes):
+        """
+        Iterate over the records of a file as {column: raw value}.
+        """
+        source_format = getattr(job_config, 'source_format', None) or 'CSV'
+        if source_format == 'CSV':
+            reader = csv.reader(io.StringIO(data.decode('utf-8-sig'), newline=''),
+                                delimiter=getattr(job_config, 'field_delimiter', None) or ',')
+            for row in reader:
+                if reader.line_num <= (getattr(job_config, 'skip_leading_rows', None) or 0) or not row:
+                    continue
+                if len(row) != len(schema):
+                    yield ValueError(f'line {reader.line_num}: {len(row)} columns, {len(schema)} expected')
+                    continue
+                yield {field['name']: value for field, value in zip(schema, row)}
+        elif source_format == 'NEWLINE_DELIMITED_JSON':
+            names = {field['name'] for field in schema}
+            for line_number, line in enumerate(data.decode('utf-8-sig').splitlines(), start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield ValueError(f'line {line_number}: {e}')
+                    continue
+                unknown = set(record) - names
+                if unknown and not getattr(job_config, 'ignore_unknown_values', False):
+                    yield ValueError(f'line {line_number}: unknown fields {sorted(unknown)}')
+                    continue
+                yield record
+        elif source_format == 'PARQUET':
+            import pyarrow.parquet as pq
+
+            for record in pq.read_table(io.BytesIO(data)).to_pylist():
+                yield record
+        else:
+            raise NotImplementedError(f'Source format {source_format} is not emulated')
+
+    def load_table_from_uri(self, source_uris, destination, job_config=None, **kwargs) -> EmulatedJob:
+        self._count('load_table_from_uri')
+        source_uris = [source_uris] if isinstance(source_uris, str) else list(source_uris)
+        dataset, table, partition = _split_table_id(destination)
+        job = EmulatedJob('load', self._count)
+        job.destination = f'{dataset}.{table}'
+        try:
+            with self._lock:
+                self._load(job, source_uris, dataset, table, partition, job_config)
+        except Exception as e:
+            job._fail(e if hasattr(e, 'code') else _bad_request(f'Error while reading data: {e}'))
+        return job
+
+    def _load(self, job: EmulatedJob, source_uris: list, dataset: str, table: str, partition: str, job_config):
+        schema = [_field_dict(field) for field in (getattr(job_config, 'schema', None) or [])]
+        if (dataset, table) not in self._tables:
+            if not schema:
+                # Parquet: the files carry the schema
+                import pyarrow.parquet as pq
+                schema = arrow_fields(pq.read_schema(io.BytesIO(self._read_uri(source_uris[0])[0])))
+            self.create_table(f'{dataset}.{table}', schema,
+                              partitioned=getattr(job_config, 'time_partitioning', None) is not None or partition is not None)
+        table_info = self._tables[(dataset, table)]
+        schema = table_info['schema']
+        if partition and not table_info['partitioned']:
+            raise ValueError(f'{dataset}.{table} is not partitioned, {partition} is not a partition')
+
+        max_bad_records = getattr(job_config, 'max_bad_records', None) or 0
+        partition_time = _partition_time(partition or datetime.now(timezone.utc).strftime('%Y%m%d'))
+        columns = [field['name'] for field in schema] + ([PARTITION_COLUMN] if table_info['partitioned'] else [])
+        rows = []
+        errors = []
+        for source_uri in source_uris:
+            data, size = self._read_uri(source_uri)
+            job.input_files += 1
+            job.input_file_bytes += size
+            for record in self._records(job_config, schema, data):
+                try:
+                    if isinstance(record, Exception):
+                        raise record
+                    row = [_column_value(field, record.get(field['name'])) for field in schema]
+                    missing = [field['name'] for field, value in zip(schema, row)
+                               if value is None and field.get('mode', 'NULLABLE').upper() == 'REQUIRED']
+                    if missing:
+                        raise ValueError(f'missing required field(s) {missing}')
+                except (ValueError, TypeError, KeyError, AttributeError) as e:
+                    errors.append(f'{source_uri}: {e}')
+                    if len(errors) > max_bad_records:
+                        raise ValueError(f'too many errors ({len(errors)}), first one: {errors[0]}')
+                    continue
+                rows.append(row + ([partition_time] if table_info['partitioned'] else []))
+
+        write_disposition = getattr(job_config, 'write_disposition', None) or 'WRITE_APPEND'
+        self.connection.execute('BEGIN')
+        try:
+            if write_disposition == 'WRITE_TRUNCATE':
+                if partition:
+                    self.connection.execute(f'DELETE FROM {dataset}.{table} WHERE {PARTITION_COLUMN} = ?', [partition_time])
+                else:
+                    self.connection.execute(f'DELETE FROM {dataset}.{table}')
+            elif write_disposition == 'WRITE_EMPTY' and self.count_rows(f'{dataset}.{table}'):
+                raise ValueError(f'{dataset}.{table} is not empty')
+            self.connection.executemany(
+                f'INSERT INTO {dataset}.{table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        job.output_rows = len(rows)
+        job.bad_records = len(errors)
+        if errors:
+            job.errors = [{'reason': 'invalid', 'message': error} for error in errors]
+
+    def append_records(self, table_id: str, records: list) -> int:
+        """
+        Append typed records (as written through the Storage Write API) to
+        a table or to one of its partitions, all of them or none.
+        """
+        dataset, table, partition = _split_table_id(table_id)
+        with self._lock:
+            if (dataset, table) not in self._tables:
+                raise _not_found(f'Table {dataset}.{table} not found')
+            table_info = self._tables[(dataset, table)]
+            schema = table_info['schema']
+            columns = [field['name'] for field in schema] + ([PARTITION_COLUMN] if table_info['partitioned'] else [])
+            partition_time = _partition_time(partition or datetime.now(timezone.utc).strftime('%Y%m%d'))
+            rows = [[_column_value(field, record.get(field['name'])) for field in schema]
+                    + ([partition_time] if table_info['partitioned'] else []) for record in records]
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.executemany(
+                    f'INSERT INTO {dataset}.{table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+        return len(rows)
+
+    # ----- copy jobs
+
+    def copy_table(self, sources, destination, job_config=None, **kwargs) -> EmulatedJob:
+        """
+        Copy tables (or partitions) into a table of the same schema (or one of
+        its partitions), the rows of a partition moved to the destination one.
+        """
+        self._count('copy_table')
+        sources = [sources] if isinstance(sources, str) else list(sources)
+        dataset, table, partition = _split_table_id(destination)
+        write_disposition = getattr(job_config, 'write_disposition', None) or 'WRITE_EMPTY'
+        job = EmulatedJob('copy', self._count)
+        job.destination = f'{dataset}.{table}'
+        try:
+            with self._lock:
+                if (dataset, table) not in self._tables:
+                    raise _not_found(f'Table {dataset}.{table} not found')
+                table_info = self._tables[(dataset, table)]
+                columns = [field['name'] for field in table_info['schema']]
+                partition_filter = f' WHERE {PARTITION_COLUMN} = ?' if partition else ''
+                self.connection.execute('BEGIN')
+                try:
+                    if write_disposition == 'WRITE_TRUNCATE':
+                        self.connection.execute(f'DELETE FROM {dataset}.{table}{partition_filter}',
+                                                [_partition_time(partition)] if partition else [])
+                    elif write_disposition == 'WRITE_EMPTY' and self.connection.execute(
+                            f'SELECT COUNT(*) FROM {dataset}.{table}{partition_filter}',
+                            [_partition_time(partition)] if partition else []).fetchone()[0]:
+                        raise _bad_request(f'{destination} is not empty')
+                    for source in sources:
+                        source_dataset, source_table, source_partition = _split_table_id(source)
+                        if (source_dataset, source_table) not in self._tables:
+                            raise _not_found(f'Table {source_dataset}.{source_table} not found')
+                        partition_time = (f"'{_partition_time(partition)}'" if partition else PARTITION_COLUMN)
+                        target = columns + ([PARTITION_COLUMN] if table_info['partitioned'] else [])
+                        selected = columns + ([partition_time] if table_info['partitioned'] else [])
+                        self.connection.execute(
+                            f'INSERT INTO {dataset}.{table} ({", ".join(target)}) '
+                            f'SELECT {", ".join(selected)} FROM {source_dataset}.{source_table}'
+                            + (f' WHERE {PARTITION_COLUMN} = ?' if source_partition else ''),
+                            [_partition_time(source_partition)] if source_partition else [])
+                    self.connection.execute('COMMIT')
+                except Exception:
+                    self.connection.execute('ROLLBACK')
+                    raise
+        except Exception as e:
+            job._fail(e if hasattr(e, 'code') else _bad_request(str(e)))
+        return job
+
+    # ----- queries
+
+    def query(self, query: str, job_config=None, destination: str = None, write_disposition: str = None, **kwargs) -> EmulatedJob:
+        self._count('query')
+        destination = destination or getattr(job_config, 'destination', None)
+        write_disposition = write_disposition or getattr(job_config, 'write_disposition', None) or 'WRITE_EMPTY'
+        job = EmulatedJob('query', self._count)
+        external_tables = []
+        try:
+            with self._lock:
+                changes = self.connection.total_changes
+                job.total_bytes_processed = self._bytes_read(query)
+                for name, external_config in (getattr(job_config, 'table_definitions', None) or {}).items():
+                    job.total_bytes_processed += self._external_table(name, external_config)
+                    external_tables.append(name)
+                parameters = {parameter.name: query_parameter(parameter)
+                              for parameter in getattr(job_config, 'query_parameters', None) or []}
+                columns, rows = run_script(self.connection, query, parameters)
+                job.num_dml_affected_rows = self.connection.total_changes - changes
+                if destination is not None:
+                    self._write_result(str(getattr(destination, 'path', destination)), columns, rows, write_disposition)
+                    job.destination = destination
+                job._rows = [dict(zip(columns, row)) for row in rows]
+                job.output_rows = len(rows)
+        except Exception as e:
+            if self.connection.in_transaction:
+                # a script which failed inside BEGIN TRANSACTION
+                self.connection.execute('ROLLBACK')
+            job._fail(_bad_request(f'Query error: {e}'))
+        finally:
+            with self._lock:
+                for name in external_tables:
+                    self.connection.execute(f'DROP TABLE IF EXISTS temp.{name}')
+        return job
+
+    def _external_table(self, name: str, external_config) -> int:
+        """
+        Temporary external table of a query (`QueryJobConfig.table_definitions`):
+        the rows of its files, with the `_FILE_NAME` pseudo-column, in a
+        temporary SQLite table. A bad row fails the query.
+
+        Returns:
+             int: Bytes of the files read.
+        """
+        source_format = external_config.source_format
+        # the options of the format, as the load jobs have them
+        options = type('ExternalOptions', (), {
+            'source_format': source_format,
+            'field_delimiter': getattr(external_config.options, 'field_delimiter', None),
+            'skip_leading_rows': getattr(external_config.options, 'skip_leading_rows', None),
+            'ignore_unknown_values': external_config.ignore_unknown_values,
+        })()
+        schema = [_field_dict(field) for field in external_config.schema or []]
+        if not schema:
+            import pyarrow.parquet as pq
+            schema = arrow_fields(pq.read_schema(io.BytesIO(self._read_uri(external_config.source_uris[0])[0])))
+
+        columns = [field['name'] for field in schema] + ['_FILE_NAME']
+        self.connection.execute(f'DROP TABLE IF EXISTS temp.{name}')
+        self.connection.execute(f'CREATE TEMP TABLE {name} ({", ".join(columns)})')
+        total = 0
+        for source_uri in external_config.source_uris:
+            data, size = self._read_uri(source_uri)
+            total += size
+            rows = []
+            for record in self._records(options, schema, data):
+                if isinstance(record, Exception):
+                    raise ValueError(f'{source_uri}: {record}')
+                rows.append([_column_value(field, record.get(field['name'])) for field in schema] + [source_uri])
+            self.connection.executemany(
+                f'INSERT INTO temp.{name} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+        return total
+
+    def _bytes_read(self, query: str) -> int:
+        """
+        Bytes of the tables a query reads (all their columns, as text), an
+        order of magnitude of the bytes processed by BigQuery.
+        """
+        total = 0
+        for dataset, table in set(re.findall(r'`(?:[\w-]+[.:])?(\w+)\.(\w+)`', query)):
+            if (dataset, table) not in self._tables:
+                continue
+            columns = [column[1] for column in self.connection.execute(f"PRAGMA {dataset}.table_info('{table}')")]
+            lengths = ' + '.join(f'IFNULL(LENGTH({column}), 0)' for column in columns) or '0'
+            total += self.connection.execute(f'SELECT IFNULL(SUM({lengths}), 0) FROM {dataset}.{table}').fetchone()[0]
+        return total
+
+    def _write_result(self, table_id: str, columns: list, rows: list, write_disposition: str):
+        dataset, table, _ = _split_table_id(table_id.strip('/').replace('/datasets/', '.').replace('/tables/', '.'))
+        if (dataset, table) not in self._tables:
+            self.create_table(f'{dataset}.{table}', [{'name': column, 'type': 'STRING'} for column in columns])
+        self.connection.execute('BEGIN')
+        try:
+            if write_disposition == 'WRITE_TRUNCATE':
+                self.connection.execute(f'DELETE FROM {dataset}.{table}')
+            elif write_disposition == 'WRITE_EMPTY' and self.count_rows(f'{dataset}.{table}'):
+                raise ValueError(f'{dataset}.{table} is not empty')
+            self.connection.executemany(
+                f'INSERT INTO {dataset}.{table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+
+class EmulatedBigQueryWrite:
+    """
+    BigQuery Storage Write API client on the tables of an `EmulatedBigQuery`:
+    PENDING streams of Arrow rows, written to the table at their commit.
+
+    Args:
+         bigquery (EmulatedBigQuery): BigQuery the streams are committed to.
+    """
+
+    def __init__(self, bigquery: EmulatedBigQuery):
+        self._bigquery = bigquery
+        self._lock = threading.Lock()
+        # stream name -> {'table_id': str, 'records': [dict], 'finalized': bool}
+        self._streams = {}
+        self.calls = Counter()
+
+    def _count(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+
+    @staticmethod
+    def table_path(project: str, dataset: str, table: str) -> str:
+        return f'projects/{project}/datasets/{dataset}/tables/{table}'
+
+    @staticmethod
+    def _table_id(parent: str) -> str:
+        parts = parent.split('/')
+        return f'{parts[1]}.{parts[3]}.{parts[5]}'
+
+    def create_write_stream(self, request=None, parent: str = None, write_stream=None, **kwargs):
+        from google.cloud.bigquery_storage_v1 import types
+
+        self._count('create_write_stream')
+        table_id = self._table_id(parent)
+        if not self._bigquery.table_exists(table_id):
+            raise _not_found(f'Table {table_id} not found')
+        name = f'{parent}/streams/{uuid.uuid4().hex}'
+        with self._lock:
+            self._streams[name] = {'table_id': table_id, 'records': [], 'finalized': False}
+        return types.WriteStream(name=name, type_=types.WriteStream.Type.PENDING)
+
+    def append_rows(self, requests, metadata=(), **kwargs):
+        import pyarrow as pa
+        from google.cloud.bigquery_storage_v1 import types
+
+        self._count('append_rows')
+        arrow_schema = None
+        for request in requests:
+            stream = self._streams[request.write_stream]
+            if request.arrow_rows.writer_schema.serialized_schema:
+                arrow_schema = pa.ipc.read_schema(pa.py_buffer(request.arrow_rows.writer_schema.serialized_schema))
+            batch = pa.ipc.read_record_batch(pa.py_buffer(request.arrow_rows.rows.serialized_record_batch), arrow_schema)
+            with self._lock:
+                offset = len(stream['records'])
+                if stream['finalized'] or ('offset' in request and request.offset != offset):
+                    yield types.AppendRowsResponse(error={'code': 11, 'message': f'offset {offset} expected'})
+                    continue
+                stream['records'].extend(batch.to_pylist())
+            yield types.AppendRowsResponse(append_result={'offset': offset}, write_stream=request.write_stream)
+
+    def finalize_write_stream(self, request=None, name: str = None, **kwargs):
+        from google.cloud.bigquery_storage_v1 import types
+
+        self._count('finalize_write_stream')
+        with self._lock:
+            stream = self._streams[name]
+            stream['finalized'] = True
+        return types.FinalizeWriteStreamResponse(row_count=len(stream['records']))
+
+    def batch_commit_write_streams(self, request=None, **kwargs):
+        from google.cloud.bigquery_storage_v1 import types
+
+        self._count('batch_commit_write_streams')
+        for name in request.write_streams:
+            stream = self._streams.pop(name)
+            self._bigquery.append_records(stream['table_id'], stream['records'])
+        return types.BatchCommitWriteStreamsResponse(commit_time=datetime.now(timezone.utc))
+
+
+# ----- BigQuery SQL -> SQLite
+
+def _find_top_level(sql: str, pattern: str, start: int = 0):
+    """
+    First match of `pattern` (a regex) outside of parentheses and quotes.
+    """
+    depth = 0
+    quote = None
+    regex = re.compile(pattern, re.IGNORECASE)
+    position = start
+    while position < len(sql):
+        character = sql[position]
+        if quote:
+            if character == quote:
+                quote = None
+        elif character in '\'"`':
+            quote = character
+        elif character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        elif depth == 0:
+            match = regex.match(sql, position)
+            if match and (position == 0 or not character.isalpha() or not (sql[position - 1].isalnum() or sql[position - 1] == '_')):
+                return match
+        position += 1
+    return None
+
+
+def _closing_parenthesis(sql: str, start: int) -> int:
+    """
+    Position of the parenthesis closing the one at `start`.
+    """
+    depth = 0
+    for position in range(start, len(sql)):
+        if sql[position] == '(':
+            depth += 1
+        elif sql[position] == ')':
+            depth -= 1
+            if depth == 0:
+                return position
+    raise ValueError('Unbalanced parentheses')
+
+
+def _rewrite_qualify(sql: str) -> str:
+    """
+    SELECT <columns> FROM <source> QUALIFY <condition>
+    -> SELECT <columns> FROM (SELECT *, (<condition>) AS _qualify FROM <source>) WHERE _qualify
+    """
+    qualify = _find_top_level(sql, r'QUALIFY\b')
+    if qualify is None:
+        return sql
+    source = _find_top_level(sql, r'FROM\b')
+    if source is None or source.start() > qualify.start():
+        raise ValueError('QUALIFY without FROM')
+    columns = sql[:source.start()]
+    condition = sql[qualify.end():].strip()
+    source_sql = sql[source.end():qualify.start()].strip()
+    return f'{columns} FROM (SELECT *, ({condition}) AS _qualify FROM {source_sql}) WHERE _qualify'
+
+
+def translate(sql: str) -> str:
+    """
+    Rewrite a BigQuery statement (outside of DECLARE and MERGE) for SQLite.
+    """
+    # `project.dataset.table` -> dataset.table
+    sql = re.sub(r'`(?:[\w-]+[.:])?(\w+)\.(\w+)`', r'\1.\2', sql)
+    sql = re.sub(r'\bCURRENT_TIMESTAMP\s*\(\s*\)', 'BQ_CURRENT_TIMESTAMP()', sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bTIMESTAMP\s+'([^']*)'", r"BQ_TIMESTAMP('\1')", sql, flags=re.IGNORECASE)
+    sql = re.sub(r'\bTIMESTAMP\s*\(', 'BQ_TIMESTAMP(', sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bDATE\s+'([^']*)'", r"'\1'", sql, flags=re.IGNORECASE)
+    # BigQuery strings can be double quoted, SQLite identifiers are
+    sql = re.sub(r'"([^"]*)"', r"'\1'", sql)
+    # _PARTITIONDATE is the date of the _PARTITIONTIME column
+    sql = re.sub(r'\b((?:\w+\.)?)_PARTITIONDATE\b', r'date(\1_PARTITIONTIME)', sql)
+    sql = re.sub(r'\bSAFE_CAST\s*\(', 'CAST(', sql, flags=re.IGNORECASE)
+    # SAFE.PARSE_TIMESTAMP(...) -> SAFE_PARSE_TIMESTAMP(...), NULL instead of an error
+    sql = re.sub(r'\bSAFE\.(\w+)\s*\(', r'SAFE_\1(', sql, flags=re.IGNORECASE)
+    # the REPEATED / RECORD columns are JSON texts: UNNEST(x) AS item -> json_each(x), item.field -> json_extract
+    for alias in re.findall(r'\bUNNEST\s*\([^)]*\)\s+AS\s+(\w+)', sql, flags=re.IGNORECASE):
+        sql = re.sub(rf'\b{alias}\.(\w+)\b', rf"json_extract({alias}.value, '$.\1')", sql)
+    sql = re.sub(r'\bUNNEST\s*\(', 'json_each(', sql, flags=re.IGNORECASE)
+    sql = re.sub(r'\bARRAY_LENGTH\s*\(', 'json_array_length(', sql, flags=re.IGNORECASE)
+    return _rewrite_qualify(sql)
+
+
+def _parameter_json(value):
+    if hasattr(value, 'struct_values'):
+        return {name: _parameter_json(item) for name, item in value.struct_values.items()}
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def query_parameter(parameter):
+    """
+    Value bound to a `@name` query parameter: the scalars as they are, the
+    arrays and structs as JSON texts (read with UNNEST, see `translate`).
+    """
+    if hasattr(parameter, 'array_type'):
+        return json.dumps([_parameter_json(value) for value in parameter.values])
+    if hasattr(parameter, 'struct_values'):
+        return json.dumps(_parameter_json(parameter))
+    return _parameter_json(parameter.value)
+
+
+def _sql_literal(value) -> str:
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _merge_statements(statement: str) -> list:
+    """
+    Rewrite a MERGE into SQLite statements on a temporary copy of its source.
+    """
+    match = re.match(r'MERGE\s+(?:INTO\s+)?(?P<target>[\w.`-]+)\s+(?:AS\s+)?(?P<target_alias>\w+)\s+USING\s+',
+                     statement, re.IGNORECASE)
+    if match is None:
+        raise ValueError('Unsupported MERGE')
+    target = translate(match.group('target'))
+    target_alias = match.group('target_alias')
+    position = match.end()
+    if statement[position] == '(':
+        end = _closing_parenthesis(statement, position)
+        source = translate(statement[position + 1:end].strip())
+        position = end + 1
+    else:
+        source_table = re.match(r'[\w.`-]+', statement[position:]).group(0)
+        source = f'SELECT * FROM {translate(source_table)}'
+        position += len(source_table)
+    alias = re.match(r'\s+(?:AS\s+)?(\w+)\s+ON\s+', statement[position:], re.IGNORECASE)
+    if alias is None:
+        raise ValueError('MERGE without source alias')
+    source_alias = alias.group(1)
+    position += alias.end()
+    first_clause = _find_top_level(statement, r'WHEN\b', position)
+    on = translate(statement[position:first_clause.start()].strip())
+
+    statements = ['DROP TABLE IF EXISTS temp._merge_source', f'CREATE TEMP TABLE _merge_source AS {source}']
+    clauses = re.split(r'\bWHEN\s+', statement[first_clause.start():], flags=re.IGNORECASE)
+    inserts = []
+    for clause in filter(None, (clause.strip() for clause in clauses)):
+        clause_match = re.match(r'(?P<kind>NOT\s+MATCHED(?:\s+BY\s+TARGET)?|MATCHED)(?:\s+AND\s+(?P<condition>.+?))?\s+THEN\s+(?P<action>.+)$',
+                                clause, re.IGNORECASE | re.DOTALL)
+        if clause_match is None:
+            raise ValueError(f'Unsupported MERGE clause: WHEN {clause}')
+        condition = translate(clause_match.group('condition')) if clause_match.group('condition') else '1'
+        action = clause_match.group('action').strip()
+        if clause_match.group('kind').upper() == 'MATCHED':
+            if re.match(r'UPDATE\s+SET\s+', action, re.IGNORECASE):
+                assignments = translate(re.sub(r'^UPDATE\s+SET\s+', '', action, flags=re.IGNORECASE))
+                statements.append(f'UPDATE {target} AS {target_alias} SET {assignments} '
+                                  f'FROM temp._merge_source AS {source_alias} WHERE ({on}) AND ({condition})')
+            elif action.upper() == 'DELETE':
+                statements.append(f'DELETE FROM {target} WHERE rowid IN ('
+                                  f'SELECT {target_alias}.rowid FROM {target} AS {target_alias} '
+                                  f'JOIN temp._merge_source AS {source_alias} ON {on} WHERE {condition})')
+            else:
+                raise ValueError(f'Unsupported MERGE action: {action}')
+        else:
+            insert = re.match(r'INSERT\s*(?P<columns>\([^)]*\))?\s*(?:VALUES\s*\((?P<values>.*)\)|ROW)$', action,
+                              re.IGNORECASE | re.DOTALL)
+            if insert is None:
+                raise ValueError(f'Unsupported MERGE action: {action}')
+            values = translate(insert.group('values')) if insert.group('values') else '*'
+            inserts.append(f'INSERT INTO {target} {insert.group("columns") or ""} '
+                           f'SELECT {values} FROM temp._merge_new AS {source_alias} WHERE {condition}')
+
+    if inserts:
+        # the rows not matched are chosen before the updates change the target
+        statements[2:2] = [
+            'DROP TABLE IF EXISTS temp._merge_new',
+            f'CREATE TEMP TABLE _merge_new AS SELECT * FROM temp._merge_source AS {source_alias} '
+            f'WHERE NOT EXISTS (SELECT 1 FROM {target} AS {target_alias} WHERE {on})',
+        ]
+        statements.extend(inserts)
+        statements.append('DROP TABLE temp._merge_new')
+    statements.append('DROP TABLE temp._merge_source')
+    return statements
+
+
+def _split_statements(script: str) -> list:
+    script = re.sub(r'--[^\n]*', '', script)
+    statements = []
+    start = 0
+    while True:
+        end = _find_top_level(script, ';', start)
+        statement = script[start:end.start() if end else len(script)].strip()
+        if statement:
+            statements.append(statement)
+        if end is None:
+            return statements
+        start = end.end()
+
+
+def run_script(connection: sqlite3.Connection, script: str, parameters: dict = None) -> tuple:
+    """
+    Run a BigQuery script (DECLARE, SET, SELECT, MERGE, INSERT, ...) on SQLite.
+
+    Args:
+         connection (sqlite3.Connection): Database of the tables.
+         script (str): BigQuery script.
+         parameters (dict): Values of the `@name` parameters of the script
+                            (see `query_parameter`).
+
+    Returns:
+         tuple: Columns and rows of the last SELECT of the script.
+    """
+    variables = {}
+    columns, rows = [], []
+    for statement in _split_statements(script):
+        for name, value in variables.items():
+            statement = re.sub(rf'\b{name}\b', _sql_literal(value), statement)
+
+        declare = re.match(r'DECLARE\s+(?P<names>\w+(?:\s*,\s*\w+)*)\s+\w+(?:\s+DEFAULT\s+(?P<default>.+))?$',
+                           statement, re.IGNORECASE | re.DOTALL)
+        assign = re.match(r'SET\s+(?P<names>\w+)\s*=\s*(?P<default>.+)$', statement, re.IGNORECASE | re.DOTALL)
+        if declare or assign:
+            match = declare or assign
+            value = None
+            if match.group('default'):
+                value = connection.execute(f"SELECT {translate(match.group('default'))}").fetchone()[0]
+            for name in re.split(r'\s*,\s*', match.group('names')):
+                variables[name] = value
+            continue
+
+        if re.match(r'MERGE\b', statement, re.IGNORECASE):
+            for merge_statement in _merge_statements(statement):
+                connection.execute(merge_statement)
+            continue
+
+        cursor = connection.execute(translate(statement), parameters or {})
+        if cursor.description:
+            columns = [column[0] for column in cursor.description if column[0] != '_qualify']
+            rows = [row[:len(columns)] for row in cursor.fetchall()]
+    return columns, rows
+
+
+# --------------------------------------------------------------------------
+# Workflows
+# --------------------------------------------------------------------------
+
+class EmulatedExecutions:
+    """
+    Executions client of the `cleaned_wkf` workflow, run as soon as it is
+    created (see `cloud_workflows/cleaned_wkf.yaml`).
+
+    Args:
+         bigquery (EmulatedBigQuery): BigQuery the queries run on.
+         workflows (list): Names of the deployed workflows.
+         queries (dict): Queries embedded in the workflow at deploy time,
+                         {table: {'incremental': sql, 'full': sql}}.
+         default_tables (list): Tables and chains refreshed when the
+                                arguments name none.
+    """
+
+    def __init__(self, bigquery: EmulatedBigQuery, workflows: list = (), queries: dict = None,
+                 default_tables: list = None):
+        self._bigquery = bigquery
+        self._lock = threading.Lock()
+        self._executions = {}
+        self.workflows = set(workflows)
+        self.queries = dict(queries or {})
+        self.default_tables = list(default_tables or [])
+        self.calls = Counter()
+
+    def _count(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+
+    def create_execution(self, request: dict = None, parent: str = None, execution=None, **kwargs):
+        from google.cloud.workflows.executions_v1.types import Execution
+
+        self._count('create_execution')
+        request = request or {}
+        parent = request.get('parent', parent)
+        execution = request.get('execution', execution) or Execution()
+        # projects/<project>/locations/<location>/workflows/<workflow>
+        _, project_id, _, _, _, workflow_id = parent.split('/')
+        if workflow_id not in self.workflows:
+            raise _not_found(f'Workflow {parent} not found')
+
+        arguments = json.loads(execution.argument or 'null') or {}
+        start_time = datetime.now(timezone.utc)
+        results, failed = self._run(project_id, arguments)
+        response = Execution(
+            name=f'{parent}/executions/{uuid.uuid4()}',
+            argument=execution.argument,
+            start_time=start_time,
+            end_time=datetime.now(timezone.utc),
+            state=Execution.State.FAILED if failed else Execution.State.SUCCEEDED,
+            result='' if failed else json.dumps(results),
+            error=Execution.Error(payload=json.dumps({'message': f'{failed} table(s) en échec', 'results': results}),
+                                  context=workflow_id) if failed else None,
+        )
+        with self._lock:
+            self._executions[response.name] = response
+        return response
+
+    def _run(self, project_id: str, arguments: dict) -> tuple:
+        """
+        Steps of `cleaned_wkf.yaml`: the query of each table (one after the
+        other, the database runs one query at a time). A table which failed
+        stops its chain, the next tables of the chain are skipped.
+
+        Returns:
+             tuple: The results per table and the number of tables failed.
+        """
+        entries = arguments.get('tables') or self.default_tables or list(self.queries)
+        full_refresh = arguments.get('full_refresh') is True
+        results = {}
+        for entry in entries:
+            chain_failed = False
+            for table_name in (entry if isinstance(entry, list) else [entry]):
+                if chain_failed:
+                    results[table_name] = {'status': 'SKIPPED', 'error': 'Table précédente de la chaîne en échec'}
+                    continue
+                results[table_name] = self._refresh(project_id, table_name, full_refresh)
+                chain_failed = results[table_name]['status'] == 'FAILED'
+        return results, sum(result['status'] == 'FAILED' for result in results.values())
+
+    def _refresh(self, project_id: str, table_name: str, full_refresh: bool) -> dict:
+        """
+        Step `refresh_table` of `cleaned_wkf.yaml` for one table.
+        """
+        try:
+            if table_name not in self.queries:
+                raise ValueError(f'Pas de requête cleaned pour la table {table_name}')
+            query = self.queries[table_name]['full' if full_refresh else 'incremental'].replace('{{ project_id }}', project_id)
+            start = time.perf_counter()
+            if full_refresh:
+                job = self._bigquery.query(query, destination=f'{project_id}.cleaned.{table_name}',
+                                           write_disposition='WRITE_TRUNCATE')
+            else:
+                job = self._bigquery.query(query)
+            job.result()
+            return {
+                'status': 'SUCCEEDED',
+                'job_id': job.job_id,
+                'bytes_processed': str(job.total_bytes_processed),
+                # no slots here: the time of the query
+                'slot_ms': str(round((time.perf_counter() - start) * 1000)),
+                'dml_affected_rows': str(job.num_dml_affected_rows),
+            }
+        except Exception as e:
+            return {'status': 'FAILED', 'error': str(e)}
+
+    def get_execution(self, request: dict = None, name: str = None, **kwargs):
+        self._count('get_execution')
+        name = (request or {}).get('name', name)
+        with self._lock:
+            if name not in self._executions:
+                raise _not_found(f'Execution {name} not found')
+            return self._executions[name]
+
+    def list_executions(self, request: dict = None, parent: str = None, view=None, **kwargs):
+        from google.cloud.workflows.executions_v1.types import Execution, ExecutionView
+
+        self._count('list_executions')
+        request = request or {}
+        parent = request.get('parent', parent)
+        page_size = request.get('page_size') or 100
+        view = request.get('view', view)
+        with self._lock:
+            executions = [execution for name, execution in self._executions.items() if name.startswith(parent + '/')]
+        if view != ExecutionView.FULL:
+            # like the API, the BASIC view (the default) has no argument, result or error
+            executions = [Execution(name=execution.name, state=execution.state, start_time=execution.start_time,
+                                    end_time=execution.end_time) for execution in executions]
+        executions.sort(key=lambda execution: execution.start_time, reverse=True)
+        pages = [_ExecutionsPage(executions[start:start + page_size]) for start in range(0, len(executions), page_size)]
+        return _ExecutionsPager(pages or [_ExecutionsPage([])])
+
+    def executions(self) -> list:
+        with self._lock:
+            return list(self._executions.values())
+
+
+class _ExecutionsPage:
+
+    def __init__(self, executions: list):
+        self.executions = executions
+
+
+class _ExecutionsPager:
+
+    def __init__(self, pages: list):
+        self.pages = iter(pages)
+
+
+# --------------------------------------------------------------------------
+# The whole project
+# --------------------------------------------------------------------------
+
+class LocalEmulator:
+    """
+    The emulated services of a project.
+
+    Args:
+         project_id (str): Project of the buckets, tables and workflows.
+         utils_bucket_suffix (str): Suffix of the utils bucket name.
+         publish_failure_rate (float): Share of the publications which fail.
+    """
+
+    def __init__(self, project_id: str, utils_bucket_suffix: str = 'magasin_cie_utils', publish_failure_rate: float = 0.0):
+        self.project_id = project_id
+        self.storage = EmulatedStorage()
+        self.publisher = EmulatedPublisher(failure_rate=publish_failure_rate)
+        self.bigquery = EmulatedBigQuery(self.storage)
+        self.bigquery_write = EmulatedBigQueryWrite(self.bigquery)
+        self.executions = EmulatedExecutions(self.bigquery)
+        self.landing_bucket = self.storage.bucket(f'{project_id}_magasin_cie_landing')
+        self.utils_bucket = self.storage.bucket(f'{project_id}_{utils_bucket_suffix}')
+
+    def install(self):
+        """
+        Make the functions use the emulated clients.
+        """
+        clients.set_client(clients.STORAGE, self.storage)
+        clients.set_client(clients.PUBLISHER, self.publisher)
+        clients.set_client(clients.BIGQUERY, self.bigquery)
+        clients.set_client(clients.EXECUTIONS, self.executions)
+        clients.set_client(clients.BIGQUERY_WRITE, self.bigquery_write)
+
+    @staticmethod
+    def uninstall():
+        clients.reset_clients()
+
+    def deploy(self, repository_path: str = REPOSITORY_PATH):
+        """
+        Create what terraform creates: the schemas of the utils bucket, the
+        cleaned tables and the workflows, with the queries of
+        `queries/cleaned/` embedded (see `iac/workflows.tf`).
+        """
+        queries_path = os.path.join(repository_path, 'queries', 'cleaned')
+        for query_path in sorted(glob.glob(os.path.join(queries_path, '*_incremental.sql'))):
+            table_name = os.path.basename(query_path)[:-len('_incremental.sql')]
+            with open(query_path, encoding='utf-8') as incremental, \
+                    open(os.path.join(queries_path, f'{table_name}.sql'), encoding='utf-8') as full:
+                self.executions.queries[table_name] = {'incremental': incremental.read(), 'full': full.read()}
+        # the default tables of the workflow (`cleaned_wkf_tables`): the cleaned tables of every raw table
+        self.executions.default_tables = [entry for spec in tables.TABLES_SPEC.values() for entry in spec['cleaned']]
+
+        for dataset in DATASETS:
+            for schema_path in sorted(glob.glob(os.path.join(repository_path, 'schemas', dataset, '*.json'))):
+                table_name = os.path.splitext(os.path.basename(schema_path))[0]
+                with open(schema_path, 'rb') as schema_file:
+                    content = schema_file.read()
+                self.utils_bucket.put(f'{dataset}_{table_name}_json', content)
+                if dataset != 'raw':
+                    # the raw tables are created by their first load
+                    self.bigquery.create_table(f'{dataset}.{table_name}', json.loads(content))
+
+        for workflow_path in sorted(glob.glob(os.path.join(repository_path, 'cloud_workflows', '*.yaml'))):
+            self.executions.workflows.add(os.path.splitext(os.path.basename(workflow_path))[0])
+
+    def api_calls(self) -> dict:
+        """
+        Calls received by each emulated service.
+        """
+        return {
+            'gcs': sum(self.storage.calls.values()),
+            'pubsub': sum(self.publisher.calls.values()),
+            'bigquery': sum(self.bigquery.calls.values()) + sum(self.bigquery_write.calls.values()),
+            'workflows': sum(self.executions.calls.values()),
+        }
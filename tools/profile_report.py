@@ -0,0 +1,150 @@
+"""
+Report of the profiles written by the `profiled` entry points (see
+`cloud_functions/common/profiling.py`).
+
+The snapshots of a local directory or of a `gs://bucket/prefix` are
+aggregated:
+    - the cProfile statistics of all the invocations are added up, and the
+      functions reported by cumulative and by own time, with their share of
+      the profiled time;
+    - the tracemalloc snapshots are compared line by line: the lines which
+      held the most memory at the end of the invocations, in total and per
+      invocation.
+
+Usage (from the repository root):
+
+    python tools/profile_report.py /tmp/profiles
+    python tools/profile_report.py gs://<project>_magasin_cie_utils/profiles --function receive_messages
+    python tools/profile_report.py /tmp/profiles --top 40 --restrict 'cloud_functions|google'
+"""
+import argparse
+import gzip
+import io
+import marshal
+import os
+import pickle
+import pstats
+import sys
+
+from collections import defaultdict
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+sys.path.append(os.path.join(REPOSITORY_PATH, 'cloud_functions'))
+
+from common import clients  # noqa: E402
+from common import profiling  # noqa: E402
+
+
+class _LoadedStats:
+    """
+    cProfile statistics read from a snapshot, in the form `pstats.Stats`
+    accepts.
+    """
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def read_snapshots(source: str, function_name: str = None) -> list:
+    """
+    Read the snapshots of a local directory or a `gs://` prefix.
+
+    Args:
+         source (str): Directory or gs://bucket/prefix of `profile_output`.
+         function_name (str): Only the snapshots of this entry point.
+
+    Returns:
+         list: (path, suffix, content not compressed) of each snapshot.
+    """
+    snapshots = []
+    if source.startswith('gs://'):
+        bucket_name, _, prefix = source[len('gs://'):].partition('/')
+        prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        if function_name:
+            prefix += f'{function_name}/'
+        for blob in clients.storage_client().list_blobs(bucket_name, prefix=prefix):
+            for suffix in [profiling.PSTATS_SUFFIX, profiling.TRACEMALLOC_SUFFIX]:
+                if blob.name.endswith(suffix):
+                    snapshots.append((blob.name, suffix, gzip.decompress(blob.download_as_bytes())))
+    else:
+        root = os.path.join(source, function_name) if function_name else source
+        for folder, _, file_names in sorted(os.walk(root)):
+            for file_name in sorted(file_names):
+                for suffix in [profiling.PSTATS_SUFFIX, profiling.TRACEMALLOC_SUFFIX]:
+                    if file_name.endswith(suffix):
+                        with gzip.open(os.path.join(folder, file_name), 'rb') as snapshot_file:
+                            snapshots.append((os.path.join(folder, file_name), suffix, snapshot_file.read()))
+    return snapshots
+
+
+def profile_report(snapshots: list, top: int, restrict: str = None) -> str:
+    """
+    Hot functions of the cProfile snapshots added up.
+    """
+    profiles = [_LoadedStats(marshal.loads(content)) for _, suffix, content in snapshots
+                if suffix == profiling.PSTATS_SUFFIX]
+    if not profiles:
+        return 'no cProfile snapshot\n'
+
+    output = io.StringIO()
+    stats = pstats.Stats(profiles[0], stream=output)
+    for profile in profiles[1:]:
+        stats.add(profile)
+    output.write(f'{len(profiles)} profiled invocation(s), {stats.total_tt:.3f} s profiled '
+                 f'({stats.total_tt / len(profiles) * 1000:.1f} ms per invocation)\n')
+    restrictions = [restrict, top] if restrict else [top]
+    for sort_key, title in [('cumulative', 'cumulative time'), ('tottime', 'own time')]:
+        output.write(f'\n===== hot functions by {title}\n')
+        stats.sort_stats(sort_key).print_stats(*restrictions)
+    return output.getvalue()
+
+
+def memory_report(snapshots: list, top: int) -> str:
+    """
+    Lines which held the most memory at the end of the invocations.
+    """
+    sizes = defaultdict(int)
+    counts = defaultdict(int)
+    invocations = 0
+    for _, suffix, content in snapshots:
+        if suffix != profiling.TRACEMALLOC_SUFFIX:
+            continue
+        invocations += 1
+        for statistic in pickle.loads(content).statistics('lineno'):
+            frame = statistic.traceback[0]
+            sizes[(frame.filename, frame.lineno)] += statistic.size
+            counts[(frame.filename, frame.lineno)] += statistic.count
+    if not invocations:
+        return 'no tracemalloc snapshot\n'
+
+    lines = [f'\n===== memory held at the end of {invocations} invocation(s), by line',
+             f"{'total KiB':>12}{'KiB/inv.':>12}{'blocks':>10}  line"]
+    for key in sorted(sizes, key=sizes.get, reverse=True)[:top]:
+        filename, lineno = key
+        lines.append(f'{sizes[key] / 1024:>12.1f}{sizes[key] / 1024 / invocations:>12.1f}{counts[key]:>10}  '
+                     f'{filename}:{lineno}')
+    lines.append(f'{"":>12}{sum(sizes.values()) / 1024 / invocations:>12.1f}  KiB per invocation in total')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate the profiles of the Cloud Functions.')
+    parser.add_argument('source', help='Directory or gs://bucket/prefix of `profile_output`.')
+    parser.add_argument('--function', default=None, help='Only this entry point (check_file_format, receive_messages).')
+    parser.add_argument('--top', type=int, default=25, help='Number of functions and lines reported.')
+    parser.add_argument('--restrict', default=None, help='Only the functions whose file:line(name) matches this regex.')
+    args = parser.parse_args()
+
+    snapshots = read_snapshots(args.source, args.function)
+    if not snapshots:
+        parser.error(f'No snapshot under {args.source}')
+    print(profile_report(snapshots, args.top, args.restrict))
+    print(memory_report(snapshots, args.top))
+
+
+if __name__ == '__main__':
+    main()